@@ -0,0 +1,412 @@
+"""
+Load test for the proxy.
+
+Starts a local origin server, drives the proxy with a configurable number of
+concurrent clients and reports throughput, latency percentiles and the memory
+of the proxy and GUI processes. With --verdict a scripted stand-in for the GUI
+listens on the GUI port and answers every held message, so the intercept path
+can be measured without clicking. Results are written as JSON so runs can be
+compared.
+
+    python3 bench.py --concurrency 32 --duration 10 --response-size 16384
+    python3 bench.py --verdict forward --output intercept.json
+"""
+import argparse
+import base64
+import datetime
+import http.client
+import http.server
+import json
+import math
+import os
+import queue
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+
+class OriginHandler(http.server.BaseHTTPRequestHandler):
+    """GET /bytes/<n> returns n bytes, POST returns the length of the request body"""
+    protocol_version = "HTTP/1.1"
+    bodies = {}
+
+    def setup(self):
+        super().setup()
+        # Head and body go out in separate writes, don't let Nagle hold the body back
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        try:
+            size = int(self.path.rsplit("/", 1)[-1])
+        except ValueError:
+            self.send_error(404)
+            return
+        body = self.bodies.get(size)
+        if body is None:
+            body = self.bodies[size] = bytes(i % 251 for i in range(size))
+        self.reply(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self.reply(str(length).encode())
+
+    def reply(self, body):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_origin(host="127.0.0.1"):
+    server = http.server.ThreadingHTTPServer((host, 0), OriginHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve_verdicts(verdict, gui_port):
+    """Stand-in for gui.py: accept the proxy's channel and answer held messages"""
+    import gui
+
+    events = queue.Queue()
+    spool = gui.BodySpool()
+    channel = gui.GuiChannelServer(events, spool, port=gui_port)
+    channel.start()
+    answer = gui.FRAME_FORWARD if verdict == "forward" else gui.FRAME_DROP
+    print("ready", flush=True)
+    while True:
+        frame, _, connection = events.get()
+        if frame.flags & gui.FRAME_FLAG_HOLD:
+            connection.send_frame(answer, frame.id)
+
+
+def read_rss(pid):
+    """Current and peak resident set size of pid in KiB, None if it is gone"""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            fields = dict(line.split(":", 1) for line in status if ":" in line)
+        return int(fields["VmRSS"].split()[0]), int(fields["VmHWM"].split()[0])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def find_process(name):
+    """Pid of the first process whose command name is name"""
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/comm") as comm:
+                    if comm.read().strip() == name:
+                        return int(entry)
+            except OSError:
+                continue
+    return None
+
+
+class MemorySampler(threading.Thread):
+    """Samples the RSS of a few processes until stopped"""
+    INTERVAL = 0.2
+
+    def __init__(self, pids):
+        super().__init__(daemon=True)
+        self.pids = {name: pid for name, pid in pids.items() if pid}
+        self.samples = {name: [] for name in self.pids}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.sample()
+            self.stopped.wait(self.INTERVAL)
+
+    def sample(self):
+        for name, pid in self.pids.items():
+            rss = read_rss(pid)
+            if rss:
+                self.samples[name].append(rss)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.sample()
+
+    def report(self):
+        report = {}
+        for name, samples in self.samples.items():
+            if samples:
+                report[name] = {"pid": self.pids[name], "rss_start_kib": samples[0][0],
+                                "rss_end_kib": samples[-1][0],
+                                "rss_peak_kib": max(max(rss for rss, _ in samples), samples[-1][1])}
+        return report
+
+
+class LoadWorker(threading.Thread):
+    """One client: sends requests through the proxy until the deadline"""
+
+    def __init__(self, options, url, headers, deadline, budget):
+        super().__init__(daemon=True)
+        self.options = options
+        self.url = url
+        self.headers = headers
+        self.deadline = deadline
+        self.budget = budget
+        self.latencies = []  # Seconds, one per completed request
+        self.errors = {}
+        self.bytes_received = 0
+        self.connections = 0
+
+    def run(self):
+        options = self.options
+        body = bytes(options.request_size) if options.request_size else None
+        method = "POST" if body is not None else "GET"
+        connection = None
+        while time.monotonic() < self.deadline and self.budget.take():
+            if connection is None:
+                connection = http.client.HTTPConnection(options.proxy_host, options.proxy_port,
+                                                        timeout=options.timeout)
+                self.connections += 1
+            started = time.perf_counter()
+            try:
+                connection.request(method, self.url, body=body, headers=self.headers)
+                response = connection.getresponse()
+                payload = response.read()
+                elapsed = time.perf_counter() - started
+            except (OSError, http.client.HTTPException) as e:
+                self.count_error(type(e).__name__)
+                connection.close()
+                connection = None
+                continue
+            if response.status == 200:
+                self.latencies.append(elapsed)
+                self.bytes_received += len(payload)
+            else:
+                self.count_error(f"HTTP {response.status}")
+            if not options.keep_alive or response.will_close:
+                connection.close()
+                connection = None
+        if connection is not None:
+            connection.close()
+
+    def count_error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+
+class RequestBudget:
+    """Shared request counter, unlimited when total is None"""
+
+    def __init__(self, total):
+        self.remaining = total
+        self.lock = threading.Lock()
+
+    def take(self):
+        if self.remaining is None:
+            return True
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+def percentile(ordered, point):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(point * len(ordered) / 100) - 1))]
+
+
+def scrape_metrics(options):
+    """Proxy metrics as a dict, empty when the endpoint is not reachable"""
+    from gui import parse_metrics
+
+    try:
+        with urllib.request.urlopen(f"http://{options.proxy_host}:{options.metrics_port}/metrics",
+                                    timeout=2) as reply:
+            return parse_metrics(reply.read().decode(errors="replace"))
+    except OSError:
+        return {}
+
+
+def send_control(options, command):
+    with socket.create_connection((options.proxy_host, options.control_port), timeout=2) as control:
+        control.sendall(command.encode())
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_phase(options, url, headers, seconds, total=None):
+    deadline = time.monotonic() + seconds
+    budget = RequestBudget(total)
+    workers = [LoadWorker(options, url, headers, deadline, budget) for _ in range(options.concurrency)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return workers, time.perf_counter() - started
+
+
+def summarize(workers, elapsed):
+    latencies = sorted(latency for worker in workers for latency in worker.latencies)
+    errors = {}
+    for worker in workers:
+        for kind, count in worker.errors.items():
+            errors[kind] = errors.get(kind, 0) + count
+    received = sum(worker.bytes_received for worker in workers)
+    milliseconds = [latency * 1000 for latency in latencies]
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "requests": len(latencies),
+        "errors": errors,
+        "connections": sum(worker.connections for worker in workers),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else 0,
+        "throughput_mib_s": round(received / elapsed / (1 << 20), 3) if elapsed else 0,
+        "latency_ms": {
+            "mean": round(sum(milliseconds) / len(milliseconds), 3) if milliseconds else None,
+            **{f"p{point}": round(percentile(milliseconds, point), 3) if milliseconds else None
+               for point in (50, 90, 99, 99.9)},
+            "max": round(milliseconds[-1], 3) if milliseconds else None,
+        },
+    }
+
+
+def metric_deltas(before, after):
+    """Counter increases over the run, gauges as last seen"""
+    return {name: after[name] - before.get(name, 0) if name.endswith(("_total", "_sum", "_count")) else after[name]
+            for name in after if "_bucket" not in name}
+
+
+def run(options):
+    origin = None
+    if options.origin:
+        origin_host, _, origin_port = options.origin.partition(":")
+        origin_port = int(origin_port or 80)
+    else:
+        origin = start_origin()
+        origin_host, origin_port = origin.server_address[:2]
+    url = (f"http://{origin_host}:{origin_port}/bytes/{options.response_size}" if not options.request_size
+           else f"http://{origin_host}:{origin_port}/upload")
+    headers = {"Proxy-Authorization": "Basic " + base64.b64encode(options.auth.encode()).decode(),
+               "Connection": "keep-alive" if options.keep_alive else "close"}
+
+    standin = None
+    gui_pid = options.gui_pid
+    if options.verdict != "none":
+        standin = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--serve-verdicts", options.verdict,
+                                    "--gui-port", str(options.gui_port)], stdout=subprocess.PIPE, text=True)
+        standin.stdout.readline()  # "ready" once the channel is listening
+        gui_pid = standin.pid
+        # The proxy reconnects to the GUI channel on demand, give it a moment to find the stand-in
+        time.sleep(options.settle)
+    # Intercept starts enabled and held requests fail without a GUI, so always set it for the run
+    send_control(options, "INTERCEPT_ON" if standin else "INTERCEPT_OFF")
+
+    proxy_pid = options.proxy_pid or find_process("http_proxy")
+    sampler = MemorySampler({"proxy": proxy_pid, "gui": gui_pid})
+    try:
+        if options.warmup:
+            run_phase(options, url, headers, options.warmup)
+        metrics_before = scrape_metrics(options)
+        sampler.start()
+        workers, elapsed = run_phase(options, url, headers, options.duration, options.requests)
+        sampler.stop()
+        metrics_after = scrape_metrics(options)
+    finally:
+        if standin:
+            send_control(options, "INTERCEPT_OFF")
+            standin.kill()
+            standin.wait()
+        if origin:
+            origin.shutdown()
+
+    result = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "config": {
+            "concurrency": options.concurrency,
+            "duration_s": options.duration,
+            "requests": options.requests,
+            "warmup_s": options.warmup,
+            "keep_alive": options.keep_alive,
+            "response_size": options.response_size,
+            "request_size": options.request_size,
+            "verdict": options.verdict,
+            "origin": options.origin or "local",
+        },
+        "results": summarize(workers, elapsed),
+        "memory": sampler.report(),
+        "proxy_metrics": metric_deltas(metrics_before, metrics_after) if metrics_after else None,
+    }
+    return result
+
+
+def print_summary(result):
+    results = result["results"]
+    latency = results["latency_ms"]
+    print(f"{results['requests']} requests in {results['elapsed_s']} s over {results['connections']} connections: "
+          f"{results['throughput_rps']} req/s, {results['throughput_mib_s']} MiB/s")
+    if latency["mean"] is not None:
+        print(f"latency ms: mean {latency['mean']}  p50 {latency['p50']}  p90 {latency['p90']}  "
+              f"p99 {latency['p99']}  p99.9 {latency['p99.9']}  max {latency['max']}")
+    if results["errors"]:
+        print("errors: " + ", ".join(f"{kind} x{count}" for kind, count in results["errors"].items()))
+    for name, memory in result["memory"].items():
+        print(f"{name} (pid {memory['pid']}) rss KiB: start {memory['rss_start_kib']}  "
+              f"end {memory['rss_end_kib']}  peak {memory['rss_peak_kib']}")
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the HTTP proxy")
+    parser.add_argument("--proxy-host", default="127.0.0.1")
+    parser.add_argument("--proxy-port", type=int, default=8080)
+    parser.add_argument("--gui-port", type=int, default=9090, help="port the GUI stand-in listens on")
+    parser.add_argument("--control-port", type=int, default=9091)
+    parser.add_argument("--metrics-port", type=int, default=9093)
+    parser.add_argument("--auth", default="user:pass", help="proxy credentials as user:password")
+    parser.add_argument("--origin", help="host:port of an existing origin instead of the built-in one")
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("-d", "--duration", type=float, default=10.0, help="seconds of measured load")
+    parser.add_argument("-n", "--requests", type=int, help="stop after this many requests")
+    parser.add_argument("--warmup", type=float, default=1.0, help="seconds of unmeasured load first")
+    parser.add_argument("--response-size", type=int, default=1024, help="bytes per response body")
+    parser.add_argument("--request-size", type=int, default=0, help="POST this many bytes instead of a GET")
+    parser.add_argument("--no-keep-alive", dest="keep_alive", action="store_false",
+                        help="open a new client connection for every request")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--verdict", choices=("none", "forward", "drop"), default="none",
+                        help="run a GUI stand-in and intercept every request with this verdict")
+    parser.add_argument("--settle", type=float, default=0.5, help="seconds to wait after starting the stand-in")
+    parser.add_argument("--proxy-pid", type=int, help="pid to sample instead of the process named http_proxy")
+    parser.add_argument("--gui-pid", type=int, help="pid of a running gui.py to sample")
+    parser.add_argument("-o", "--output", help="write the results as JSON to this file")
+    parser.add_argument("--serve-verdicts", choices=("forward", "drop"), help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main():
+    options = parse_arguments()
+    if options.serve_verdicts:
+        serve_verdicts(options.serve_verdicts, options.gui_port)
+        return
+    result = run(options)
+    print_summary(result)
+    if options.output:
+        with open(options.output, "w") as output:
+            json.dump(result, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
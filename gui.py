@@ -1,34 +1,1868 @@
 import tkinter as tk
 from tkinter import ttk, scrolledtext
-import socket
+import asyncio
 import threading
 import datetime
+import time
 import queue
+import collections
 import os
 import json
-from tkinter import simpledialog, messagebox
+import struct
+import array
+import mmap
+import tempfile
+import re
+import fnmatch
+import itertools
+import urllib.parse
+import zlib
+import base64
+import secrets
+from tkinter import simpledialog, messagebox, filedialog
+
+try:
+    import brotli  # Optional, only needed to view br encoded bodies
+except ImportError:
+    brotli = None
+
+
+# Proxy <-> GUI channel framing, shared by both directions:
+#   magic "PX" | version u8 | type u8 | flags u16 | message id u32 | head length u32 | body length u32
+# followed by the head section (start line and headers) and the body section.
+FRAME_MAGIC = b"PX"
+FRAME_VERSION = 1
+FRAME_HEADER = struct.Struct("!2sBBHIII")
+FRAME_MAX_SECTION = 64 * 1024 * 1024
+
+FRAME_REQUEST = 1
+FRAME_RESPONSE = 2
+FRAME_FORWARD = 3
+FRAME_DROP = 4
+FRAME_EDIT = 5
+FRAME_DATA = 6  # More body bytes of a streamed message
+FRAME_TIMING = 7  # Phase timings of a finished exchange, "name value" lines
+
+FRAME_FLAG_HOLD = 0x0001  # Sender waits for a verdict on this frame
+FRAME_FLAG_PREVIEW = 0x0002  # Body is truncated, the full copy follows in DATA frames
+FRAME_FLAG_END = 0x0004  # Last DATA frame of a message
+FRAME_FLAG_CACHED = 0x0008  # Response was served from the proxy's response cache
+FRAME_FLAG_REVALIDATED = 0x0010  # Cached response was confirmed by the origin with a 304
+
+# Blocklist updates on the blocked domains port, the frame id carries the list version
+BLOCKLIST_ADD = 16
+BLOCKLIST_REMOVE = 17
+BLOCKLIST_REPLACE = 18
+BLOCKLIST_ACK = 19
+BLOCKLIST_RESYNC = 20  # The proxy missed a change and needs the whole list
+
+# Rewrite rule lists on the rewrite port, each one replaces the proxy's rules as a whole
+REWRITE_RULES = 21
+REWRITE_ACK = 22
+REWRITE_ERROR = 23  # The list was rejected, the body says why
+
+# Saved sessions: a file header, then one entry per exchange
+#   magic "PXS" | version u8
+#   meta length u32 | request head length u32 | request body length u64 | response head length u32 | response body length u64
+# followed by those sections in that order. meta is JSON (timestamp, cache, timing), an exchange
+# without a response has an empty response head. Bodies are kept as received, so an imported
+# session is read in place instead of being copied.
+SESSION_MAGIC = b"PXS"
+SESSION_VERSION = 1
+SESSION_HEADER = struct.Struct("!3sB")
+SESSION_ENTRY = struct.Struct("!IIQIQ")
+
+
+class FrameError(ValueError):
+    pass
+
+
+class Frame:
+    __slots__ = ("type", "flags", "id", "head", "body")
+
+    def __init__(self, frame_type, message_id, head=b"", body=b"", flags=0):
+        self.type = frame_type
+        self.flags = flags
+        self.id = message_id
+        self.head = head
+        self.body = body
+
+    def encode(self):
+        return encode_frame(self.type, self.id, self.head, self.body, self.flags)
+
+
+def encode_frame(frame_type, message_id, head=b"", body=b"", flags=0):
+    header = FRAME_HEADER.pack(FRAME_MAGIC, FRAME_VERSION, frame_type, flags,
+                               message_id, len(head), len(body))
+    return header + head + body
+
+
+def decode_frame_header(header):
+    """Validate a frame header, returns (type, flags, id, head length, body length)"""
+    magic, version, frame_type, flags, message_id, head_length, body_length = FRAME_HEADER.unpack(header)
+    if magic != FRAME_MAGIC or version != FRAME_VERSION:
+        raise FrameError(f"Unsupported frame (magic {magic!r}, version {version})")
+    if head_length > FRAME_MAX_SECTION or body_length > FRAME_MAX_SECTION:
+        raise FrameError("Frame section too large")
+    return frame_type, flags, message_id, head_length, body_length
+
+
+async def read_frame(reader):
+    """Read one frame from an asyncio stream, raises IncompleteReadError at EOF"""
+    frame_type, flags, message_id, head_length, body_length = decode_frame_header(
+        await reader.readexactly(FRAME_HEADER.size))
+    head = await reader.readexactly(head_length)
+    body = await reader.readexactly(body_length)
+    return Frame(frame_type, message_id, head, body, flags)
+
+
+class ProxyConnection:
+    """Persistent connection from the proxy, carrying many framed messages"""
+
+    def __init__(self, loop, reader, writer):
+        self.loop = loop
+        self.reader = reader
+        self.writer = writer
+
+    def send_frame(self, frame_type, message_id, head=b"", body=b""):
+        """Queue a frame for the proxy without blocking the calling thread"""
+        self.loop.call_soon_threadsafe(self.writer.write, encode_frame(frame_type, message_id, head, body))
+
+    def send_frames(self, frames):
+        """Queue several (type, id, head, body) frames with a single wakeup of the loop"""
+        data = b"".join(encode_frame(*frame) for frame in frames)
+        self.loop.call_soon_threadsafe(self.writer.write, data)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.writer.close)
+
+
+class GuiChannelServer:
+    """
+    Asyncio server that reads framed messages from the proxy.
+
+    Frame bodies are written to the spool on the loop thread, so events carry
+    (frame, body reference, connection). Held messages go through the rule
+    engine first, so only the ones it leaves undecided wait for the user. DATA frames of a streamed body are
+    collected here and delivered as one event when the last one arrives.
+    """
+
+    def __init__(self, events, spool, rules=None, host='127.0.0.1', port=9090):
+        self.events = events
+        self.spool = spool
+        self.rules = rules
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.server = None
+
+    def start(self):
+        # Bind synchronously so a busy port is reported to the caller
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle_connection, self.host, self.port, backlog=128))
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def stop(self):
+        if self.server:
+            self.loop.call_soon_threadsafe(self.server.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def handle_connection(self, reader, writer):
+        connection = ProxyConnection(self.loop, reader, writer)
+        streams = {}  # Message id -> spool references of a body still arriving
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if self.rules and frame.type in (FRAME_REQUEST, FRAME_RESPONSE):
+                    frame = self.rules.apply(frame, connection)
+                if frame.type == FRAME_TIMING:
+                    # Small text body, handed over as is instead of spooled
+                    self.events.put((frame, (0, 0), connection))
+                    continue
+                body = self.spool.append(frame.body)
+                if frame.type == FRAME_DATA:
+                    chunks = streams.setdefault(frame.id, [])
+                    if body[1]:
+                        chunks.append(body)
+                    if frame.flags & FRAME_FLAG_END:
+                        self.events.put((frame, self.spool.join(streams.pop(frame.id)), connection))
+                    continue
+                self.events.put((frame, body, connection))
+        except asyncio.IncompleteReadError:
+            pass
+        except (FrameError, ConnectionError) as e:
+            print(f"Failed to read message from proxy: {e}")
+        writer.close()
+
+
+def parse_metrics(text):
+    """Parse Prometheus text format into {name or name{labels}: value}"""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, _, value = line.rpartition(" ")
+        try:
+            samples[name] = float(value)
+        except ValueError:
+            pass
+    return samples
+
+
+class ControlClient:
+    """
+    Control traffic to the proxy: intercept commands, statistics, blocklist and
+    rewrite rule updates. The coroutines run on the GUI channel's event loop and submit()
+    returns a concurrent.futures.Future, so the Tk thread never waits on the
+    network.
+    """
+    TIMEOUT = 5.0
+
+    def __init__(self, loop, host='127.0.0.1', control_port=9091, blocklist_port=9092, metrics_port=9093,
+                 rewrite_port=9094):
+        self.loop = loop
+        self.host = host
+        self.control_port = control_port
+        self.blocklist_port = blocklist_port
+        self.metrics_port = metrics_port
+        self.rewrite_port = rewrite_port
+        self.update_lock = None  # Created on the loop, keeps updates in submission order
+
+    def submit(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def query(self, command):
+        """Send a command to the proxy control port and return its reply"""
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.control_port), self.TIMEOUT)
+        try:
+            writer.write(command.encode())
+            await writer.drain()
+            reply = await asyncio.wait_for(reader.read(), self.TIMEOUT)
+        finally:
+            writer.close()
+        return reply.decode(errors="replace")
+
+    async def fetch_metrics(self):
+        """Scrape the proxy's metrics endpoint, returns the parsed samples"""
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.metrics_port), self.TIMEOUT)
+        try:
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+            reply = await asyncio.wait_for(reader.read(), self.TIMEOUT)
+        finally:
+            writer.close()
+        _, _, body = reply.partition(b"\r\n\r\n")
+        return parse_metrics(body.decode(errors="replace"))
+
+    async def send_update(self, port, frame_type, message_id, body):
+        """Send one update frame and return the proxy's reply frame"""
+        if self.update_lock is None:
+            self.update_lock = asyncio.Lock()
+        async with self.update_lock:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, port), self.TIMEOUT)
+            try:
+                writer.write(encode_frame(frame_type, message_id, body=body))
+                await writer.drain()
+                return await asyncio.wait_for(read_frame(reader), self.TIMEOUT)
+            finally:
+                writer.close()
+
+    async def update_blocklist(self, operation, version, body):
+        """Send one blocklist update frame, returns the type of the proxy's reply"""
+        return (await self.send_update(self.blocklist_port, operation, version, body)).type
+
+    async def update_rewrite_rules(self, version, body):
+        """Replace the proxy's rewrite rules, returns (reply type, reason of a rejection)"""
+        reply = await self.send_update(self.rewrite_port, REWRITE_RULES, version, body)
+        return reply.type, reply.body.decode(errors="replace")
+
+
+class BodySpool:
+    """
+    Append-only file holding raw message bodies, read back through a memory map.
+
+    append() returns an (offset, length) reference that is all the rest of the
+    GUI keeps; read() slices the bytes back out exactly as they were received.
+    Other files, such as imported sessions, can be attached to be read in place:
+    their references start at a multiple of 1 << ATTACH_SHIFT.
+    """
+    ATTACH_SHIFT = 48
+
+    def __init__(self, path=None):
+        self.temporary = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix="proxy-spool-", suffix=".bin")
+            os.close(fd)
+        self.path = path
+        self.file = open(path, "ab", buffering=0)
+        self.size = self.file.tell()
+        self.map = None
+        self.attached = []  # Memory maps of attached files, in attach order
+        self.lock = threading.Lock()
+
+    def attach(self, path):
+        """Make an existing file readable through references; returns the reference offset of its first byte"""
+        with open(path, "rb") as f:
+            attached = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with self.lock:
+            self.attached.append(attached)
+            return len(self.attached) << self.ATTACH_SHIFT
+
+    def append(self, data):
+        if not data:
+            return (0, 0)
+        with self.lock:
+            offset = self.size
+            self.file.write(data)
+            self.size += len(data)
+        return (offset, len(data))
+
+    def join(self, references):
+        """Return one reference covering several, copying them together if they are not adjacent"""
+        if not references:
+            return (0, 0)
+        offset = references[0][0]
+        end = offset
+        for chunk_offset, chunk_length in references:
+            if chunk_offset != end:
+                break
+            end += chunk_length
+        else:
+            return (offset, end - offset)
+
+        with self.lock:
+            start = self.size
+        for reference in references:
+            self.append(self.read(*reference))
+        with self.lock:
+            return (start, self.size - start)
+
+    def read(self, offset, length, limit=None):
+        """Return the bytes of a reference, at most limit of them"""
+        if limit is not None:
+            length = min(length, limit)
+        if length <= 0:
+            return b""
+        if offset >> self.ATTACH_SHIFT:
+            attached = self.attached[(offset >> self.ATTACH_SHIFT) - 1]
+            offset &= (1 << self.ATTACH_SHIFT) - 1
+            return attached[offset:offset + length]
+        with self.lock:
+            # Remap when the reference lies past the end of the current mapping
+            if self.map is None or offset + length > len(self.map):
+                if self.map is not None:
+                    self.map.close()
+                with open(self.path, "rb") as f:
+                    self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.map[offset:offset + length]
+
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+            for attached in self.attached:
+                attached.close()
+            self.attached.clear()
+            self.file.close()
+            if self.temporary:
+                try:
+                    os.remove(self.path)
+                except OSError:
+                    pass
+
+
+class BodyDecodeError(ValueError):
+    pass
+
+
+class BodyDecoder:
+    """
+    Display-only view of spooled bodies with their transfer and content codings undone.
+
+    The spool and the proxy keep the bytes exactly as they travel, decoding
+    happens only when a body is opened. Chunked framing is removed and gzip,
+    deflate and br (with the brotli module) are inflated piece by piece,
+    stopping at limit decoded bytes. Recent views are cached by body reference.
+    """
+    PIECE_SIZE = 64 * 1024
+    CACHE_BYTES = 16 * 1024 * 1024
+
+    def __init__(self, spool, limit, max_cache_bytes=CACHE_BYTES):
+        self.spool = spool
+        self.limit = limit
+        self.cache = collections.OrderedDict()  # Body reference -> (data, note)
+        self.cache_bytes = 0
+        self.max_cache_bytes = max_cache_bytes
+
+    @staticmethod
+    def codings(head):
+        """Return (chunked, content codings in the order they were applied) of a message head"""
+        _, headers = parse_message_head(head)
+        chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+        encodings = [coding.strip().lower() for coding in headers.get("content-encoding", "").split(",")]
+        return chunked, [coding for coding in encodings if coding and coding != "identity"]
+
+    @classmethod
+    def needs_decoding(cls, head):
+        chunked, encodings = cls.codings(head)
+        return chunked or bool(encodings)
+
+    def decode(self, head, body):
+        """Return (decoded bytes, note for the reader or None) of a spooled body"""
+        cached = self.cache.get(body)
+        if cached is not None:
+            self.cache.move_to_end(body)
+            return cached
+
+        chunked, encodings = self.codings(head)
+        offset, length = body
+        pieces = (self.spool.read(offset + start, min(self.PIECE_SIZE, length - start))
+                  for start in range(0, length, self.PIECE_SIZE))
+        try:
+            if chunked:
+                pieces = self.dechunk(pieces)
+            for coding in reversed(encodings):
+                pieces = self.decoder_for(coding)(pieces)
+            data, truncated = self.collect(pieces)
+        except (BodyDecodeError, zlib.error) as e:
+            data = self.spool.read(offset, length, self.limit)
+            note = f"[Could not decode {' + '.join(encodings) or 'chunked'} body, showing raw bytes: {e}]"
+        else:
+            applied = ", ".join((["chunked"] if chunked else []) + encodings)
+            note = f"[Decoded {applied}: {length} bytes on the wire, " + (
+                f"view stops at {self.limit} decoded bytes]" if truncated else f"{len(data)} decoded]")
+
+        self.cache[body] = (data, note)
+        self.cache_bytes += len(data)
+        while self.cache_bytes > self.max_cache_bytes and len(self.cache) > 1:
+            old_data, _ = self.cache.popitem(last=False)[1]
+            self.cache_bytes -= len(old_data)
+        return data, note
+
+    def collect(self, pieces):
+        """Join decoded pieces up to the limit, returns (data, whether more was left)"""
+        collected = []
+        size = 0
+        for piece in pieces:
+            collected.append(piece)
+            size += len(piece)
+            if size > self.limit:
+                return b"".join(collected)[:self.limit], True
+        return b"".join(collected), False
+
+    def decoder_for(self, coding):
+        if coding in ("gzip", "x-gzip"):
+            return lambda pieces: self.inflate(pieces, 16 + zlib.MAX_WBITS)
+        if coding == "deflate":
+            return self.inflate_deflate
+        if coding == "br":
+            if brotli is None:
+                raise BodyDecodeError("install the brotli module to view br bodies")
+            return self.unbrotli
+        raise BodyDecodeError(f"unsupported content coding {coding!r}")
+
+    def inflate(self, pieces, wbits):
+        decompressor = zlib.decompressobj(wbits)
+        for piece in pieces:
+            # Bounded output per call, so a small bomb cannot blow past the limit in one go
+            while piece and not decompressor.eof:
+                output = decompressor.decompress(piece, self.PIECE_SIZE)
+                if output:
+                    yield output
+                piece = decompressor.unconsumed_tail
+            if decompressor.eof:
+                return
+        yield decompressor.flush()
+
+    def inflate_deflate(self, pieces):
+        # "deflate" should be zlib wrapped, but some servers send a raw stream
+        pieces = iter(pieces)
+        first = next(pieces, b"")
+        wrapped = len(first) >= 2 and first[0] & 0x0F == 8 and (first[0] << 8 | first[1]) % 31 == 0
+        return self.inflate(itertools.chain([first], pieces), zlib.MAX_WBITS if wrapped else -zlib.MAX_WBITS)
+
+    def unbrotli(self, pieces):
+        decompressor = brotli.Decompressor()
+        for piece in pieces:
+            try:
+                output = decompressor.process(piece)
+            except brotli.error as e:
+                raise BodyDecodeError(str(e)) from e
+            if output:
+                yield output
+
+    @staticmethod
+    def dechunk(pieces):
+        """Yield the payload of a chunked body, stopping at the last chunk"""
+        buffer = b""
+        remaining = 0  # Payload bytes left in the current chunk
+        for piece in pieces:
+            buffer += piece
+            while buffer:
+                if remaining > 0:
+                    data = buffer[:remaining]
+                    buffer = buffer[len(data):]
+                    remaining -= len(data)
+                    yield data
+                    if remaining:
+                        break
+                    remaining = -2  # The CRLF after the chunk data
+                if remaining < 0:
+                    if len(buffer) < 2:
+                        break
+                    buffer = buffer[2:]
+                    remaining = 0
+                line_end = buffer.find(b"\r\n")
+                if line_end < 0:
+                    if len(buffer) > 1024:
+                        raise BodyDecodeError("chunk size line too long")
+                    break
+                try:
+                    remaining = int(buffer[:line_end].split(b";")[0], 16)
+                except ValueError:
+                    raise BodyDecodeError("bad chunk size") from None
+                buffer = buffer[line_end + 2:]
+                if remaining == 0:
+                    return
+
+    @staticmethod
+    def decoded_head(head, length):
+        """Rewrite a head for a plain body of length bytes, dropping the codings"""
+        lines = [line for line in head.split("\r\n")
+                 if line.split(":", 1)[0].strip().lower() not in ("content-encoding", "transfer-encoding", "content-length")]
+        while lines and not lines[-1]:
+            lines.pop()
+        lines.append(f"Content-Length: {length}")
+        return "\r\n".join(lines)
+
+
+def parse_message_head(head):
+    """Return (start line parts, headers dict with lower-case names) of a message head"""
+    lines = head.splitlines()
+    parts = lines[0].strip().split(' ', 2) if lines else []
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(":")
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return parts, headers
+
+
+def request_summary(parts, headers):
+    """Return (method, host, path) of a request from its parsed head"""
+    method = parts[0].upper() if parts else ""
+    url = urllib.parse.urlsplit(parts[1] if len(parts) > 1 else "")
+    host = (url.hostname or headers.get("host", "").split(":")[0]).lower()
+    path = (url.path or "/") + (f"?{url.query}" if url.query else "")
+    return method, host, path
+
+
+RULE_ACTIONS = ("forward", "drop", "hold", "rewrite")
+RULE_TARGETS = ("requests", "responses", "both")
+
+
+class Rule:
+    """A rule compiled from its saved form, see RuleEngine.compile_rule"""
+    __slots__ = ("name", "targets", "method", "host", "path", "header_name", "header",
+                 "content_type", "action", "find", "replace", "find_bytes", "replace_bytes")
+
+
+class RuleEngine:
+    """
+    Decides held messages on the GUI channel's loop thread, before they are queued.
+
+    Rules are compiled once whenever they change and evaluated in order, the
+    first match wins. set_rules() swaps the compiled tuple in whole, so the
+    loop thread never sees a half-updated rule set.
+    """
+    REQUEST_MEMORY = 10000  # Request summaries kept to match their responses
+
+    def __init__(self):
+        self.state = ((), "hold")  # (compiled rules, action for unmatched messages)
+        self.requests = collections.OrderedDict()  # Message id -> (method, host, path), loop thread only
+
+    def set_rules(self, specs, default_action="hold"):
+        """Compile rule specs, raises ValueError or re.error for an invalid one"""
+        rules = tuple(self.compile_rule(spec) for spec in specs if spec.get("enabled", True))
+        self.state = (rules, default_action)
+
+    @staticmethod
+    def compile_rule(spec):
+        rule = Rule()
+        rule.name = spec.get("name", "")
+        rule.targets = spec.get("applies_to", "requests")
+        rule.action = spec.get("action", "hold")
+        if rule.targets not in RULE_TARGETS or rule.action not in RULE_ACTIONS:
+            raise ValueError(f"Invalid rule {rule.name!r}")
+
+        rule.method = spec.get("method", "").strip().upper() or None
+        host = spec.get("host", "").strip().lower()
+        rule.host = re.compile(fnmatch.translate(host)) if host else None
+        path = spec.get("path", "")
+        rule.path = re.compile(path) if path else None
+
+        # "Name: regex" matches a header value, "Name" alone its presence
+        header_name, _, header = spec.get("header", "").partition(":")
+        rule.header_name = header_name.strip().lower() or None
+        rule.header = re.compile(header.strip(), re.IGNORECASE) if header.strip() else None
+        rule.content_type = spec.get("content_type", "").strip().lower() or None
+
+        rule.find = rule.replace = rule.find_bytes = rule.replace_bytes = None
+        if rule.action == "rewrite":
+            if not spec.get("find"):
+                raise ValueError(f"Rewrite rule {rule.name!r} needs a pattern")
+            rule.find = re.compile(spec["find"])
+            rule.replace = spec.get("replace", "")
+            rule.find_bytes = re.compile(spec["find"].encode())
+            rule.replace_bytes = rule.replace.encode()
+        return rule
+
+    def remember_request(self, message_id, method, host, path):
+        self.requests[message_id] = (method, host, path)
+        if len(self.requests) > self.REQUEST_MEMORY:
+            self.requests.popitem(last=False)
+
+    def match(self, rule, is_request, method, host, path, headers):
+        if rule.targets != "both" and rule.targets != ("requests" if is_request else "responses"):
+            return False
+        if rule.method and rule.method != method:
+            return False
+        if rule.host and not rule.host.match(host):
+            return False
+        if rule.path and not rule.path.search(path):
+            return False
+        if rule.header_name:
+            value = headers.get(rule.header_name)
+            if value is None or (rule.header and not rule.header.search(value)):
+                return False
+        if rule.content_type and rule.content_type not in headers.get("content-type", "").lower():
+            return False
+        return True
+
+    def apply(self, frame, connection):
+        """
+        Send the verdict for a held frame if a rule decides it.
+
+        Decided frames lose FRAME_FLAG_HOLD, so the GUI only records them; a
+        rewritten frame carries what was sent to the proxy.
+        """
+        head = frame.head.decode(errors="replace")
+        parts, headers = parse_message_head(head)
+        is_request = frame.type == FRAME_REQUEST
+
+        if is_request:
+            method, host, path = request_summary(parts, headers)
+            self.remember_request(frame.id, method, host, path)
+        else:
+            method, host, path = self.requests.pop(frame.id, ("", "", ""))
+
+        rules, default_action = self.state
+        if not frame.flags & FRAME_FLAG_HOLD or not rules and default_action == "hold":
+            return frame
+        rule = next((rule for rule in rules if self.match(rule, is_request, method, host, path, headers)), None)
+        action = rule.action if rule else default_action
+
+        if action == "forward":
+            connection.send_frame(FRAME_FORWARD, frame.id)
+        elif action == "drop":
+            connection.send_frame(FRAME_DROP, frame.id)
+        elif action == "rewrite":
+            frame.head, frame.body = self.rewrite(rule, head, headers, frame.body)
+            connection.send_frame(FRAME_EDIT, frame.id, frame.head, frame.body)
+        else:
+            return frame
+        frame.flags &= ~FRAME_FLAG_HOLD
+        return frame
+
+    @staticmethod
+    def rewrite(rule, head, headers, body):
+        """Apply a rewrite rule to the head and, when it is plain, to the body"""
+        head = rule.find.sub(rule.replace, head)
+        if body and "content-encoding" not in headers and "chunked" not in headers.get("transfer-encoding", "").lower():
+            new_body = rule.find_bytes.sub(rule.replace_bytes, body)
+            if len(new_body) != len(body):
+                head = re.sub(r"(?im)^(content-length:\s*)\d+", lambda m: f"{m.group(1)}{len(new_body)}", head)
+            body = new_body
+        return head.encode(), body
+
+
+REWRITE_ACTIONS = ("header-add", "header-set", "header-remove", "body-replace", "body-regex")
+REWRITE_DIRECTIONS = ("request", "response", "both")
+REWRITE_FIELDS = ("host", "content_type", "find", "replace")  # In the order of the proxy's rule lines
+
+
+def encode_rewrite_rules(specs):
+    """
+    Encode the enabled rewrite rule specs as the proxy's rule list, raises
+    ValueError for an invalid one.
+
+    Each rule is a line of tab separated fields: action, direction, host glob,
+    content type, find (a header name, literal or POSIX extended regex) and
+    replace. Backslashes, tabs and line breaks in the fields are escaped.
+    Patterns are compiled by the proxy, which reports the line of a bad one.
+    """
+    lines = []
+    for spec in specs:
+        if not spec.get("enabled", True):
+            continue
+        name = spec.get("name", "")
+        action = spec.get("action")
+        if action not in REWRITE_ACTIONS or spec.get("direction") not in REWRITE_DIRECTIONS:
+            raise ValueError(f"Invalid rewrite rule {name!r}")
+        if not spec.get("find"):
+            raise ValueError(f"Rewrite rule {name!r} needs a "
+                             f"{'header name' if action.startswith('header') else 'pattern'}")
+        fields = [spec.get(field, "").replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+                  .replace("\r", "\\r") for field in REWRITE_FIELDS]
+        lines.append("\t".join([action, spec["direction"]] + fields))
+    return "\n".join(lines).encode()
+
+
+class HistoryRecord:
+    """One exchange in the history, paired by the proxy's message id"""
+    __slots__ = ("id", "message_id", "timestamp", "method", "url", "protocol", "host",
+                 "headers", "body", "status", "response_headers", "response_body", "size", "timing", "cache")
+
+    def __init__(self, entry_id, message_id, timestamp, method, url, protocol, host):
+        self.id = entry_id
+        self.message_id = message_id
+        self.timestamp = timestamp
+        self.method = method
+        self.url = url
+        self.protocol = protocol
+        self.host = host
+        self.headers = ""
+        self.body = (0, 0)  # Spool reference
+        self.status = ""
+        self.response_headers = None
+        self.response_body = (0, 0)
+        self.size = 0
+        self.timing = None  # Phase name -> milliseconds, once the exchange finished
+        self.cache = ""  # "hit" or "revalidated" when the proxy answered from its cache
+
+
+class HistoryStore:
+    """
+    Bounded history with O(1) lookup by entry id and by the proxy's message id.
+
+    Entries are evicted once max_entries or max_bytes is exceeded, oldest first
+    ("fifo") or least recently viewed first ("lru"). Bodies stay in the spool,
+    records only hold (offset, length) references to them.
+    """
+    RECORD_OVERHEAD = 256  # Rough per-entry cost of the record and index slots
+
+    def __init__(self, max_entries=5000, max_bytes=64 * 1024 * 1024, eviction="fifo"):
+        if eviction not in ("fifo", "lru"):
+            raise ValueError(f"Unknown eviction policy: {eviction}")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.entries = collections.OrderedDict()
+        self.by_message_id = {}  # Exchanges still waiting for their response or timings
+        self.total_bytes = 0
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries.values())
+
+    def get(self, entry_id):
+        record = self.entries.get(entry_id)
+        if record is not None and self.eviction == "lru":
+            self.entries.move_to_end(entry_id)
+        return record
+
+    def add_request(self, message_id, head, body):
+        """Record a request with its spooled body; returns the new record and the records evicted to make room"""
+        record = self._new_record(message_id, head, body, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        self._account(record)
+
+        self.entries[record.id] = record
+        self.by_message_id[message_id] = record.id
+        return record, self._evict()
+
+    def restore(self, head, body, response_head=None, response_body=(0, 0), timestamp=None, cache="", timing=None):
+        """Record a finished exchange from a saved session; returns the new record and the records evicted"""
+        record = self._new_record(None, head, body, timestamp or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        if response_head is not None:
+            self._set_response(record, response_head, response_body, cache)
+        record.timing = timing
+        self._account(record)
+
+        self.entries[record.id] = record
+        return record, self._evict()
+
+    def add_response(self, message_id, head, body, cache=""):
+        """
+        Attach a response to its request; returns (record or None, evicted records).
+        A streamed response only has a preview body until complete_response().
+        """
+        record = self.entries.get(self.by_message_id.get(message_id))
+        if record is None:
+            return None, []
+
+        self.total_bytes -= record.size
+        self._set_response(record, head, body, cache)
+        self._account(record)
+        return record, self._evict()
+
+    def complete_response(self, message_id, body):
+        """Replace the preview of a streamed response with its full body"""
+        record = self.entries.get(self.by_message_id.get(message_id))
+        if record is not None:
+            record.response_body = body
+        return record
+
+    def set_timing(self, message_id, timing):
+        """Attach the phase timings sent once the exchange finished, the last thing it receives"""
+        record = self.entries.get(self.by_message_id.pop(message_id, None))
+        if record is not None:
+            record.timing = timing
+        return record
+
+    def _new_record(self, message_id, head, body, timestamp):
+        parts, headers = parse_message_head(head)
+        self.next_id += 1
+        record = HistoryRecord(
+            self.next_id, message_id, timestamp,
+            parts[0] if len(parts) > 0 else "UNKNOWN",
+            parts[1] if len(parts) > 1 else "UNKNOWN",
+            parts[2] if len(parts) > 2 else "HTTP",
+            headers.get("host", "UNKNOWN"))
+        record.headers = head
+        record.body = body
+        return record
+
+    @staticmethod
+    def _set_response(record, head, body, cache):
+        parts, _ = parse_message_head(head)
+        record.status = parts[1] if len(parts) > 1 else ""
+        record.response_headers = head
+        record.response_body = body
+        record.cache = cache
+
+    def _account(self, record):
+        record.size = self.RECORD_OVERHEAD + len(record.headers) + len(record.response_headers or "")
+        self.total_bytes += record.size
+
+    def _evict(self):
+        evicted = []
+        while self.entries and (len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            _, record = self.entries.popitem(last=False)
+            self.total_bytes -= record.size
+            if self.by_message_id.get(record.message_id) == record.id:
+                del self.by_message_id[record.message_id]
+            evicted.append(record)
+        return evicted
+
+
+class HistoryIndex:
+    """
+    Inverted index over the history, behind the search box of the History tab.
+
+    Records are indexed as "field:token" terms as their request, response and
+    body arrive. A term keeps its entry ids in an array until it is common
+    enough to switch to bitmaps, one int per block of ids, so even a query
+    matching most of the history is a few big-int ANDs per block. A query is a
+    list of words, "field:value" for one field or a bare value for any field,
+    and matches the entries holding every token. Removed entries are masked out
+    by the live bitmap and purged once they hold half of the postings.
+    """
+    FIELDS = ("method", "host", "path", "status", "header", "value", "body")
+    TOKEN = re.compile(r"\w+")
+    MAX_TOKEN_LENGTH = 40  # Longer runs are mostly encoded blobs nobody searches for
+    BODY_LIMIT = 64 * 1024  # Decoded bytes of a body that are indexed
+    MAX_BODY_TERMS = 2000  # Distinct body tokens indexed per body
+    TEXT_TYPES = ("text/", "json", "xml", "javascript", "x-www-form-urlencoded")
+    BLOCK_BITS = 12  # Entry ids per bitmap block, as a power of two
+    DENSE_AT = 128  # Ids after which a term switches from an array to bitmaps
+    COMPACT_MIN = 100000  # Dead postings tolerated before purging, whatever the ratio
+
+    def __init__(self):
+        self.postings = {}  # Term -> array of entry ids, or block number -> bitmap
+        self.live = {}  # Indexed entry id -> number of postings it holds
+        self.live_bits = {}  # Block number -> bitmap of the indexed entry ids
+        self.total = 0
+        self.dead = 0
+
+    def __len__(self):
+        return len(self.live)
+
+    @classmethod
+    def tokens(cls, text, limit=None):
+        """Return the distinct lower-case tokens of text in order of appearance, at most limit of them"""
+        tokens = {}
+        for match in cls.TOKEN.finditer(text.lower()):
+            token = match.group()
+            if len(token) <= cls.MAX_TOKEN_LENGTH:
+                tokens[token] = None
+                if limit is not None and len(tokens) >= limit:
+                    break
+        return tokens
+
+    @classmethod
+    def indexes_body(cls, head):
+        """Whether the body of a message is text worth indexing, judging by its Content-Type"""
+        _, headers = parse_message_head(head)
+        content_type = headers.get("content-type", "").lower()
+        return not content_type or any(kind in content_type for kind in cls.TEXT_TYPES)
+
+    @classmethod
+    def bitmap(cls, ids):
+        blocks = {}
+        for entry_id in ids:
+            block = entry_id >> cls.BLOCK_BITS
+            blocks[block] = blocks.get(block, 0) | 1 << (entry_id & ((1 << cls.BLOCK_BITS) - 1))
+        return blocks
+
+    @classmethod
+    def ids(cls, matches, after=0):
+        """Yield the entry ids of a bitmap greater than after, in ascending order"""
+        for block in sorted(matches):
+            base = block << cls.BLOCK_BITS
+            if base + (1 << cls.BLOCK_BITS) <= after:
+                continue
+            bits = matches[block]
+            if after >= base:
+                bits &= -1 << (after - base + 1)
+            while bits:
+                low = bits & -bits
+                yield base + low.bit_length() - 1
+                bits ^= low
+
+    @staticmethod
+    def count(matches):
+        return sum(bin(bits).count("1") for bits in matches.values())
+
+    def add_request(self, record):
+        parts, headers = parse_message_head(record.headers)
+        method, host, path = request_summary(parts, headers)
+        terms = {f"method:{method.lower()}"}
+        terms.update(f"host:{token}" for token in self.tokens(host))
+        terms.update(f"path:{token}" for token in self.tokens(path))
+        self._add(record.id, self._header_terms(terms, headers))
+
+    def add_response(self, record):
+        _, headers = parse_message_head(record.response_headers or "")
+        terms = set()
+        if record.status:
+            status = record.status.lower()
+            terms.update((f"status:{status}", f"status:{status[0]}xx"))
+        self._add(record.id, self._header_terms(terms, headers))
+
+    def add_body(self, entry_id, text):
+        self._add(entry_id, {f"body:{token}" for token in self.tokens(text, self.MAX_BODY_TERMS)})
+
+    def remove(self, entry_id):
+        count = self.live.pop(entry_id, None)
+        if count is None:
+            return
+        block = entry_id >> self.BLOCK_BITS
+        bits = self.live_bits[block] & ~(1 << (entry_id & ((1 << self.BLOCK_BITS) - 1)))
+        if bits:
+            self.live_bits[block] = bits
+        else:
+            del self.live_bits[block]
+        self.dead += count
+        if self.dead > self.COMPACT_MIN and self.dead * 2 > self.total:
+            self.compact()
+
+    def compact(self):
+        """Drop the postings of removed entries, and the terms left without any"""
+        live, live_bits = self.live, self.live_bits
+        for term, ids in list(self.postings.items()):
+            if type(ids) is dict:
+                kept = {}
+                for block, bits in ids.items():
+                    bits &= live_bits.get(block, 0)
+                    if bits:
+                        kept[block] = bits
+            else:
+                kept = array.array("I", filter(live.__contains__, ids))
+            if kept:
+                self.postings[term] = kept
+            else:
+                del self.postings[term]
+        self.total -= self.dead
+        self.dead = 0
+
+    def parse_query(self, query):
+        """Return the conditions of a query as (fields, token) pairs, every one of which must match"""
+        conditions = []
+        for word in query.split():
+            field, sep, value = word.partition(":")
+            if sep and field.lower() in self.FIELDS:
+                fields = (field.lower(),)
+            else:
+                fields, value = self.FIELDS, word
+            conditions.extend((fields, token) for token in self.tokens(value))
+        return conditions
+
+    def search(self, query):
+        """Return the bitmap (block number -> int) of the entries matching query, or None for an empty query"""
+        conditions = self.parse_query(query)
+        if not conditions:
+            return None
+        matches = self.live_bits
+        for fields, token in conditions:
+            # A condition holds in any of its fields
+            condition = {}
+            for term in (f"{field}:{token}" for field in fields):
+                ids = self.postings.get(term)
+                if ids is None:
+                    continue
+                for block, bits in (ids if type(ids) is dict else self.bitmap(ids)).items():
+                    condition[block] = condition.get(block, 0) | bits
+            matches = {block: bits for block, bits in
+                       ((block, bits & condition.get(block, 0)) for block, bits in matches.items()) if bits}
+            if not matches:
+                break
+        return matches
+
+    @classmethod
+    def _header_terms(cls, terms, headers):
+        for name, value in headers.items():
+            terms.update(f"header:{token}" for token in cls.tokens(name))
+            terms.update(f"value:{token}" for token in cls.tokens(value))
+        return terms
+
+    def _add(self, entry_id, terms):
+        block = entry_id >> self.BLOCK_BITS
+        bit = 1 << (entry_id & ((1 << self.BLOCK_BITS) - 1))
+        postings = self.postings
+        for term in terms:
+            ids = postings.get(term)
+            if ids is None:
+                postings[term] = array.array("I", (entry_id,))
+            elif type(ids) is dict:
+                ids[block] = ids.get(block, 0) | bit
+            else:
+                ids.append(entry_id)
+                if len(ids) > self.DENSE_AT:
+                    postings[term] = self.bitmap(ids)
+        self.live[entry_id] = self.live.get(entry_id, 0) + len(terms)
+        self.live_bits[block] = self.live_bits.get(block, 0) | bit
+        self.total += len(terms)
+
+
+class SessionError(ValueError):
+    """A session file is not one this GUI wrote, or it is cut short"""
+
+
+class SessionWriter:
+    """Streams history records into a session file, bodies copied out of the spool piece by piece"""
+    PIECE_SIZE = 1024 * 1024
+
+    def __init__(self, path, spool):
+        self.spool = spool
+        self.file = open(path, "wb")
+        self.file.write(SESSION_HEADER.pack(SESSION_MAGIC, SESSION_VERSION))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, record):
+        meta = json.dumps({"timestamp": record.timestamp, "cache": record.cache, "timing": record.timing}).encode()
+        head = record.headers.encode()
+        response_head = (record.response_headers or "").encode()
+        self.file.write(SESSION_ENTRY.pack(len(meta), len(head), record.body[1],
+                                           len(response_head), record.response_body[1]))
+        self.file.write(meta)
+        self.file.write(head)
+        self.copy_body(record.body)
+        self.file.write(response_head)
+        self.copy_body(record.response_body)
+
+    def copy_body(self, body):
+        offset, length = body
+        for start in range(0, length, self.PIECE_SIZE):
+            self.file.write(self.spool.read(offset + start, min(self.PIECE_SIZE, length - start)))
+
+    def close(self):
+        self.file.close()
+
+
+class SessionReader:
+    """
+    Reads the entries of a session file without their bodies.
+
+    Iterating yields (meta, request head, request body, response head or None,
+    response body) per entry, the bodies as (offset, length) within the file,
+    which is only read up to the heads of each entry.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        header = self.file.read(SESSION_HEADER.size)
+        if len(header) < SESSION_HEADER.size or SESSION_HEADER.unpack(header)[0] != SESSION_MAGIC:
+            self.file.close()
+            raise SessionError("not a session file")
+        version = SESSION_HEADER.unpack(header)[1]
+        if version != SESSION_VERSION:
+            self.file.close()
+            raise SessionError(f"unsupported session version {version}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+
+    def __iter__(self):
+        while True:
+            header = self.file.read(SESSION_ENTRY.size)
+            if not header:
+                return
+            if len(header) < SESSION_ENTRY.size:
+                raise SessionError("truncated entry")
+            meta_length, head_length, body_length, response_head_length, response_body_length = \
+                SESSION_ENTRY.unpack(header)
+            meta = json.loads(self.read_exact(meta_length))
+            if not isinstance(meta, dict):
+                raise SessionError("malformed entry")
+            head = self.read_exact(head_length).decode(errors="replace")
+            body = self.skip(body_length)
+            response_head = self.read_exact(response_head_length).decode(errors="replace")
+            response_body = self.skip(response_body_length)
+            yield meta, head, body, response_head or None, response_body
+
+    def read_exact(self, length):
+        data = self.file.read(length)
+        if len(data) < length:
+            raise SessionError("truncated entry")
+        return data
+
+    def skip(self, length):
+        """Step over a body, returning its reference within the file"""
+        offset = self.file.tell()
+        if offset + length > self.size:
+            raise SessionError("truncated entry")
+        self.file.seek(length, os.SEEK_CUR)
+        return (offset, length)
+
+
+class HarWriter:
+    """
+    Streams history records into a HAR 1.2 file, one entry at a time.
+
+    Bodies are written decoded, up to body_limit bytes each, as text when they
+    are UTF-8 and base64 otherwise.
+    """
+    CREATOR = {"name": "HTTP Proxy Server", "version": "1.0"}
+
+    def __init__(self, path, spool, body_limit):
+        self.spool = spool
+        self.decoder = BodyDecoder(spool, body_limit, max_cache_bytes=0)
+        self.file = open(path, "w", encoding="utf-8")
+        self.file.write('{"log": {"version": "1.2", "creator": %s, "entries": [' % json.dumps(self.CREATOR))
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, record):
+        self.file.write(("," if self.count else "") + "\n" + json.dumps(self.entry(record)))
+        self.count += 1
+
+    def close(self):
+        self.file.write("\n]}}\n")
+        self.file.close()
+
+    def entry(self, record):
+        timing = record.timing or {}
+        url = record.url
+        if "://" not in url:
+            # Origin-form of a plain request or authority-form of a CONNECT
+            url = f"http://{record.host}{url}" if url.startswith("/") else f"https://{url}"
+        started = datetime.datetime.strptime(record.timestamp, "%Y-%m-%d %H:%M:%S").astimezone()
+        request = {
+            "method": record.method, "url": url, "httpVersion": record.protocol, "cookies": [],
+            "headers": self.headers(record.headers),
+            "queryString": [{"name": name, "value": value} for name, value in
+                            urllib.parse.parse_qsl(urllib.parse.urlsplit(url).query, keep_blank_values=True)],
+            "headersSize": len(record.headers), "bodySize": record.body[1],
+        }
+        if record.body[1]:
+            content = self.content(record.body, record.headers)
+            request["postData"] = {"mimeType": content["mimeType"], "text": content.get("text", "")}
+
+        if record.response_headers is None:
+            response = {"status": 0, "statusText": "", "httpVersion": "", "cookies": [], "headers": [],
+                        "content": {"size": 0, "mimeType": ""}, "redirectURL": "", "headersSize": -1, "bodySize": -1}
+        else:
+            parts, headers = parse_message_head(record.response_headers)
+            response = {
+                "status": int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0,
+                "statusText": parts[2] if len(parts) > 2 else "", "httpVersion": parts[0] if parts else "",
+                "cookies": [], "headers": self.headers(record.response_headers),
+                "content": self.content(record.response_body, record.response_headers),
+                "redirectURL": headers.get("location", ""),
+                "headersSize": len(record.response_headers), "bodySize": record.response_body[1],
+            }
+
+        # Both intercept holds count as time blocked, so "time" is the sum of the phases like HAR expects
+        holds = [timing[name] for name in ("request_hold", "response_hold") if name in timing]
+        timings = {"blocked": sum(holds) if holds else -1, "dns": timing.get("dns", -1),
+                   "connect": timing.get("connect", -1), "send": timing.get("send", 0),
+                   "wait": timing.get("wait", 0), "receive": timing.get("download", 0), "ssl": -1}
+        entry = {
+            "startedDateTime": started.isoformat(), "time": sum(value for value in timings.values() if value > 0),
+            "request": request, "response": response, "cache": {}, "timings": timings,
+        }
+        if record.cache:
+            entry["comment"] = f"Served from the proxy's response cache ({record.cache})"
+        return entry
+
+    @staticmethod
+    def headers(head):
+        headers = []
+        for line in head.splitlines()[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers.append({"name": name.strip(), "value": value.strip()})
+        return headers
+
+    def content(self, body, head):
+        offset, length = body
+        _, headers = parse_message_head(head)
+        content = {"size": length, "mimeType": headers.get("content-type", "")}
+        if not length:
+            content["text"] = ""
+            return content
+        if BodyDecoder.needs_decoding(head):
+            data, note = self.decoder.decode(head, body)
+            content["size"] = len(data)
+            content["comment"] = note
+        else:
+            data = self.spool.read(offset, length, self.decoder.limit)
+            if length > self.decoder.limit:
+                content["comment"] = f"[Truncated to {self.decoder.limit} of {length} bytes]"
+        try:
+            content["text"] = data.decode("utf-8")
+        except UnicodeDecodeError:
+            content["text"] = base64.b64encode(data).decode("ascii")
+            content["encoding"] = "base64"
+        return content
+
+
+class Repeater:
+    """
+    Replays captured requests through the proxy, for load and regression tests.
+
+    Every request is sent repeat times, by at most concurrency connections at
+    once and no faster than rate requests per second overall (0 for no
+    limit). A connection is kept for the next replay when both sides allow it.
+    run() executes on the GUI channel's event loop and appends one result per
+    replay to self.results as (replay number, request index, status,
+    milliseconds, response body bytes, error or None); the Tk thread drains
+    them. stop() lets the replays in flight finish and starts no new ones.
+
+    Each replay carries MARKER_HEADER with the run's token. The proxy removes
+    it and does not hold replays whose token was registered for the run, so
+    intercept stays on for all other traffic.
+    """
+    TIMEOUT = 30.0  # Per replay, from sending the request to the end of the response
+    PIECE_SIZE = 64 * 1024  # Response bodies are read and discarded in pieces of this size
+    HEAD_LIMIT = 1024 * 1024  # Longest response head accepted
+    MARKER_HEADER = "X-Proxy-Replay"
+
+    def __init__(self, requests, repeat=1, concurrency=1, rate=0, host='127.0.0.1', port=8080):
+        self.token = secrets.token_hex(16)
+        marker = f"\r\n{self.MARKER_HEADER}: {self.token}".encode()
+        self.requests = [request.replace(b"\r\n", marker + b"\r\n", 1) for request in requests]  # Raw request bytes
+        self.methods = [request.split(b" ", 1)[0].upper() for request in requests]
+        self.closes = [self.closes_connection(request) for request in requests]
+        self.total = len(requests) * repeat
+        self.repeat = repeat
+        self.concurrency = max(1, min(concurrency, self.total))
+        self.interval = 1 / rate if rate > 0 else 0
+        self.host = host
+        self.port = port
+        self.results = collections.deque()
+        self.next_start = 0
+        self.stopped = False
+
+    @staticmethod
+    def build_request(head, body):
+        """Raw request bytes from a head without its blank line and a raw body"""
+        return "\r\n".join(head.splitlines()).encode() + b"\r\n\r\n" + body
+
+    @staticmethod
+    def closes_connection(request):
+        head = request.split(b"\r\n\r\n", 1)[0].decode("latin-1")
+        parts, headers = parse_message_head(head)
+        return "close" in headers.get("connection", "").lower() or (len(parts) > 2 and parts[2] == "HTTP/1.0")
+
+    def stop(self):
+        self.stopped = True
+
+    async def run(self):
+        jobs = ((iteration * len(self.requests) + index + 1, index)
+                for iteration in range(self.repeat) for index in range(len(self.requests)))
+        workers = [asyncio.ensure_future(self.worker(jobs)) for _ in range(self.concurrency)]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        return self.stopped
+
+    async def pace(self):
+        """Wait for the next start slot when the rate is limited"""
+        if not self.interval:
+            return
+        now = asyncio.get_running_loop().time()
+        start = max(now, self.next_start)
+        self.next_start = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def worker(self, jobs):
+        reader = writer = None
+        try:
+            # The generator is shared, each job goes to whichever worker is free first
+            for replay, index in jobs:
+                await self.pace()
+                if self.stopped:
+                    break
+                started = time.perf_counter()
+                status, size, error, keep_alive = "", 0, None, False
+                try:
+                    if writer is None:
+                        reader, writer = await asyncio.wait_for(
+                            asyncio.open_connection(self.host, self.port, limit=self.HEAD_LIMIT), self.TIMEOUT)
+                    status, size, keep_alive = await asyncio.wait_for(
+                        self.exchange(reader, writer, index), self.TIMEOUT)
+                except asyncio.TimeoutError:
+                    error = "timed out"
+                except asyncio.IncompleteReadError:
+                    error = "connection closed"
+                except (OSError, EOFError, ValueError, asyncio.LimitOverrunError) as e:
+                    error = str(e) or type(e).__name__
+                elapsed = (time.perf_counter() - started) * 1000
+                self.results.append((replay, index, status, elapsed, size, error))
+                if not keep_alive and writer is not None:
+                    writer.close()
+                    reader = writer = None
+        finally:
+            if writer is not None:
+                writer.close()
+
+    async def exchange(self, reader, writer, index):
+        """Send one request and read its response; returns (status, body bytes, connection reusable)"""
+        writer.write(self.requests[index])
+        await writer.drain()
+        head = await reader.readuntil(b"\r\n\r\n")
+        parts, headers = parse_message_head(head.decode("latin-1"))
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise ValueError("malformed response")
+        status = parts[1]
+        keep_alive = (parts[0] == "HTTP/1.1" and "close" not in headers.get("connection", "").lower()
+                      and not self.closes[index])
+
+        if self.methods[index] == b"HEAD" or status.startswith("1") or status in ("204", "304"):
+            return status, 0, keep_alive
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            size = 0
+            while True:
+                line = await reader.readuntil(b"\r\n")
+                length = int(line.split(b";", 1)[0], 16)
+                if length == 0:
+                    break
+                await self.discard(reader, length + 2)
+                size += length
+            while await reader.readuntil(b"\r\n") != b"\r\n":
+                pass  # Trailer fields
+            return status, size, keep_alive
+        if "content-length" in headers:
+            length = int(headers["content-length"])
+            await self.discard(reader, length)
+            return status, length, keep_alive
+        # Delimited by the end of the connection
+        size = 0
+        while True:
+            data = await reader.read(self.PIECE_SIZE)
+            if not data:
+                return status, size, False
+            size += len(data)
+
+    async def discard(self, reader, length):
+        while length > 0:
+            data = await reader.read(min(length, self.PIECE_SIZE))
+            if not data:
+                raise asyncio.IncompleteReadError(b"", length)
+            length -= len(data)
+
+
+class LatencyTracker:
+    """Recent exchange durations per host, for running percentiles"""
+    WINDOW = 1000  # Samples kept per host
+
+    def __init__(self):
+        self.samples = {}  # Host -> deque of durations in milliseconds
+        self.counts = collections.Counter()
+
+    def add(self, host, duration):
+        samples = self.samples.get(host)
+        if samples is None:
+            samples = self.samples[host] = collections.deque(maxlen=self.WINDOW)
+        samples.append(duration)
+        self.counts[host] += 1
+
+    def percentiles(self, host, points=(50, 95, 99)):
+        """Nearest-rank percentiles over the window of host"""
+        ordered = sorted(self.samples.get(host, ()))
+        if not ordered:
+            return [None] * len(points)
+        return [ordered[min(len(ordered) - 1, max(0, -(-point * len(ordered) // 100) - 1))] for point in points]
+
+
+class VirtualListView:
+    """
+    Treeview that only holds the rows currently scrolled into view.
+
+    Rows live in a model (ordered ids and their values). insert/set/delete only
+    touch the model and mark the view dirty; the visible window is reconciled
+    with the Treeview by iid on a fixed refresh tick, so the cost per tick
+    depends on the number of visible rows, not on how many rows exist.
+    """
+    DEFAULT_ROW_HEIGHT = 20
+    WHEEL_ROWS = 3
+
+    def __init__(self, parent, columns, headings=None, refresh_ms=100, selectmode="browse", follow_tail=False):
+        self.frame = ttk.Frame(parent)
+        self.tree = ttk.Treeview(self.frame, columns=columns, show="headings", selectmode=selectmode)
+        for column, heading in zip(columns, headings or columns):
+            self.tree.heading(column, text=heading)
+        self.scrollbar = ttk.Scrollbar(self.frame, orient=tk.VERTICAL, command=self.on_scroll)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
+        self.columns = columns
+        self.ids = []
+        self.values = {}
+        self.removed = set()  # Deleted ids not yet compacted out of self.ids
+        self.changed = set()  # Ids whose values changed since the last refresh
+        self.selected = {}  # Selected ids in selection order, visible or not
+        self.select_callbacks = []
+        self.tail_callbacks = []
+
+        self.top = 0
+        self.visible_rows = 20
+        self.follow_tail = follow_tail
+        self.at_tail = True
+        self.dirty = True
+        self.refresh_ms = refresh_ms
+
+        try:
+            self.row_height = int(ttk.Style().lookup("Treeview", "rowheight") or self.DEFAULT_ROW_HEIGHT)
+        except (ValueError, tk.TclError):
+            self.row_height = self.DEFAULT_ROW_HEIGHT
+
+        self.tree.bind("<Configure>", self.on_resize)
+        self.tree.bind("<<TreeviewSelect>>", self.on_tree_select)
+        self.tree.bind("<Up>", lambda event: self.on_key_step(-1))
+        self.tree.bind("<Down>", lambda event: self.on_key_step(1))
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.tree.bind(sequence, self.on_wheel)
+        self.frame.after(self.refresh_ms, self.tick)
+
+    def pack(self, **kwargs):
+        self.frame.pack(**kwargs)
+
+    def __len__(self):
+        return len(self.values)
+
+    def exists(self, row_id):
+        return str(row_id) in self.values
+
+    def insert(self, row_id, values):
+        """Append a row at the end of the list"""
+        row_id = str(row_id)
+        if row_id in self.removed:
+            # Re-inserting an id that still has a stale position
+            self.compact()
+        self.ids.append(row_id)
+        self.values[row_id] = values
+        self.dirty = True
+
+    def item(self, row_id):
+        return self.values.get(str(row_id))
+
+    def update(self, row_id, values):
+        row_id = str(row_id)
+        if row_id in self.values:
+            self.values[row_id] = values
+            self.changed.add(row_id)
+            self.dirty = True
+
+    def set(self, row_id, column, value):
+        values = self.values.get(str(row_id))
+        if values is not None:
+            values = list(values)
+            values[self.columns.index(column)] = value
+            self.update(row_id, tuple(values))
+
+    def delete(self, row_id):
+        row_id = str(row_id)
+        if self.values.pop(row_id, None) is not None:
+            self.removed.add(row_id)
+            self.changed.discard(row_id)
+            self.selected.pop(row_id, None)
+            self.dirty = True
+
+    def clear(self):
+        self.ids = []
+        self.values.clear()
+        self.removed.clear()
+        self.changed.clear()
+        self.selected.clear()
+        self.top = 0
+        self.dirty = True
+
+    def selection(self):
+        return list(self.selected)
+
+    def bind_select(self, callback):
+        """Call callback(view) when the set of selected rows changes"""
+        self.select_callbacks.append(callback)
+
+    def bind_tail(self, callback):
+        """Call callback(view) when the window reaches the last row, so more rows can be appended"""
+        self.tail_callbacks.append(callback)
+
+    def see(self, row_id):
+        row_id = str(row_id)
+        if row_id not in self.values:
+            return
+        self.compact()
+        index = self.ids.index(row_id)
+        if index < self.top or index >= self.top + self.visible_rows:
+            self.scroll_to(index - self.visible_rows // 2)
+
+    def compact(self):
+        if self.removed:
+            self.ids = [row_id for row_id in self.ids if row_id not in self.removed]
+            self.removed.clear()
+
+    def scroll_to(self, top):
+        self.compact()
+        self.top = max(0, min(top, len(self.ids) - self.visible_rows))
+        self.at_tail = self.top + self.visible_rows >= len(self.ids)
+        self.refresh()
+
+    def tick(self):
+        if self.dirty:
+            self.refresh()
+        self.frame.after(self.refresh_ms, self.tick)
+
+    def refresh(self):
+        """Reconcile the Treeview with the visible window of the model"""
+        self.dirty = False
+        self.compact()
+        total = len(self.ids)
+        if self.follow_tail and self.at_tail:
+            self.top = total - self.visible_rows
+        self.top = max(0, min(self.top, total - self.visible_rows))
+        window = self.ids[self.top:self.top + self.visible_rows]
+        wanted = set(window)
+
+        stale = [iid for iid in self.tree.get_children() if iid not in wanted]
+        if stale:
+            self.tree.delete(*stale)
+
+        for index, row_id in enumerate(window):
+            if not self.tree.exists(row_id):
+                self.tree.insert("", index, iid=row_id, values=self.values[row_id])
+                continue
+            if row_id in self.changed:
+                self.tree.item(row_id, values=self.values[row_id])
+            if self.tree.index(row_id) != index:
+                self.tree.move(row_id, "", index)
+        self.changed.clear()
+
+        visible_selection = [row_id for row_id in window if row_id in self.selected]
+        if set(visible_selection) != set(self.tree.selection()):
+            self.tree.selection_set(visible_selection)
+
+        if total:
+            self.scrollbar.set(self.top / total, min(1.0, (self.top + self.visible_rows) / total))
+        else:
+            self.scrollbar.set(0.0, 1.0)
+
+        if self.top + self.visible_rows >= total:
+            for callback in self.tail_callbacks:
+                callback(self)
+
+    def on_resize(self, event):
+        heading_height = self.row_height + 4
+        rows = max(1, (event.height - heading_height) // self.row_height)
+        if rows != self.visible_rows:
+            self.visible_rows = rows
+            self.refresh()
+
+    def on_scroll(self, *args):
+        if args[0] == "moveto":
+            top = int(float(args[1]) * len(self.ids))
+        else:
+            step = self.visible_rows if args[2] == "pages" else 1
+            top = self.top + int(args[1]) * step
+        self.scroll_to(top)
+
+    def on_wheel(self, event):
+        direction = -1 if event.num == 4 or event.delta > 0 else 1
+        self.scroll_to(self.top + direction * self.WHEEL_ROWS)
+        return "break"
+
+    def on_key_step(self, direction):
+        # Scroll the window when the focus would move past its edge
+        focus = self.tree.focus()
+        children = self.tree.get_children()
+        if focus and children and focus == children[0 if direction < 0 else -1]:
+            self.scroll_to(self.top + direction)
+
+    def on_tree_select(self, event):
+        visible = set(self.tree.get_children())
+        visible_selection = self.tree.selection()
+        if str(self.tree.cget("selectmode")) == "browse":
+            if not visible_selection:
+                return  # The selected row was scrolled out of view
+            selected = dict.fromkeys(visible_selection)
+        else:
+            selected = {row_id: None for row_id in self.selected if row_id not in visible}
+            selected.update(dict.fromkeys(visible_selection))
+        # Selection events caused by scrolling leave the model selection unchanged
+        if set(selected) != set(self.selected):
+            self.selected = selected
+            for callback in self.select_callbacks:
+                callback(self)
+
+
+class BlockedDomainStore:
+    """
+    Blocked domains kept as a JSON snapshot plus an append-only change log.
+
+    Changes append "+domain" or "-domain" lines to the log instead of
+    rewriting the snapshot; the log is folded into a new snapshot once it
+    outgrows the list. Replaying the log over any snapshot it was written
+    against gives the same list, so a crash between the two steps is harmless.
+    """
+    COMPACT_MIN_LINES = 1000
+    COMPACT_RATIO = 0.5  # Log lines allowed per blocked domain before compacting
+
+    # Names found in hosts files that must never be blocked
+    HOSTS_FILE_NAMES = {"localhost", "localhost.localdomain", "local", "broadcasthost", "0.0.0.0"}
+
+    def __init__(self, snapshot_path, log_path):
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.domains = {}  # Insertion-ordered index of blocked domains
+        self.log_lines = 0
+        self.version = 0  # Version of the list last sent to the proxy
+        self.load()
+
+    def __contains__(self, domain):
+        return domain in self.domains
+
+    def __iter__(self):
+        return iter(self.domains)
+
+    def __len__(self):
+        return len(self.domains)
+
+    @staticmethod
+    def normalize(domain):
+        """Same form the proxy keys its blocklist by, "*.example.com" stays a separate entry"""
+        domain = domain.strip().lower()
+        prefix = "*." if domain.startswith("*.") else ""
+        name = domain[len(prefix):].lstrip(".").rstrip(". \t\r\n\v\f")
+        return prefix + name if name else ""
+
+    @classmethod
+    def parse_list(cls, text):
+        """Domains from a plain list or a hosts file, comments ignored"""
+        domains = []
+        for line in text.splitlines():
+            fields = line.split("#", 1)[0].split()
+            # Hosts files put an address before the names
+            for name in fields[1:] if len(fields) > 1 else fields:
+                domain = cls.normalize(name)
+                if domain and domain not in cls.HOSTS_FILE_NAMES:
+                    domains.append(domain)
+        return domains
+
+    def load(self):
+        try:
+            if os.path.exists(self.snapshot_path):
+                with open(self.snapshot_path, "r") as f:
+                    self.domains = dict.fromkeys(json.load(f))
+            if os.path.exists(self.log_path):
+                with open(self.log_path, "r") as f:
+                    for line in f:
+                        operation, domain = line[:1], line[1:].strip()
+                        if operation == "+":
+                            self.domains[domain] = None
+                        elif operation == "-":
+                            self.domains.pop(domain, None)
+                        self.log_lines += 1
+        except (OSError, ValueError) as e:
+            print(f"Error loading blocked domains: {e}")
+
+    def add(self, domains):
+        """Block domains, returns the ones that were not blocked yet"""
+        added = [domain for domain in dict.fromkeys(domains) if domain and domain not in self.domains]
+        for domain in added:
+            self.domains[domain] = None
+        self.append_log("+", added)
+        return added
+
+    def remove(self, domains):
+        """Unblock domains, returns the ones that were blocked"""
+        removed = [domain for domain in dict.fromkeys(domains) if domain in self.domains]
+        for domain in removed:
+            del self.domains[domain]
+        self.append_log("-", removed)
+        return removed
+
+    def append_log(self, operation, domains):
+        if not domains:
+            return
+        try:
+            with open(self.log_path, "a") as f:
+                f.write("".join(f"{operation}{domain}\n" for domain in domains))
+            self.log_lines += len(domains)
+        except OSError as e:
+            print(f"Error saving blocked domains: {e}")
+        if self.log_lines > max(self.COMPACT_MIN_LINES, len(self.domains) * self.COMPACT_RATIO):
+            self.compact()
+
+    def compact(self):
+        """Write the current list as the new snapshot and empty the log"""
+        temporary_path = self.snapshot_path + ".tmp"
+        try:
+            with open(temporary_path, "w") as f:
+                json.dump(list(self.domains), f, indent=2)
+            os.replace(temporary_path, self.snapshot_path)
+            open(self.log_path, "w").close()
+            self.log_lines = 0
+        except OSError as e:
+            print(f"Error compacting blocked domains: {e}")
 
 
 class ProxyServerGUI:
+    GUI_EVENT_INTERVAL_MS = 50  # How often queued proxy messages are applied to the GUI
+    GUI_EVENT_BATCH = 500  # Upper bound of messages handled per tick
+
+    DISPLAY_BODY_LIMIT = 1024 * 1024  # Bytes of a body loaded into a text widget
+    STATS_POLL_INTERVAL = 2.0  # Seconds between proxy statistics updates
+
+    # History budget
+    HISTORY_MAX_ENTRIES = 5000
+    HISTORY_MAX_BYTES = 64 * 1024 * 1024
+    HISTORY_EVICTION = "fifo"
+    HISTORY_PAGE_SIZE = 500  # Search results appended to the history view per page
+    HISTORY_SEARCH_REFRESH_MS = 1000  # How often an active search picks up new matches
+
+    # Saved sessions
+    HAR_BODY_LIMIT = 64 * 1024 * 1024  # Decoded bytes of one body written into a HAR file
+    SESSION_PROGRESS_EVERY = 500  # Exported entries between progress updates
+    SESSION_IMPORT_BATCH = 200  # Imported entries handed to the Tk thread at a time
+
+    # Repeater
+    REPEATER_MAX_REQUESTS = 1000  # Requests queued for replay at once
+    REPEATER_MAX_CONCURRENCY = 256
+    REPEATER_REFRESH_MS = 250  # How often finished replays are moved into the results table
+
+    # Phases of an exchange in the order they happen, as sent in FRAME_TIMING
+    TIMING_PHASES = (("request_hold", "Request hold", "#c9a227"), ("dns", "DNS", "#2a9d8f"),
+                     ("connect", "Connect", "#e76f51"), ("wait", "Waiting (TTFB)", "#457b9d"),
+                     ("download", "Download", "#6a994e"), ("response_hold", "Response hold", "#c9a227"),
+                     ("send", "Send to client", "#8d6cab"))
+    LATENCY_REFRESH_MS = 1000
+
+    # Metrics tab: one scrape per interval, charts cover the last METRICS_WINDOW scrapes
+    METRICS_POLL_INTERVAL_MS = 1000
+    METRICS_WINDOW = 120
+    METRICS_CHARTS = (("Requests/s", (("requests_rate", "#457b9d"),)),
+                      ("In flight (requests, connections)", (("requests_in_flight", "#e76f51"),
+                                                            ("connections_in_flight", "#8d6cab"))),
+                      ("Intercept queue depth", (("intercept_queue_depth", "#c9a227"),)),
+                      ("Client bytes/s (in, out)", (("bytes_in_rate", "#2a9d8f"), ("bytes_out_rate", "#6a994e"))),
+                      ("Blocked and upstream errors/s", (("blocked_rate", "#999999"), ("errors_rate", "#d62828"))),
+                      ("Mean duration (ms)", (("mean_duration", "#457b9d"),)))
+
     def __init__(self, root):
         self.root = root
         self.root.title("HTTP Proxy Server")
         self.root.geometry("1800x900")  # Increased size to accommodate new feature
 
         # Blocked domains management
-        self.blocked_domains_file = "blocked_domains.json"
-        self.blocked_domains = self.load_blocked_domains()
+        self.blocked_domains = BlockedDomainStore("blocked_domains.json", "blocked_domains.log")
+        self.blocklist_resync_pending = False
 
-        # Queue to manage waiting requests
-        self.waiting_requests_queue = queue.Queue()
-        self.waiting_requests = []
+        # Rules deciding held messages before they reach the waiting list
+        self.rules_file = "rules.json"
+        self.rule_engine = RuleEngine()
+        self.rule_specs, self.default_rule_action = self.load_rules()
+        try:
+            self.rule_engine.set_rules(self.rule_specs, self.default_rule_action)
+        except (ValueError, re.error) as e:
+            print(f"Error compiling rules, holding every message: {e}")
+
+        # Rewrite rules the proxy applies to all traffic, sent to it whenever they change
+        self.rewrite_rules_file = "rewrite_rules.json"
+        self.rewrite_specs = self.load_rewrite_rules()
+        self.rewrite_version = 0  # Of the last list sent, older replies are ignored
+
+        # Messages read by the GUI channel, applied to the widgets on the Tk thread
+        self.gui_events = queue.Queue()
+        # Callables posted by background threads, also run on the Tk thread
+        self.ui_callbacks = queue.Queue()
+        self.waiting_requests = collections.OrderedDict()
         self.current_request_id = 0
+        self.current_selected_request = None
+
+        # Responses waiting for a verdict; the first one is the one on display
+        self.pending_responses = collections.deque()
 
-        self.server_socket = None
-        self.client_socket = None
+        self.gui_channel = None
         self.intercept_enabled = True
-        self.current_message_type = None
-        self.history = []
+        # Raw bodies live on disk, everything else keeps (offset, length) references
+        self.spool = BodySpool()
+        self.decoder = BodyDecoder(self.spool, self.DISPLAY_BODY_LIMIT)
+        self.current_request_body_text = None
+        self.current_request_body_note = None
+
+        self.history = HistoryStore(self.HISTORY_MAX_ENTRIES, self.HISTORY_MAX_BYTES, self.HISTORY_EVICTION)
+        self.latency = LatencyTracker()
+        self.latency_changed = False
+        # Search over the history; the results are None while no search is active
+        self.history_index = HistoryIndex()
+        self.index_decoder = BodyDecoder(self.spool, HistoryIndex.BODY_LIMIT, max_cache_bytes=0)
+        self.history_results = None
+        self.history_cursor = 0  # Results up to this entry id are in the history view
+        self.history_search_stale = False
+        # Requests queued for replay and the run in progress, if any
+        self.repeater_requests = []  # Dicts with the head text, a spooled body and a label
+        self.repeater_editing = None  # Queued request loaded into the request panel
+        self.repeater = None
+        self.repeater_labels = []  # Labels of the requests of the current run, by index
+        self.repeater_latency = LatencyTracker()
+        self.repeater_statuses = collections.Counter()
+        self.repeater_done = 0
+        self.repeater_started = 0
 
         self.create_main_layout()
         self.create_control_panel()
@@ -36,130 +1870,89 @@ class ProxyServerGUI:
         self.create_response_panel()
         self.create_waiting_requests_panel()
         self.create_blocked_domains_panel()  # New panel for blocked domains
+        self.create_rules_panel()
+        self.create_rewrite_panel()
+        self.create_metrics_tab()
         self.create_history_tab()
+        self.create_repeater_tab()
 
         self.start_gui_listener()
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
 
+    def read_request_panel(self, body):
+        """
+        Return (head, raw body, body edited) from the request panel. body is the
+        spool reference of the message on display.
+        """
+        # Collect modified headers and body
+        headers = self.request_headers.get("1.0", tk.END).strip()
+        text = self.request_body.get("1.0", tk.END).strip()
+
+        # The proxy expects CRLF line endings in the head section
+        head = "\r\n".join(headers.splitlines())
+
+        # An untouched body is sent back byte for byte from the spool
+        if text == self.current_request_body_text:
+            return head, self.spool.read(*body), False
+        note = self.current_request_body_note
+        if note and text.endswith(note):
+            text = text[:-len(note)].rstrip()
+        raw_body = text.encode()
+        # The editor showed the decoded body, so it goes out plain with the length of the edit
+        head = BodyDecoder.decoded_head(head, len(raw_body))
+        return head, raw_body, True
+
     def save_and_forward_request(self):
         if self.current_selected_request:
             try:
-                # Collect modified headers and body
-                headers = self.request_headers.get("1.0", tk.END).strip()
-                body = self.request_body.get("1.0", tk.END).strip()
-                
-                # Reconstruct the HTTP request
-                modified_request = f"{headers}\r\n\r\n{body}"
-                
-                try:
-                    # Get the client socket
-                    client_socket = self.current_selected_request['client_socket']
-                    request_id = self.current_selected_request['id']
-                    
-                    # Send edit signal
-                    client_socket.sendall("EDIT\n\n".encode())
-                    
-                    # Send message length as a fixed-length string (padded with spaces)
-                    message_length = str(len(modified_request)).ljust(10)
-                    print(message_length)
-                    client_socket.sendall(message_length.encode())
-
-                    # Wait for acknowledgment with timeout
-                    client_socket.settimeout(5.0)  # 5 second timeout
-                    response = client_socket.recv(1024).decode().strip()
-                    if response != "READY":
-                        self.remove_request_from_waiting_list(request_id)
-                        messagebox.showerror("Error", "Server did not acknowledge message length")
-                        client_socket.close()
-                        return
-
-                    print(modified_request)
-                    # Send modified request
-                    client_socket.sendall(modified_request.encode())
-                    
-                    # Wait for confirmation
-                    response = client_socket.recv(1024).decode().strip()
-                    if response != "OK":
-                        self.remove_request_from_waiting_list(request_id)
-                        messagebox.showerror("Error", "Failed to send modified request")
-                        client_socket.close()
-                        return
-                    
-                    # Remove from waiting requests
-                    self.remove_request_from_waiting_list(request_id)
-                    
-                    messagebox.showinfo("Success", "Request modified and forwarded successfully")
-                    
-                except socket.timeout:
-                    self.remove_request_from_waiting_list(request_id)
-                    messagebox.showerror("Error", "Connection timed out")
-                except ConnectionResetError:
-                    self.remove_request_from_waiting_list(request_id)
-                    messagebox.showerror("Error", "Connection was reset by the server")
-                except Exception as e:
-                    self.remove_request_from_waiting_list(request_id)
-                    messagebox.showerror("Error", f"Failed to forward modified request: {str(e)}")
-                finally:
-                    try:
-                        client_socket.close()
-                    except:
-                        pass
-                    
+                head, raw_body, _ = self.read_request_panel(self.current_selected_request['body'])
+
+                # A single EDIT frame replaces the request, no acknowledgment round trips
+                connection = self.current_selected_request['connection']
+                connection.send_frame(FRAME_EDIT, self.current_selected_request['message_id'],
+                                      head.encode(), raw_body)
+                self.remove_request_from_waiting_list(self.current_selected_request['id'])
+
             except Exception as e:
-                messagebox.showerror("Error", f"Failed to prepare modified request: {str(e)}")
+                messagebox.showerror("Error", f"Failed to forward modified request: {str(e)}")
 
     def remove_request_from_waiting_list(self, request_id):
         """Remove a request from the waiting list and update the GUI"""
-        # Remove from waiting requests list
-        self.waiting_requests = [
-            req for req in self.waiting_requests 
-            if req['id'] != request_id
-        ]
-        
-        # Update GUI
-        self.root.after(0, self.update_waiting_requests_list)
-        self.root.after(0, self.clear_request_display)
+        self.waiting_requests.pop(request_id, None)
+        self.waiting_requests_list.delete(request_id)
 
-    def load_blocked_domains(self):
-        """Load blocked domains from a JSON file"""
-        try:
-            if os.path.exists(self.blocked_domains_file):
-                with open(self.blocked_domains_file, 'r') as f:
-                    return json.load(f)
-            return []
-        except Exception as e:
-            print(f"Error loading blocked domains: {e}")
-            return []
+        if self.current_selected_request and self.current_selected_request['id'] == request_id:
+            self.current_selected_request = None
+            self.clear_request_display()
 
-    def save_blocked_domains(self):
-        """Save blocked domains to a JSON file"""
-        try:
-            with open(self.blocked_domains_file, 'w') as f:
-                json.dump(self.blocked_domains, f, indent=2)
-            
-            # Send updated blocked domains to the proxy server
-            self.send_blocked_domains_to_proxy()
-        except Exception as e:
-            print(f"Error saving blocked domains: {e}")
-
-    def send_blocked_domains_to_proxy(self):
-        """Send updated blocked domains list to the proxy server"""
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect(('127.0.0.1', 9092))  # New port for blocked domains update
-                domains_json = json.dumps(self.blocked_domains)
-                s.sendall(domains_json.encode())
-        except Exception as e:
-            print(f"Failed to send blocked domains: {e}")
+    def sync_blocked_domains(self, operation, domains):
+        """Send a blocklist change to the proxy in the background"""
+        store = self.blocked_domains
+        store.version += 1
+        body = "\n".join(domains).encode()
+        self.run_in_background(self.control.update_blocklist(operation, store.version, body),
+                               lambda reply, error: self.on_blocklist_reply(operation, reply, error))
+
+    def on_blocklist_reply(self, operation, reply, error):
+        if operation == BLOCKLIST_REPLACE:
+            self.blocklist_resync_pending = False
+        if error is not None:
+            print(f"Failed to send blocked domains: {error}")
+        elif reply == BLOCKLIST_RESYNC:
+            # The proxy missed a change or restarted, give it the whole list once
+            if not self.blocklist_resync_pending:
+                self.blocklist_resync_pending = True
+                self.sync_blocked_domains(BLOCKLIST_REPLACE, self.blocked_domains)
+        elif reply != BLOCKLIST_ACK:
+            print(f"Unexpected blocked domains reply from proxy: {reply}")
 
     def create_blocked_domains_panel(self):
         """Create panel for managing blocked domains"""
         blocked_domains_tab = ttk.Frame(self.notebook)
         self.notebook.add(blocked_domains_tab, text='Blocked Domains')
 
-        # Treeview to display blocked domains
-        self.blocked_domains_list = ttk.Treeview(blocked_domains_tab, columns=("Domain",), show="headings")
-        self.blocked_domains_list.heading("Domain", text="Blocked Domains")
+        # Virtual list, imported lists can hold hundreds of thousands of domains
+        self.blocked_domains_list = VirtualListView(blocked_domains_tab, ("Domain",), ("Blocked Domains",))
         self.blocked_domains_list.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
 
         # Update the list with current blocked domains
@@ -177,89 +1970,463 @@ class ProxyServerGUI:
         remove_button = ttk.Button(button_frame, text="Remove Domain", command=self.remove_blocked_domain)
         remove_button.pack(side=tk.LEFT, padx=5)
 
+        # Import List button, plain domain lists or hosts files
+        import_button = ttk.Button(button_frame, text="Import List", command=self.import_blocked_domains)
+        import_button.pack(side=tk.LEFT, padx=5)
+
     def update_blocked_domains_list(self):
-        """Update the treeview with current blocked domains"""
-        # Clear existing items
-        for i in self.blocked_domains_list.get_children():
-            self.blocked_domains_list.delete(i)
-        
-        # Add current blocked domains
+        """Fill the list with current blocked domains"""
+        self.blocked_domains_list.clear()
         for domain in self.blocked_domains:
-            self.blocked_domains_list.insert("", "end", values=(domain,))
+            self.blocked_domains_list.insert(domain, (domain,))
 
     def add_blocked_domain(self):
         """Prompt user to add a new blocked domain"""
         domain = simpledialog.askstring("Add Blocked Domain", "Enter domain to block:")
         if domain:
-            # Validate domain (basic check)
-            domain = domain.strip().lower()
+            # "example.com" also blocks its subdomains, "*.example.com" only the subdomains
+            domain = BlockedDomainStore.normalize(domain)
             if domain and domain not in self.blocked_domains:
-                self.blocked_domains.append(domain)
-                self.update_blocked_domains_list()
-                self.save_blocked_domains()
+                self.blocked_domains.add([domain])
+                self.blocked_domains_list.insert(domain, (domain,))
+                self.sync_blocked_domains(BLOCKLIST_ADD, [domain])
                 messagebox.showinfo("Success", f"Domain {domain} added to blocked list")
             elif domain in self.blocked_domains:
                 messagebox.showwarning("Warning", f"Domain {domain} is already blocked")
 
     def remove_blocked_domain(self):
         """Remove selected blocked domain"""
-        selected_item = self.blocked_domains_list.selection()
-        if selected_item:
-            domain = self.blocked_domains_list.item(selected_item, "values")[0]
-            self.blocked_domains.remove(domain)
-            self.update_blocked_domains_list()
-            self.save_blocked_domains()
+        selected = self.blocked_domains_list.selection()
+        if selected:
+            domain = selected[0]
+            self.blocked_domains.remove([domain])
+            self.blocked_domains_list.delete(domain)
+            self.sync_blocked_domains(BLOCKLIST_REMOVE, [domain])
             messagebox.showinfo("Success", f"Domain {domain} removed from blocked list")
         else:
             messagebox.showwarning("Warning", "Please select a domain to remove")
 
+    def import_blocked_domains(self):
+        """Block every domain of a list file in one update"""
+        path = filedialog.askopenfilename(title="Import Blocked Domains",
+                                          filetypes=[("Domain lists", "*.txt *.hosts *.list"), ("All files", "*")])
+        if not path:
+            return
+        try:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                domains = BlockedDomainStore.parse_list(f.read())
+        except OSError as e:
+            messagebox.showerror("Error", f"Failed to read {path}: {e}")
+            return
+
+        added = self.blocked_domains.add(domains)
+        for domain in added:
+            self.blocked_domains_list.insert(domain, (domain,))
+        if added:
+            self.sync_blocked_domains(BLOCKLIST_ADD, added)
+        messagebox.showinfo("Success", f"Imported {len(added)} new domains ({len(domains) - len(added)} already blocked)")
+
+    def load_rules(self):
+        """Load rule specs and the action for unmatched messages from a JSON file"""
+        try:
+            if os.path.exists(self.rules_file):
+                with open(self.rules_file, 'r') as f:
+                    saved = json.load(f)
+                return saved.get("rules", []), saved.get("default_action", "hold")
+        except (OSError, ValueError) as e:
+            print(f"Error loading rules: {e}")
+        return [], "hold"
+
+    def save_rules(self):
+        try:
+            with open(self.rules_file, 'w') as f:
+                json.dump({"default_action": self.default_rule_action, "rules": self.rule_specs}, f, indent=2)
+        except OSError as e:
+            print(f"Error saving rules: {e}")
+
+    def apply_rules(self, specs, default_action):
+        """Compile and activate rules, returns False and reports the error if one is invalid"""
+        try:
+            self.rule_engine.set_rules(specs, default_action)
+        except (ValueError, re.error) as e:
+            messagebox.showerror("Invalid Rule", str(e))
+            return False
+        self.rule_specs, self.default_rule_action = specs, default_action
+        self.save_rules()
+        self.update_rules_list()
+        return True
+
+    def create_rules_panel(self):
+        """Create panel for managing the rules that decide held messages"""
+        rules_tab = ttk.Frame(self.notebook)
+        self.notebook.add(rules_tab, text='Rules')
+
+        columns = ("On", "Name", "Applies To", "Match", "Action")
+        self.rules_list = ttk.Treeview(rules_tab, columns=columns, show="headings")
+        for column, width in zip(columns, (40, 120, 80, 260, 80)):
+            self.rules_list.heading(column, text=column)
+            self.rules_list.column(column, width=width, stretch=column == "Match")
+        self.rules_list.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        self.rules_list.bind("<Double-1>", lambda event: self.edit_rule())
+
+        button_frame = ttk.Frame(rules_tab)
+        button_frame.pack(fill=tk.X, padx=10, pady=5)
+        for text, command in (("Add Rule", self.add_rule), ("Edit Rule", self.edit_rule),
+                              ("Remove Rule", self.remove_rule), ("Enable/Disable", self.toggle_rule),
+                              ("Move Up", lambda: self.move_rule(-1)), ("Move Down", lambda: self.move_rule(1))):
+            ttk.Button(button_frame, text=text, command=command).pack(side=tk.LEFT, padx=5)
+
+        # What happens to held messages no rule matches
+        ttk.Label(button_frame, text="Unmatched:").pack(side=tk.LEFT, padx=(15, 5))
+        self.default_rule_action_var = tk.StringVar(value=self.default_rule_action)
+        default_action = ttk.Combobox(button_frame, textvariable=self.default_rule_action_var,
+                                      values=("hold", "forward", "drop"), state="readonly", width=8)
+        default_action.pack(side=tk.LEFT)
+        default_action.bind("<<ComboboxSelected>>",
+                            lambda event: self.apply_rules(self.rule_specs, self.default_rule_action_var.get()))
+
+        self.update_rules_list()
+
+    @staticmethod
+    def describe_rule(spec):
+        conditions = [f"{field}={spec[field]}" for field in ("method", "host", "path", "header", "content_type")
+                      if spec.get(field)]
+        return ", ".join(conditions) or "any"
+
+    def update_rules_list(self):
+        self.rules_list.delete(*self.rules_list.get_children())
+        for index, spec in enumerate(self.rule_specs):
+            self.rules_list.insert("", "end", iid=str(index), values=(
+                "yes" if spec.get("enabled", True) else "no", spec.get("name", ""),
+                spec.get("applies_to", "requests"), self.describe_rule(spec), spec.get("action", "hold")))
+
+    def selected_rule_index(self):
+        selection = self.rules_list.selection()
+        return int(selection[0]) if selection else None
+
+    def add_rule(self):
+        self.open_rule_dialog(None)
+
+    def edit_rule(self):
+        index = self.selected_rule_index()
+        if index is None:
+            messagebox.showwarning("Warning", "Please select a rule to edit")
+            return
+        self.open_rule_dialog(index)
+
+    def remove_rule(self):
+        index = self.selected_rule_index()
+        if index is not None:
+            self.apply_rules(self.rule_specs[:index] + self.rule_specs[index + 1:], self.default_rule_action)
+
+    def toggle_rule(self):
+        index = self.selected_rule_index()
+        if index is not None:
+            specs = [dict(spec) for spec in self.rule_specs]
+            specs[index]["enabled"] = not specs[index].get("enabled", True)
+            self.apply_rules(specs, self.default_rule_action)
+            self.rules_list.selection_set(str(index))
+
+    def move_rule(self, direction):
+        """Rules are evaluated in list order, the first match wins"""
+        index = self.selected_rule_index()
+        if index is None or not 0 <= index + direction < len(self.rule_specs):
+            return
+        specs = list(self.rule_specs)
+        specs[index], specs[index + direction] = specs[index + direction], specs[index]
+        if self.apply_rules(specs, self.default_rule_action):
+            self.rules_list.selection_set(str(index + direction))
+
+    def open_rule_dialog(self, index):
+        """Form for adding a rule, or editing the one at index"""
+        spec = self.rule_specs[index] if index is not None else {"applies_to": "requests", "action": "forward"}
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Edit Rule" if index is not None else "Add Rule")
+        dialog.transient(self.root)
+
+        fields = (("name", "Name"), ("method", "Method"), ("host", "Host (e.g. *.example.com)"),
+                  ("path", "Path regex"), ("header", "Header (Name: regex)"),
+                  ("content_type", "Content type contains"), ("find", "Rewrite pattern (regex)"),
+                  ("replace", "Rewrite replacement"))
+        variables = {}
+        for row, (field, label) in enumerate(fields):
+            ttk.Label(dialog, text=label).grid(row=row, column=0, sticky=tk.W, padx=5, pady=2)
+            variables[field] = tk.StringVar(value=spec.get(field, ""))
+            ttk.Entry(dialog, textvariable=variables[field], width=50).grid(row=row, column=1, padx=5, pady=2)
+
+        for field, label, values in (("applies_to", "Applies to", RULE_TARGETS), ("action", "Action", RULE_ACTIONS)):
+            row = len(variables)
+            ttk.Label(dialog, text=label).grid(row=row, column=0, sticky=tk.W, padx=5, pady=2)
+            variables[field] = tk.StringVar(value=spec.get(field, values[0]))
+            ttk.Combobox(dialog, textvariable=variables[field], values=values,
+                         state="readonly").grid(row=row, column=1, sticky=tk.W, padx=5, pady=2)
+
+        def save():
+            new_spec = {field: variable.get() for field, variable in variables.items() if variable.get()}
+            new_spec["enabled"] = spec.get("enabled", True)
+            specs = list(self.rule_specs)
+            if index is None:
+                specs.append(new_spec)
+            else:
+                specs[index] = new_spec
+            if self.apply_rules(specs, self.default_rule_action):
+                dialog.destroy()
+
+        button_frame = ttk.Frame(dialog)
+        button_frame.grid(row=len(variables), column=0, columnspan=2, pady=5)
+        ttk.Button(button_frame, text="Save", command=save).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="Cancel", command=dialog.destroy).pack(side=tk.LEFT, padx=5)
+
+    def load_rewrite_rules(self):
+        try:
+            if os.path.exists(self.rewrite_rules_file):
+                with open(self.rewrite_rules_file, 'r') as f:
+                    return json.load(f).get("rules", [])
+        except (OSError, ValueError) as e:
+            print(f"Error loading rewrite rules: {e}")
+        return []
+
+    def save_rewrite_rules(self):
+        try:
+            with open(self.rewrite_rules_file, 'w') as f:
+                json.dump({"rules": self.rewrite_specs}, f, indent=2)
+        except OSError as e:
+            print(f"Error saving rewrite rules: {e}")
+
+    def apply_rewrite_rules(self, specs):
+        """Save rewrite rules and send them to the proxy, returns False and reports the error if one is invalid"""
+        try:
+            encode_rewrite_rules(specs)
+        except ValueError as e:
+            messagebox.showerror("Invalid Rewrite Rule", str(e))
+            return False
+        self.rewrite_specs = specs
+        self.save_rewrite_rules()
+        self.update_rewrite_list()
+        self.send_rewrite_rules()
+        return True
+
+    def send_rewrite_rules(self):
+        """Replace the proxy's rewrite rules with the enabled ones, in the background"""
+        try:
+            body = encode_rewrite_rules(self.rewrite_specs)
+        except ValueError as e:
+            self.rewrite_status.config(text=f"Not sent to the proxy: {e}")
+            return
+        self.rewrite_version += 1
+        version = self.rewrite_version
+        self.rewrite_status.config(text="Sending to the proxy...")
+        self.run_in_background(self.control.update_rewrite_rules(version, body),
+                               lambda reply, error: self.on_rewrite_reply(version, reply, error))
+
+    def on_rewrite_reply(self, version, reply, error):
+        if version != self.rewrite_version:
+            return
+        if error is not None:
+            self.rewrite_status.config(text=f"Not sent to the proxy ({error}), use Send to Proxy once it runs")
+            return
+        reply_type, reason = reply
+        if reply_type == REWRITE_ACK:
+            active = sum(1 for spec in self.rewrite_specs if spec.get("enabled", True))
+            self.rewrite_status.config(text=f"{active} rules active in the proxy")
+            return
+
+        # "line N: reason", N counting the enabled rules
+        match = re.match(r"line (\d+): (.*)", reason, re.DOTALL)
+        enabled = [spec for spec in self.rewrite_specs if spec.get("enabled", True)]
+        if match and 0 < int(match.group(1)) <= len(enabled):
+            reason = f"rule {enabled[int(match.group(1)) - 1].get('name') or match.group(1)!r}: {match.group(2)}"
+        self.rewrite_status.config(text="Rejected by the proxy, it keeps its previous rules")
+        messagebox.showerror("Rewrite Rules", f"The proxy rejected {reason or 'the rules'}")
+
+    def create_rewrite_panel(self):
+        """Create panel for the header and body rewrite rules the proxy applies"""
+        rewrite_tab = ttk.Frame(self.notebook)
+        self.notebook.add(rewrite_tab, text='Rewrite')
+
+        columns = ("On", "Name", "Action", "Direction", "Host", "Content Type", "Find", "Replace")
+        self.rewrite_list = ttk.Treeview(rewrite_tab, columns=columns, show="headings")
+        for column, width in zip(columns, (40, 120, 100, 80, 140, 110, 260, 260)):
+            self.rewrite_list.heading(column, text=column)
+            self.rewrite_list.column(column, width=width, stretch=column in ("Find", "Replace"))
+        self.rewrite_list.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        self.rewrite_list.bind("<Double-1>", lambda event: self.edit_rewrite_rule())
+
+        button_frame = ttk.Frame(rewrite_tab)
+        button_frame.pack(fill=tk.X, padx=10, pady=5)
+        for text, command in (("Add Rule", self.add_rewrite_rule), ("Edit Rule", self.edit_rewrite_rule),
+                              ("Remove Rule", self.remove_rewrite_rule),
+                              ("Enable/Disable", self.toggle_rewrite_rule),
+                              ("Move Up", lambda: self.move_rewrite_rule(-1)),
+                              ("Move Down", lambda: self.move_rewrite_rule(1)),
+                              ("Send to Proxy", self.send_rewrite_rules)):
+            ttk.Button(button_frame, text=text, command=command).pack(side=tk.LEFT, padx=5)
+        self.rewrite_status = ttk.Label(button_frame, text="")
+        self.rewrite_status.pack(side=tk.LEFT, padx=15)
+
+        self.update_rewrite_list()
+
+    def update_rewrite_list(self):
+        self.rewrite_list.delete(*self.rewrite_list.get_children())
+        for index, spec in enumerate(self.rewrite_specs):
+            self.rewrite_list.insert("", "end", iid=str(index), values=(
+                "yes" if spec.get("enabled", True) else "no", spec.get("name", ""), spec.get("action", ""),
+                spec.get("direction", ""), spec.get("host") or "any", spec.get("content_type") or "any",
+                spec.get("find", ""), spec.get("replace", "")))
+
+    def selected_rewrite_index(self):
+        selection = self.rewrite_list.selection()
+        return int(selection[0]) if selection else None
+
+    def add_rewrite_rule(self):
+        self.open_rewrite_dialog(None)
+
+    def edit_rewrite_rule(self):
+        index = self.selected_rewrite_index()
+        if index is None:
+            messagebox.showwarning("Warning", "Please select a rewrite rule to edit")
+            return
+        self.open_rewrite_dialog(index)
+
+    def remove_rewrite_rule(self):
+        index = self.selected_rewrite_index()
+        if index is not None:
+            self.apply_rewrite_rules(self.rewrite_specs[:index] + self.rewrite_specs[index + 1:])
+
+    def toggle_rewrite_rule(self):
+        index = self.selected_rewrite_index()
+        if index is not None:
+            specs = [dict(spec) for spec in self.rewrite_specs]
+            specs[index]["enabled"] = not specs[index].get("enabled", True)
+            if self.apply_rewrite_rules(specs):
+                self.rewrite_list.selection_set(str(index))
+
+    def move_rewrite_rule(self, direction):
+        """Rewrite rules apply in list order, each one to the output of the previous"""
+        index = self.selected_rewrite_index()
+        if index is None or not 0 <= index + direction < len(self.rewrite_specs):
+            return
+        specs = list(self.rewrite_specs)
+        specs[index], specs[index + direction] = specs[index + direction], specs[index]
+        if self.apply_rewrite_rules(specs):
+            self.rewrite_list.selection_set(str(index + direction))
+
+    def open_rewrite_dialog(self, index):
+        """Form for adding a rewrite rule, or editing the one at index"""
+        spec = self.rewrite_specs[index] if index is not None else {"action": "body-replace", "direction": "response"}
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Edit Rewrite Rule" if index is not None else "Add Rewrite Rule")
+        dialog.transient(self.root)
+
+        fields = (("name", "Name"), ("host", "Host (e.g. *.example.com, empty for any)"),
+                  ("content_type", "Content type contains (body rules)"),
+                  ("find", "Header name, text or POSIX regex to find"),
+                  ("replace", "Header value or replacement (\\1 for a regex group)"))
+        variables = {}
+        for row, (field, label) in enumerate(fields):
+            ttk.Label(dialog, text=label).grid(row=row, column=0, sticky=tk.W, padx=5, pady=2)
+            variables[field] = tk.StringVar(value=spec.get(field, ""))
+            ttk.Entry(dialog, textvariable=variables[field], width=50).grid(row=row, column=1, padx=5, pady=2)
+
+        for field, label, values in (("action", "Action", REWRITE_ACTIONS),
+                                     ("direction", "Applies to", REWRITE_DIRECTIONS)):
+            row = len(variables)
+            ttk.Label(dialog, text=label).grid(row=row, column=0, sticky=tk.W, padx=5, pady=2)
+            variables[field] = tk.StringVar(value=spec.get(field, values[0]))
+            ttk.Combobox(dialog, textvariable=variables[field], values=values,
+                         state="readonly").grid(row=row, column=1, sticky=tk.W, padx=5, pady=2)
+
+        def save():
+            new_spec = {field: variable.get() for field, variable in variables.items() if variable.get()}
+            new_spec["enabled"] = spec.get("enabled", True)
+            specs = list(self.rewrite_specs)
+            if index is None:
+                specs.append(new_spec)
+            else:
+                specs[index] = new_spec
+            if self.apply_rewrite_rules(specs):
+                dialog.destroy()
+
+        button_frame = ttk.Frame(dialog)
+        button_frame.grid(row=len(variables), column=0, columnspan=2, pady=5)
+        ttk.Button(button_frame, text="Save", command=save).pack(side=tk.LEFT, padx=5)
+        ttk.Button(button_frame, text="Cancel", command=dialog.destroy).pack(side=tk.LEFT, padx=5)
+
     def start_gui_listener(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind(('127.0.0.1', 9090))
-        self.server_socket.listen(5)  # Increased to allow multiple connections
-        threading.Thread(target=self.listen_for_requests, daemon=True).start()
+        self.gui_channel = GuiChannelServer(self.gui_events, self.spool, self.rule_engine)
+        self.gui_channel.start()
+        # Control traffic shares the channel's event loop
+        self.control = ControlClient(self.gui_channel.loop)
+        self.root.after(self.GUI_EVENT_INTERVAL_MS, self.process_gui_events)
+
+        # The proxy starts with an empty blocklist and no rewrite rules, give it both
+        self.sync_blocked_domains(BLOCKLIST_REPLACE, self.blocked_domains)
+        self.send_rewrite_rules()
+        self.poll_proxy_stats()
+        self.poll_metrics()
+
+    def run_in_background(self, coroutine, on_done=None):
+        """Run a coroutine on the I/O loop; on_done(result, error) is called on the Tk thread"""
+        future = self.control.submit(coroutine)
+        if on_done is not None:
+            def report(future):
+                error = future.exception()
+                result = None if error else future.result()
+                self.ui_callbacks.put(lambda: on_done(result, error))
+            future.add_done_callback(report)
+        return future
+
+    def process_gui_events(self):
+        """Apply every frame queued by the GUI channel since the last tick"""
+        try:
+            for _ in range(self.GUI_EVENT_BATCH):
+                frame, body, connection = self.gui_events.get_nowait()
+                head = frame.head.decode(errors="replace")
+
+                if frame.type == FRAME_REQUEST:
+                    if frame.flags & FRAME_FLAG_HOLD:
+                        # Increment request ID
+                        self.current_request_id += 1
+                        waiting_request = {
+                            "id": self.current_request_id,
+                            "message_id": frame.id,
+                            "head": head,
+                            "body": body,
+                            "connection": connection
+                        }
+                        self.waiting_requests[waiting_request['id']] = waiting_request
+                        self.waiting_requests_list.insert(waiting_request['id'],
+                                                          (waiting_request['id'], self.extract_method_and_url(head)))
+                    self.add_to_history(frame, head, body)
+
+                elif frame.type == FRAME_RESPONSE:
+                    if frame.flags & FRAME_FLAG_HOLD:
+                        self.pending_responses.append((connection, frame.id, head, body))
+                        if len(self.pending_responses) == 1:
+                            self.display_response(head, body)
+                    self.add_to_history(frame, head, body)
+
+                elif frame.type == FRAME_DATA:
+                    # Full copy of a streamed response body
+                    record = self.history.complete_response(frame.id, body)
+                    if record is not None:
+                        self.index_body(record.id, record.response_headers, body)
+
+                elif frame.type == FRAME_TIMING:
+                    self.record_timing(frame)
+
+                else:
+                    print(f"Unexpected frame type from proxy: {frame.type}")
+        except queue.Empty:
+            pass
 
-    def listen_for_requests(self):
-        while True:
-            self.client_socket, _ = self.server_socket.accept()
-            data = self.client_socket.recv(20000).decode(errors="replace")
-
-            # Increment request ID
-            self.current_request_id += 1
-            
-            # Split message
-            parts = data.split("\n\n", 1)
-            self.current_message_type = parts[0] if len(parts) > 0 else ""
-            content = parts[1] if len(parts) > 1 else ""
-
-            if self.current_message_type == "REQUEST":
-                # Add to waiting requests
-                waiting_request = {
-                    "id": self.current_request_id,
-                    "content": content,
-                    "client_socket": self.client_socket
-                }
-                self.waiting_requests.append(waiting_request)
-                self.waiting_requests_queue.put(waiting_request)
-                
-                # Update waiting requests list in main thread
-                self.root.after(0, self.update_waiting_requests_list)
-            
-            elif self.current_message_type == "RESPONSE":
-                self.root.after(0, self.display_response, content)
-                self.add_to_history("RESPONSE", content)
-
-    def update_waiting_requests_list(self):
-        # Clear existing items
-        for i in self.waiting_requests_list.get_children():
-            self.waiting_requests_list.delete(i)
-        
-        # Populate with waiting requests
-        for req in self.waiting_requests:
-            self.waiting_requests_list.insert("", "end", 
-                                              iid=str(req['id']), 
-                                              values=(req['id'], 
-                                                      self.extract_method_and_url(req['content'])))
+        try:
+            while True:
+                self.ui_callbacks.get_nowait()()
+        except queue.Empty:
+            pass
+
+        self.root.after(self.GUI_EVENT_INTERVAL_MS, self.process_gui_events)
 
     def extract_method_and_url(self, request_data):
         # Extract method and URL from request
@@ -271,110 +2438,192 @@ class ProxyServerGUI:
                 return f"{parts[0]} {parts[1]}"
         return "Unknown Request"
 
-    def handle_waiting_request_selection(self, event):
+    def handle_waiting_request_selection(self, view):
         # Get selected request
-        selected_item = self.waiting_requests_list.selection()
+        selected_item = view.selection()
         if not selected_item:
             return
-        
-        request_id = int(selected_item[0])
-        
-        # Find the corresponding request
-        selected_request = next((req for req in self.waiting_requests if req['id'] == request_id), None)
-        
+
+        selected_request = self.waiting_requests.get(int(selected_item[0]))
         if selected_request:
             # Display request in request panels
-            request_data = selected_request['content']
-            self.display_request(request_data, selected_request)
+            self.display_request(selected_request)
 
     @staticmethod
     def sanitize_text(text):
         text = text.replace("\r\n", "\n").replace("\r", "\n").strip()
         return text
 
-    def split_headers_body(self, data):
-        if "\r\n\r\n" in data:
-            headers, body = data.split("\r\n\r\n", 1)
-        elif "\n\n" in data:
-            headers, body = data.split("\n\n", 1)
-        else:
-            headers, body = data, ""
-        return self.sanitize_text(headers), self.sanitize_text(body)
-
-    def display_request(self, request_data, selected_request=None):
-        request_data = self.sanitize_text(request_data)
-        if not request_data.strip():
-            return  
-
-        headers, body = self.split_headers_body(request_data)
+    def load_body_text(self, body, head=None):
+        """Read a spooled body for display, with a note on truncation or decoding at the end"""
+        text, note = self.body_view(body, head)
+        return f"{text}\n\n{note}" if note else text
+
+    def body_view(self, body, head=None):
+        """Return (text, note) of a bounded prefix of a body, decoded when its head declares codings"""
+        offset, length = body
+        if head and length and BodyDecoder.needs_decoding(head):
+            data, note = self.decoder.decode(head, body)
+            return data.decode(errors="replace"), note
+        text = self.spool.read(offset, length, self.DISPLAY_BODY_LIMIT).decode(errors="replace")
+        if length > self.DISPLAY_BODY_LIMIT:
+            return text, f"[... {length - self.DISPLAY_BODY_LIMIT} more bytes not shown]"
+        return text, None
+
+    def show_request_in_panel(self, head, body):
+        """Load a request into the request panel editors; returns False for an empty head"""
+        headers = self.sanitize_text(head)
+        if not headers:
+            return False
+
+        text, note = self.body_view(body, head)
+        body_text = self.sanitize_text(text)
+        if note:
+            body_text += f"\n\n{note}"
         self.request_headers.delete("1.0", tk.END)
         self.request_headers.insert("1.0", headers)
         self.request_body.delete("1.0", tk.END)
-        self.request_body.insert("1.0", body)
+        self.request_body.insert("1.0", body_text)
+
+        # What the body looked like, to tell edits apart when it is read back
+        self.current_request_body_text = body_text
+        self.current_request_body_note = note
+        return True
+
+    def display_request(self, selected_request):
+        if not self.show_request_in_panel(selected_request['head'], selected_request['body']):
+            return
 
         # Store the current selected request for forwarding/dropping
         self.current_selected_request = selected_request
+        self.repeater_editing = None
 
         self.request_buttons_frame.pack(fill=tk.X, pady=5)
+        self.repeater_buttons_frame.pack_forget()
         self.response_buttons_frame.pack_forget()
 
-    def display_response(self, response_data):
-        response_data = self.sanitize_text(response_data)
-        if not response_data.strip():
-            return 
+    def display_response(self, head, body):
+        headers = self.sanitize_text(head)
+        if not headers:
+            return
 
-        headers, body = self.split_headers_body(response_data)
         self.response_headers.delete("1.0", tk.END)
         self.response_headers.insert("1.0", headers)
         self.response_body.delete("1.0", tk.END)
-        self.response_body.insert("1.0", body)
+        self.response_body.insert("1.0", self.sanitize_text(self.load_body_text(body, head)))
 
         self.response_buttons_frame.pack(fill=tk.X, pady=5)
         self.request_buttons_frame.pack_forget()
 
     def forward_request(self):
         if self.current_selected_request:
-            client_socket = self.current_selected_request['client_socket']
-            client_socket.sendall("FORWARD".encode())
-            client_socket.close()
-            
-            # Remove from waiting requests
-            self.waiting_requests = [req for req in self.waiting_requests 
-                                     if req['id'] != self.current_selected_request['id']]
-            
-            # Update waiting requests list
-            self.update_waiting_requests_list()
-            
-            # Clear request display
-            self.clear_request_display()
+            connection = self.current_selected_request['connection']
+            connection.send_frame(FRAME_FORWARD, self.current_selected_request['message_id'])
+
+            # Remove from waiting requests and clear the request display
+            self.remove_request_from_waiting_list(self.current_selected_request['id'])
 
     def drop_request(self):
         if self.current_selected_request:
-            client_socket = self.current_selected_request['client_socket']
-            client_socket.sendall("DROP".encode())
-            client_socket.close()
-            
-            # Remove from waiting requests
-            self.waiting_requests = [req for req in self.waiting_requests 
-                                     if req['id'] != self.current_selected_request['id']]
-            
-            # Update waiting requests list
-            self.update_waiting_requests_list()
-            
-            # Clear request display
-            self.clear_request_display()
+            connection = self.current_selected_request['connection']
+            connection.send_frame(FRAME_DROP, self.current_selected_request['message_id'])
+
+            # Remove from waiting requests and clear the request display
+            self.remove_request_from_waiting_list(self.current_selected_request['id'])
+
+    def resolve_waiting_requests(self, verdicts):
+        """
+        Send verdicts for many waiting requests at once.
+
+        verdicts holds (request, frame type, head, body) tuples. The frames for
+        each proxy connection are written together, so the proxy wakes every
+        waiting request in the batch at once; the list redraws once afterwards.
+        """
+        by_connection = {}
+        for request, frame_type, head, body in verdicts:
+            by_connection.setdefault(request['connection'], []).append(
+                (frame_type, request['message_id'], head, body))
+        for connection, frames in by_connection.items():
+            connection.send_frames(frames)
+        for request, *_ in verdicts:
+            self.remove_request_from_waiting_list(request['id'])
+
+    def selected_waiting_requests(self):
+        return [self.waiting_requests[int(row_id)] for row_id in self.waiting_requests_list.selection()
+                if int(row_id) in self.waiting_requests]
+
+    def resolve_selected_requests(self, verdict):
+        requests = self.selected_waiting_requests()
+        if not requests:
+            messagebox.showwarning("Warning", "Please select the requests to send")
+            return
+        self.resolve_waiting_requests([(request, verdict, b"", b"") for request in requests])
+
+    def edit_selected_requests(self):
+        """Apply one find/replace to every selected request and forward them"""
+        requests = self.selected_waiting_requests()
+        if not requests:
+            messagebox.showwarning("Warning", "Please select the requests to edit")
+            return
+        find = simpledialog.askstring("Edit Selected", "Find (regex):")
+        if not find:
+            return
+        replace = simpledialog.askstring("Edit Selected", "Replace with:")
+        if replace is None:
+            return
+        try:
+            rule = RuleEngine.compile_rule({"name": "batch edit", "action": "rewrite", "find": find, "replace": replace})
+        except re.error as e:
+            messagebox.showerror("Error", f"Invalid pattern: {e}")
+            return
+
+        verdicts = []
+        for request in requests:
+            _, headers = parse_message_head(request['head'])
+            head, body = RuleEngine.rewrite(rule, request['head'], headers, self.spool.read(*request['body']))
+            verdicts.append((request, FRAME_EDIT, head, body))
+        self.resolve_waiting_requests(verdicts)
+
+    def forward_matching_requests(self):
+        """Forward every waiting request whose method and URL match the filter regex"""
+        try:
+            pattern = re.compile(self.waiting_filter_var.get(), re.IGNORECASE)
+        except re.error as e:
+            messagebox.showerror("Error", f"Invalid filter: {e}")
+            return
+        self.resolve_waiting_requests([
+            (request, FRAME_FORWARD, b"", b"") for request in self.waiting_requests.values()
+            if pattern.search(self.extract_method_and_url(request['head']))])
+
+    def forward_requests_for_host(self):
+        """Forward every waiting request for the host in the filter, or of the selected request"""
+        host = self.waiting_filter_var.get().strip().lower()
+        if not host:
+            selected = self.selected_waiting_requests()
+            if not selected:
+                messagebox.showwarning("Warning", "Select a request or enter a host in the filter")
+                return
+            host = request_summary(*parse_message_head(selected[0]['head']))[1]
+        self.resolve_waiting_requests([
+            (request, FRAME_FORWARD, b"", b"") for request in self.waiting_requests.values()
+            if request_summary(*parse_message_head(request['head']))[1] == host])
 
     def forward_response(self):
-        if self.client_socket and self.current_message_type == "RESPONSE":
-            self.client_socket.sendall("FORWARD_RESPONSE".encode())
-            self.client_socket.close()
-        self.clear_response_display()
+        self.send_response_verdict(FRAME_FORWARD)
 
     def drop_response(self):
-        if self.client_socket and self.current_message_type == "RESPONSE":
-            self.client_socket.sendall("DROP_RESPONSE".encode())
-            self.client_socket.close()
+        self.send_response_verdict(FRAME_DROP)
+
+    def send_response_verdict(self, verdict):
+        """Answer the displayed response and show the next one waiting, if any"""
         self.clear_response_display()
+        if not self.pending_responses:
+            return
+        connection, message_id, _, _ = self.pending_responses.popleft()
+        connection.send_frame(verdict, message_id)
+        if self.pending_responses:
+            _, _, head, body = self.pending_responses[0]
+            self.display_response(head, body)
 
     def clear_request_display(self):
         self.request_headers.delete("1.0", tk.END)
@@ -384,115 +2633,601 @@ class ProxyServerGUI:
         self.response_headers.delete("1.0", tk.END)
         self.response_body.delete("1.0", tk.END)
 
-    def add_to_history(self, message_type, data):
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        headers, body = self.split_headers_body(data)
-        
-        # Parse the first line to get method and URL
-        lines = headers.splitlines()
-        if not lines:
-            return  # No headers to process
-        
-        first_line = lines[0].strip()
-        parts = first_line.split(' ')
-        
-        # More flexible parsing of method, URL, and protocol
-        method = parts[0] if parts and len(parts) > 0 else "UNKNOWN"
-        url = parts[1] if parts and len(parts) > 1 else "UNKNOWN"
-        protocol = parts[2] if parts and len(parts) > 2 else "HTTP"
-
-        # Find host from headers if possible
-        host = "UNKNOWN"
-        for line in lines:
-            if line.lower().startswith("host:"):
-                host = line.split(":", 1)[1].strip()
-                break
+    def add_to_history(self, frame, head, body):
+        if frame.type == FRAME_RESPONSE:
+            # Pair the response with its request by message id
+            cache = ("revalidated" if frame.flags & FRAME_FLAG_REVALIDATED else
+                     "hit" if frame.flags & FRAME_FLAG_CACHED else "")
+            record, evicted = self.history.add_response(frame.id, head, body, cache)
+            if record is not None:
+                self.history_list.set(record.id, "Status", record.status)
+                self.history_list.set(record.id, "Cache", record.cache)
+                self.history_index.add_response(record)
+                if not frame.flags & FRAME_FLAG_PREVIEW:
+                    # A preview is indexed once its full body arrives
+                    self.index_body(record.id, head, body)
+        else:
+            record, evicted = self.history.add_request(frame.id, head, body)
+            self.history_index.add_request(record)
+            self.index_body(record.id, head, body)
+            if self.history_results is None:
+                self.history_list.insert(record.id, self.history_row(record))
+        self.history_search_stale = True
+
+        self.forget_history_records(evicted)
+
+    def forget_history_records(self, records):
+        for record in records:
+            self.history_list.delete(record.id)
+            self.history_index.remove(record.id)
+
+    def index_body(self, entry_id, head, body):
+        """Add the tokens of a bounded, decoded prefix of a textual body to the history index"""
+        if not body[1] or not HistoryIndex.indexes_body(head):
+            return
+        if BodyDecoder.needs_decoding(head):
+            data, _ = self.index_decoder.decode(head, body)
+        else:
+            data = self.spool.read(*body, limit=HistoryIndex.BODY_LIMIT)
+        self.history_index.add_body(entry_id, data.decode(errors="replace"))
 
-        # Check for duplicate response entries
-        if message_type == "RESPONSE":
-            for entry in self.history:
-                if entry["url"] == url and "response_body" not in entry:
-                    entry["response_body"] = body
-                    entry["response_headers"] = headers
-                    return
+    @staticmethod
+    def history_row(record):
+        duration = f"{record.timing['total']:.1f} ms" if record.timing and "total" in record.timing else ""
+        return (record.method, record.url, record.timestamp, record.protocol, record.status, duration, record.cache)
+
+    def search_history(self, event=None):
+        """Show the history entries matching the search box, or every entry when it is empty"""
+        started = time.perf_counter()
+        results = self.history_index.search(self.history_search_var.get())
+        elapsed = (time.perf_counter() - started) * 1000
+
+        self.history_list.clear()
+        self.history_results = results
+        self.history_cursor = 0
+        self.history_search_stale = False
+        if results is None:
+            for entry_id in sorted(self.history.entries):
+                record = self.history.entries[entry_id]
+                self.history_list.insert(record.id, self.history_row(record))
+            self.history_list.follow_tail = True
+            self.history_list.scroll_to(len(self.history_list))
+            self.history_search_status.config(text="")
+        else:
+            # Results page in as the view is scrolled to its end
+            self.history_list.follow_tail = False
+            self.load_history_page()
+            self.history_list.scroll_to(0)
+            self.history_search_status.config(text=f"{HistoryIndex.count(results)} matches ({elapsed:.1f} ms)")
+
+    def clear_history_search(self):
+        self.history_search_var.set("")
+        self.search_history()
+
+    def load_history_page(self, view=None):
+        """Append the next page of search results to the history view"""
+        if self.history_results is None:
+            return
+        page = HistoryIndex.ids(self.history_results, self.history_cursor)
+        for entry_id in itertools.islice(page, self.HISTORY_PAGE_SIZE):
+            record = self.history.entries.get(entry_id)
+            if record is not None:  # Not evicted since the search ran
+                self.history_list.insert(record.id, self.history_row(record))
+            self.history_cursor = entry_id
+
+    def refresh_history_search(self):
+        """Bring an active search up to date with the entries recorded since it ran"""
+        if self.history_results is not None and self.history_search_stale:
+            self.history_search_stale = False
+            matches = self.history_index.search(self.history_search_var.get()) or {}
+            # Entries that started matching behind the cursor, typically once their response arrived
+            late = {block: bits & ~self.history_results.get(block, 0) for block, bits in matches.items()
+                    if block << HistoryIndex.BLOCK_BITS <= self.history_cursor}
+            for entry_id in HistoryIndex.ids(late):
+                if entry_id > self.history_cursor:
+                    break
+                self.history_list.insert(entry_id, self.history_row(self.history.entries[entry_id]))
+            self.history_results = matches
+            self.history_list.dirty = True  # Pages in new matches if the view sits at its end
+            self.history_search_status.config(text=f"{HistoryIndex.count(matches)} matches")
+        self.root.after(self.HISTORY_SEARCH_REFRESH_MS, self.refresh_history_search)
+
+    def export_history(self, kind):
+        """Write the history to a HAR ("har") or session ("session") file on a worker thread"""
+        if kind == "har":
+            path = filedialog.asksaveasfilename(title="Export HAR", defaultextension=".har",
+                                                filetypes=[("HAR files", "*.har"), ("All files", "*.*")])
+        else:
+            path = filedialog.asksaveasfilename(title="Export Session", defaultextension=".pxs",
+                                                filetypes=[("Proxy sessions", "*.pxs"), ("All files", "*.*")])
+        if not path:
+            return
+        # Records are only read by the worker, bodies through the spool's lock
+        records = [self.history.entries[entry_id] for entry_id in sorted(self.history.entries)]
+        self.session_status.config(text=f"Exporting {len(records)} entries...")
+        threading.Thread(target=self.write_session, args=(kind, path, records), daemon=True).start()
 
-        # Create new history entry
-        entry = {
-            "timestamp": timestamp,
-            "type": message_type,
-            "method": method,
-            "url": url,
-            "protocol": protocol,
-            "headers": headers,
-            "body": body,
-        }
-        self.history.append(entry)
-        
-        # Update the treeview in the history list
-        self.history_list.insert("", "end", values=(method, url, timestamp, protocol))
+    def write_session(self, kind, path, records):
+        try:
+            writer = HarWriter(path, self.spool, self.HAR_BODY_LIMIT) if kind == "har" else SessionWriter(path, self.spool)
+            with writer:
+                for count, record in enumerate(records, 1):
+                    writer.write(record)
+                    if count % self.SESSION_PROGRESS_EVERY == 0:
+                        text = f"Exported {count}/{len(records)} entries"
+                        self.ui_callbacks.put(lambda text=text: self.session_status.config(text=text))
+        except (OSError, ValueError) as e:
+            error = f"Failed to export {path}: {e}"
+            self.ui_callbacks.put(lambda: self.session_failed(error))
+            return
+        text = f"Exported {len(records)} entries to {os.path.basename(path)}"
+        self.ui_callbacks.put(lambda: self.session_status.config(text=text))
+
+    def import_session(self):
+        """Load a saved session into the history; bodies stay in the file and are read when needed"""
+        path = filedialog.askopenfilename(title="Import Session",
+                                          filetypes=[("Proxy sessions", "*.pxs"), ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            reader = SessionReader(path)
+        except (OSError, SessionError) as e:
+            messagebox.showerror("Error", f"Failed to read {path}: {e}")
+            return
+        try:
+            base = self.spool.attach(path)
+        except (OSError, ValueError) as e:
+            reader.file.close()
+            messagebox.showerror("Error", f"Failed to read {path}: {e}")
+            return
+        self.session_status.config(text=f"Importing {os.path.basename(path)}...")
+        threading.Thread(target=self.read_session, args=(reader, base, path), daemon=True).start()
+
+    def read_session(self, reader, base, path):
+        """Worker thread: scan the entry heads of a session, handing them to the Tk thread a batch at a time"""
+        def relocate(body):
+            offset, length = body
+            return (base + offset, length) if length else (0, 0)
+
+        def hand_over(batch, status):
+            # Wait for the batch to be applied, so a large session never floods the Tk thread
+            applied = threading.Event()
+
+            def apply():
+                self.restore_history_entries(batch)
+                self.session_status.config(text=status)
+                applied.set()
+            self.ui_callbacks.put(apply)
+            applied.wait()
+
+        batch = []
+        count = 0
+        try:
+            with reader:
+                for meta, head, body, response_head, response_body in reader:
+                    batch.append((meta, head, relocate(body), response_head, relocate(response_body)))
+                    count += 1
+                    if len(batch) == self.SESSION_IMPORT_BATCH:
+                        hand_over(batch, f"Imported {count} entries...")
+                        batch = []
+        except (OSError, ValueError) as e:
+            # Keep what was read before the damage
+            hand_over(batch, "")
+            error = f"Stopped importing {path} after {count} entries: {e}"
+            self.ui_callbacks.put(lambda: self.session_failed(error))
+            return
+        hand_over(batch, f"Imported {count} entries from {os.path.basename(path)}")
+
+    def restore_history_entries(self, entries):
+        for meta, head, body, response_head, response_body in entries:
+            record, evicted = self.history.restore(head, body, response_head, response_body, meta.get("timestamp"),
+                                                   meta.get("cache", ""), meta.get("timing"))
+            self.history_index.add_request(record)
+            self.index_body(record.id, head, body)
+            if response_head is not None:
+                self.history_index.add_response(record)
+                self.index_body(record.id, response_head, response_body)
+            if self.history_results is None:
+                self.history_list.insert(record.id, self.history_row(record))
+            self.forget_history_records(evicted)
+        self.history_search_stale = True
+
+    def session_failed(self, error):
+        self.session_status.config(text="")
+        messagebox.showerror("Error", error)
+
+    def add_to_repeater(self, records, matched=None):
+        """Queue history entries for replay; matched counts the entries records were taken from"""
+        room = self.REPEATER_MAX_REQUESTS - len(self.repeater_requests)
+        for record in records[:room]:
+            self.repeater_requests.append({"head": record.headers, "body": record.body,
+                                           "label": f"{record.method} {record.url}", "edited": False})
+        self.update_repeater_list()
+        left_out = (len(records) if matched is None else matched) - min(room, len(records))
+        if left_out > 0:
+            messagebox.showwarning("Repeater", f"Only {self.REPEATER_MAX_REQUESTS} requests can be queued, "
+                                               f"{left_out} were left out")
+
+    def repeat_history_matches(self):
+        """Queue the entries matching the history search, or every entry when no search is active"""
+        if self.history_results is None:
+            ids, matched = iter(self.history.entries), len(self.history.entries)
+        else:
+            ids, matched = HistoryIndex.ids(self.history_results), HistoryIndex.count(self.history_results)
+        records = (self.history.entries.get(entry_id) for entry_id in ids)
+        room = self.REPEATER_MAX_REQUESTS - len(self.repeater_requests)
+        self.add_to_repeater(list(itertools.islice((record for record in records if record is not None), room)), matched)
+        self.notebook.select(self.repeater_tab)
+
+    def update_repeater_list(self):
+        self.repeater_list.delete(*self.repeater_list.get_children())
+        for index, item in enumerate(self.repeater_requests):
+            self.repeater_list.insert("", "end", iid=str(index),
+                                      values=(index + 1, item["label"], "yes" if item["edited"] else ""))
+        if self.repeater is None:
+            self.repeater_status.config(text=f"{len(self.repeater_requests)} requests queued")
+
+    def selected_repeater_indexes(self):
+        return sorted(int(iid) for iid in self.repeater_list.selection())
+
+    def edit_repeater_request(self):
+        """Load the selected queued request into the request panel for editing"""
+        indexes = self.selected_repeater_indexes()
+        if not indexes:
+            return
+        item = self.repeater_requests[indexes[0]]
+        if not self.show_request_in_panel(item["head"], item["body"]):
+            return
+        # The panel no longer shows a held request, Forward/Drop must not act on it
+        self.current_selected_request = None
+        self.repeater_editing = item
 
+        self.repeater_buttons_frame.pack(fill=tk.X, pady=5)
+        self.request_buttons_frame.pack_forget()
+        self.notebook.select(self.request_tab)
 
-    def show_history_details(self, event):
-        selected_item = self.history_list.selection()
+    def save_repeater_request(self):
+        """Store the request panel's contents in the queued request being edited"""
+        item = self.repeater_editing
+        if item is None or not any(queued is item for queued in self.repeater_requests):
+            return
+        head, raw_body, edited = self.read_request_panel(item["body"])
+        if edited:
+            # Declare the length of the new body, whatever the original framing was
+            head = BodyDecoder.decoded_head(head, len(raw_body))
+            item["body"] = self.spool.append(raw_body)
+        item["head"] = head
+        item["label"] = self.extract_method_and_url(head)
+        item["edited"] = True
+
+        self.repeater_editing = None
+        self.repeater_buttons_frame.pack_forget()
+        self.clear_request_display()
+        self.update_repeater_list()
+        self.notebook.select(self.repeater_tab)
+
+    def remove_repeater_requests(self):
+        selected = set(self.selected_repeater_indexes())
+        self.repeater_requests = [item for index, item in enumerate(self.repeater_requests) if index not in selected]
+        self.update_repeater_list()
+
+    def clear_repeater_requests(self):
+        self.repeater_requests = []
+        self.update_repeater_list()
+
+    def start_repeater(self):
+        """Replay every queued request with the repeat count, concurrency and rate of the form"""
+        if self.repeater is not None or not self.repeater_requests:
+            return
+        try:
+            repeat = int(self.repeater_repeat_var.get())
+            concurrency = int(self.repeater_concurrency_var.get())
+            rate = float(self.repeater_rate_var.get() or 0)
+            if repeat < 1 or not 1 <= concurrency <= self.REPEATER_MAX_CONCURRENCY or rate < 0:
+                raise ValueError
+        except ValueError:
+            messagebox.showerror("Repeater", f"Repeat must be at least 1, concurrency between 1 and "
+                                             f"{self.REPEATER_MAX_CONCURRENCY} and the rate 0 (no limit) or more")
+            return
+
+        requests = [Repeater.build_request(item["head"], self.spool.read(*item["body"]))
+                    for item in self.repeater_requests]
+        self.repeater_labels = [f"#{index + 1} {item['label']}" for index, item in enumerate(self.repeater_requests)]
+        self.clear_repeater_results()
+        self.repeater = Repeater(requests, repeat, concurrency, rate, host=self.control.host)
+        self.repeater_started = time.monotonic()
+        self.repeater_start_btn.config(state=tk.DISABLED)
+        self.repeater_stop_btn.config(state=tk.NORMAL)
+        self.run_in_background(self.run_repeater(self.repeater), self.repeater_finished)
+        self.root.after(self.REPEATER_REFRESH_MS, self.refresh_repeater, self.repeater)
+
+    async def run_repeater(self, repeater):
+        """Run the replays with their token registered, so the proxy does not hold them"""
+        await self.control.query(f"REPLAY_TOKEN {repeater.token}")
+        try:
+            return await repeater.run()
+        finally:
+            await self.control.query("REPLAY_TOKEN")
+
+    def stop_repeater(self):
+        if self.repeater is not None:
+            self.repeater.stop()
+            self.repeater_status.config(text="Stopping after the replays in flight...")
+
+    def refresh_repeater(self, repeater):
+        """Move finished replays into the results table while the run is going on"""
+        if self.repeater is repeater and repeater.results:
+            self.drain_repeater_results(repeater, "Stopping" if repeater.stopped else "Running")
+        if self.repeater is repeater:
+            self.root.after(self.REPEATER_REFRESH_MS, self.refresh_repeater, repeater)
+
+    def drain_repeater_results(self, repeater, state):
+        while repeater.results:
+            replay, index, status, elapsed, size, error = repeater.results.popleft()
+            label = self.repeater_labels[index]
+            self.repeater_results.insert(replay, (replay, label, status or "-", f"{elapsed:.1f}", size, error or ""))
+            self.repeater_latency.add(label, elapsed)
+            self.repeater_statuses["error" if error else status] += 1
+            self.repeater_done += 1
+
+        seconds = time.monotonic() - self.repeater_started
+        rate = self.repeater_done / seconds if seconds else 0
+        statuses = ", ".join(f"{status} x{count}" for status, count in self.repeater_statuses.most_common())
+        self.repeater_status.config(
+            text=f"{state}: {self.repeater_done}/{repeater.total} replays, {rate:.1f}/s  |  {statuses}")
+
+        self.repeater_summary.delete(*self.repeater_summary.get_children())
+        for label in self.repeater_labels:
+            count = self.repeater_latency.counts.get(label)
+            if count:
+                p50, p95, p99 = self.repeater_latency.percentiles(label)
+                self.repeater_summary.insert("", "end", values=(label, count, f"{p50:.1f}", f"{p95:.1f}", f"{p99:.1f}"))
+
+    def repeater_finished(self, stopped, error):
+        repeater, self.repeater = self.repeater, None
+        self.repeater_start_btn.config(state=tk.NORMAL)
+        self.repeater_stop_btn.config(state=tk.DISABLED)
+        self.drain_repeater_results(repeater, "Stopped" if stopped else "Finished")
+        if error is not None:
+            self.repeater_status.config(text=f"Repeater failed: {error}")
+        elif not self.repeater_done:
+            self.repeater_status.config(text="Stopped before any replay")
+
+    def clear_repeater_results(self):
+        if self.repeater is not None:
+            return
+        self.repeater_results.clear()
+        self.repeater_summary.delete(*self.repeater_summary.get_children())
+        self.repeater_latency = LatencyTracker()
+        self.repeater_statuses.clear()
+        self.repeater_done = 0
+        self.update_repeater_list()
+
+    def record_timing(self, frame):
+        """Store the phase timings of a finished exchange, in milliseconds"""
+        timing = {name[:-3]: value / 1000 for name, value in self.parse_stats(frame.body.decode(errors="replace")).items()
+                  if name.endswith("_us")}
+        record = self.history.set_timing(frame.id, timing)
+        if record is not None and "total" in timing:
+            self.history_list.set(record.id, "Duration", f"{timing['total']:.1f} ms")
+            self.latency.add(record.host, timing["total"])
+            self.latency_changed = True
+
+    def show_history_details(self, view):
+        selected_item = view.selection()
         if selected_item:
-            item = selected_item[0]
-            values = self.history_list.item(item, "values") 
-            method, url, timestamp, protocol = values
-
-          
-            for entry in self.history:
-                if entry["timestamp"] == timestamp and entry["url"] == url:
-                    self.open_details_window(entry)
-                    break
+            record = self.history.get(int(selected_item[0]))
+            if record is not None:
+                self.open_details_window(record)
 
     def open_details_window(self, entry):
         details_window = tk.Toplevel(self.root)
-        details_window.title(f"Details - {entry['method']} {entry['url']}")
+        details_window.title(f"Details - {entry.method} {entry.url}")
         details_window.geometry("800x600")
 
         content_frame = ttk.Frame(details_window)
         content_frame.pack(fill=tk.BOTH, expand=True)
 
-        request_text = scrolledtext.ScrolledText(content_frame, height=10, wrap=tk.WORD)
-        request_text.pack(fill=tk.BOTH, expand=True, pady=(5, 0))
-        request_text.insert("1.0", f"Request:\n{entry['headers']}\n\n{entry['body']}")
+        button_frame = ttk.Frame(content_frame)
+        button_frame.pack(fill=tk.X, pady=5)
 
-        if "response_headers" in entry:
-            response_text = scrolledtext.ScrolledText(content_frame, height=10, wrap=tk.WORD)
-            response_text.pack(fill=tk.BOTH, expand=True, pady=(5, 0))
-            response_text.insert("1.0", f"Response:\n{entry['response_headers']}\n\n{entry['response_body']}")
+        if entry.timing:
+            waterfall = tk.Canvas(content_frame, height=22 * (len(self.TIMING_PHASES) + 1) + 5,
+                                  background="white", highlightthickness=0)
+            waterfall.pack(fill=tk.X, padx=5)
+            waterfall.bind("<Configure>", lambda event: self.draw_waterfall(waterfall, entry.timing, event.width))
 
+        content_text = scrolledtext.ScrolledText(content_frame, wrap=tk.WORD)
+        content_text.pack(fill=tk.BOTH, expand=True, pady=(5, 0))
 
-       
         def show_request():
             content_text.delete("1.0", tk.END)
-            content_text.insert("1.0", f"{entry['headers']}\n\n{entry['body']}")
+            content_text.insert("1.0", f"{entry.headers}\n\n{self.load_body_text(entry.body, entry.headers)}")
 
         def show_response():
-          
-            response_data = entry.get("response_body", "")
-            response_headers = entry.get("response_headers", "")
             content_text.delete("1.0", tk.END)
-            content_text.insert("1.0", f"{response_headers}\n\n{response_data}")
+            if entry.response_headers is None:
+                content_text.insert("1.0", "No response received")
+                return
+            content_text.insert("1.0", f"{entry.response_headers}\n\n{self.load_body_text(entry.response_body, entry.response_headers)}")
 
-       
         request_btn = ttk.Button(button_frame, text="Show Request", command=show_request)
         request_btn.pack(side=tk.LEFT, padx=5)
 
         response_btn = ttk.Button(button_frame, text="Show Response", command=show_response)
         response_btn.pack(side=tk.LEFT, padx=5)
 
-      
+        repeat_btn = ttk.Button(button_frame, text="Send to Repeater", command=lambda: self.add_to_repeater([entry]))
+        repeat_btn.pack(side=tk.LEFT, padx=5)
+
         show_request()
 
 
+    def draw_waterfall(self, canvas, timing, width):
+        """Draw the phases of an exchange one after another, scaled to its total duration"""
+        canvas.delete("all")
+        label_width, value_width, row_height = 110, 80, 22
+        bar_width = max(1, width - label_width - value_width)
+        total = max(timing.get("total", 0), sum(timing.get(phase, 0) for phase, _, _ in self.TIMING_PHASES), 0.001)
+
+        offset = 0
+        for row, (phase, label, color) in enumerate(self.TIMING_PHASES):
+            duration = timing.get(phase, 0)
+            y = 5 + row * row_height
+            canvas.create_text(5, y + 8, anchor=tk.W, text=label)
+            if duration:
+                x = label_width + offset / total * bar_width
+                canvas.create_rectangle(x, y + 2, max(x + 2, x + duration / total * bar_width), y + 16,
+                                        fill=color, outline="")
+            canvas.create_text(width - 5, y + 8, anchor=tk.E, text=f"{duration:.1f} ms")
+            offset += duration
+
+        y = 5 + len(self.TIMING_PHASES) * row_height
+        canvas.create_text(5, y + 8, anchor=tk.W, text="Total", font=("TkDefaultFont", 9, "bold"))
+        canvas.create_text(width - 5, y + 8, anchor=tk.E, text=f"{total:.1f} ms", font=("TkDefaultFont", 9, "bold"))
+
+    def refresh_latency_view(self):
+        """Redraw the per-host percentiles when new timings arrived"""
+        if self.latency_changed:
+            self.latency_changed = False
+            self.latency_list.delete(*self.latency_list.get_children())
+            for host, count in self.latency.counts.most_common():
+                p50, p95, p99 = self.latency.percentiles(host)
+                self.latency_list.insert("", "end", values=(host, count, f"{p50:.1f}", f"{p95:.1f}", f"{p99:.1f}"))
+        self.root.after(self.LATENCY_REFRESH_MS, self.refresh_latency_view)
+
+    def create_metrics_tab(self):
+        """Create the tab charting the proxy's live metrics over a rolling window"""
+        metrics_tab = ttk.Frame(self.notebook)
+        self.notebook.add(metrics_tab, text='Metrics')
+
+        self.metrics_label = ttk.Label(metrics_tab, text="Metrics unavailable")
+        self.metrics_label.pack(fill=tk.X, padx=10, pady=5)
+
+        self.metrics_series = {key: collections.deque(maxlen=self.METRICS_WINDOW)
+                               for _, series in self.METRICS_CHARTS for key, _ in series}
+        self.previous_metrics = None
+        self.metrics_charts = []
+        for title, series in self.METRICS_CHARTS:
+            canvas = tk.Canvas(metrics_tab, height=90, background="white", highlightthickness=0)
+            canvas.pack(fill=tk.X, padx=10, pady=2)
+            self.metrics_charts.append((canvas, title, series))
+
+    def poll_metrics(self):
+        """Scrape the metrics endpoint, the next scrape starts once this one is done"""
+        def report(samples, error):
+            if error is None:
+                self.record_metrics(samples, time.monotonic())
+            else:
+                self.metrics_label.config(text=f"Metrics unavailable: {error}")
+            self.root.after(self.METRICS_POLL_INTERVAL_MS, self.poll_metrics)
+        self.run_in_background(self.control.fetch_metrics(), report)
+
+    def record_metrics(self, samples, now):
+        """Turn counters into rates against the previous scrape and redraw the charts"""
+        previous = self.previous_metrics
+        self.previous_metrics = (now, samples)
+        if previous is None:
+            return
+        elapsed = max(now - previous[0], 0.001)
+
+        def rate(name):
+            return max(0.0, samples.get(name, 0) - previous[1].get(name, 0)) / elapsed
+
+        completed = samples.get("proxy_request_duration_seconds_count", 0) - previous[1].get(
+            "proxy_request_duration_seconds_count", 0)
+        duration = samples.get("proxy_request_duration_seconds_sum", 0) - previous[1].get(
+            "proxy_request_duration_seconds_sum", 0)
+        values = {
+            "requests_rate": rate("proxy_requests_total"),
+            "requests_in_flight": samples.get("proxy_requests_in_flight", 0),
+            "connections_in_flight": samples.get("proxy_connections_in_flight", 0),
+            "intercept_queue_depth": samples.get("proxy_intercept_queue_depth", 0),
+            "bytes_in_rate": rate("proxy_client_bytes_received_total"),
+            "bytes_out_rate": rate("proxy_client_bytes_sent_total"),
+            "blocked_rate": rate("proxy_blocked_requests_total"),
+            "errors_rate": rate("proxy_upstream_errors_total"),
+            "mean_duration": 1000 * duration / completed if completed > 0 else 0.0,
+        }
+        for key, value in values.items():
+            self.metrics_series[key].append(value)
+
+        self.metrics_label.config(
+            text=f"{values['requests_rate']:.1f} req/s  |  {values['requests_in_flight']:.0f} in flight  |  "
+                 f"queue {values['intercept_queue_depth']:.0f}  |  "
+                 f"in {values['bytes_in_rate'] / 1024:.1f} KiB/s, out {values['bytes_out_rate'] / 1024:.1f} KiB/s  |  "
+                 f"{samples.get('proxy_requests_total', 0):.0f} requests total")
+        for canvas, title, series in self.metrics_charts:
+            self.draw_chart(canvas, title, series)
+
+    def draw_chart(self, canvas, title, series):
+        """Line chart of a few series over the metrics window, scaled to their maximum"""
+        canvas.delete("all")
+        width, height = max(canvas.winfo_width(), 200), int(canvas.cget("height"))
+        top, bottom = 18, height - 4
+        peak = max([max(self.metrics_series[key], default=0) for key, _ in series] + [1e-9])
+
+        current = ", ".join(f"{self.metrics_series[key][-1]:.1f}" for key, _ in series if self.metrics_series[key])
+        canvas.create_text(5, 2, anchor=tk.NW, text=f"{title}: {current}")
+        canvas.create_text(width - 5, 2, anchor=tk.NE, text=f"max {peak:.1f}", fill="#666666")
+        canvas.create_line(0, bottom, width, bottom, fill="#dddddd")
+
+        step = width / max(1, self.METRICS_WINDOW - 1)
+        for key, color in series:
+            values = self.metrics_series[key]
+            offset = self.METRICS_WINDOW - len(values)
+            points = []
+            for index, value in enumerate(values):
+                points.extend(((offset + index) * step, bottom - value / peak * (bottom - top)))
+            if len(points) >= 4:
+                canvas.create_line(*points, fill=color, width=2)
+
     def send_intercept_command(self, command):
-        try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect(('127.0.0.1', 9091))
-                s.sendall(command.encode())
-        except Exception as e:
-            print(f"Failed to send intercept command: {e}")
+        def report(reply, error):
+            if error is not None:
+                print(f"Failed to send intercept command: {error}")
+        self.run_in_background(self.control.query(command), report)
+
+    @staticmethod
+    def parse_stats(text):
+        stats = {}
+        for line in text.splitlines():
+            name, _, value = line.partition(" ")
+            try:
+                stats[name] = float(value)
+            except ValueError:
+                pass
+        return stats
+
+    def poll_proxy_stats(self):
+        """Fetch proxy statistics for the control panel, the next poll starts once this one is done"""
+        def report(reply, error):
+            self.show_proxy_stats(self.parse_stats(reply) if error is None else None)
+            self.root.after(int(self.STATS_POLL_INTERVAL * 1000), self.poll_proxy_stats)
+        self.run_in_background(self.control.query("STATS"), report)
+
+    def show_proxy_stats(self, stats):
+        if not stats:
+            self.stats_label.config(text="Proxy statistics unavailable")
+            return
+        hits = stats.get("pool_hits", 0)
+        lookups = hits + stats.get("pool_misses", 0)
+        hit_rate = 100 * hits / lookups if lookups else 0
+        connections = stats.get("client_connections", 0)
+        requests_per_connection = stats.get("client_requests", 0) / connections if connections else 0
+        dns_hits = stats.get("dns_hits", 0) + stats.get("dns_negative_hits", 0) + stats.get("dns_coalesced", 0)
+        dns_lookups = dns_hits + stats.get("dns_misses", 0)
+        dns_hit_rate = 100 * dns_hits / dns_lookups if dns_lookups else 0
+        cache_hits = stats.get("cache_hits", 0) + stats.get("cache_revalidated", 0)
+        cache_lookups = stats.get("cache_lookups", 0)
+        cache_hit_rate = 100 * cache_hits / cache_lookups if cache_lookups else 0
+        self.stats_label.config(
+            text=f"Upstream pool: {hit_rate:.0f}% hits ({hits:.0f}/{lookups:.0f}), "
+                 f"{stats.get('pool_idle', 0):.0f} idle  |  "
+                 f"DNS cache: {dns_hit_rate:.0f}% hits ({dns_hits:.0f}/{dns_lookups:.0f})  |  "
+                 f"Response cache: {cache_hit_rate:.0f}% hits ({cache_hits:.0f}/{cache_lookups:.0f}), "
+                 f"{stats.get('cache_memory_bytes', 0) / 1048576:.1f} MiB  |  "
+                 f"Client keep-alive: {requests_per_connection:.1f} requests/connection")
 
     def toggle_intercept(self):
         self.intercept_enabled = not self.intercept_enabled
@@ -516,21 +3251,42 @@ class ProxyServerGUI:
         waiting_requests_label = ttk.Label(waiting_requests_frame, text="Waiting Requests")
         waiting_requests_label.pack(fill=tk.X, pady=(5,0))
         
-        self.waiting_requests_list = ttk.Treeview(waiting_requests_frame, 
-                                                  columns=("ID", "Request"), 
-                                                  show="headings")
-        self.waiting_requests_list.heading("ID", text="Request ID")
-        self.waiting_requests_list.heading("Request", text="Request Details")
+        self.waiting_requests_list = VirtualListView(waiting_requests_frame,
+                                                     columns=("ID", "Request"),
+                                                     headings=("Request ID", "Request Details"),
+                                                     selectmode="extended")
         self.waiting_requests_list.pack(fill=tk.BOTH, expand=True)
-        
+
         # Bind selection event
-        self.waiting_requests_list.bind("<<TreeviewSelect>>", self.handle_waiting_request_selection)
+        self.waiting_requests_list.bind_select(self.handle_waiting_request_selection)
+
+        # Batch actions on every selected request
+        batch_frame = ttk.Frame(waiting_requests_frame)
+        batch_frame.pack(fill=tk.X, pady=(5, 0))
+        ttk.Button(batch_frame, text="Forward Selected",
+                   command=lambda: self.resolve_selected_requests(FRAME_FORWARD)).pack(side=tk.LEFT, padx=2)
+        ttk.Button(batch_frame, text="Drop Selected",
+                   command=lambda: self.resolve_selected_requests(FRAME_DROP)).pack(side=tk.LEFT, padx=2)
+        ttk.Button(batch_frame, text="Edit Selected...",
+                   command=self.edit_selected_requests).pack(side=tk.LEFT, padx=2)
+
+        # Actions on every waiting request matching a filter or a host
+        filter_frame = ttk.Frame(waiting_requests_frame)
+        filter_frame.pack(fill=tk.X, pady=5)
+        self.waiting_filter_var = tk.StringVar()
+        ttk.Entry(filter_frame, textvariable=self.waiting_filter_var).pack(side=tk.LEFT, fill=tk.X, expand=True, padx=2)
+        ttk.Button(filter_frame, text="Forward Matching",
+                   command=self.forward_matching_requests).pack(side=tk.LEFT, padx=2)
+        ttk.Button(filter_frame, text="Forward Host",
+                   command=self.forward_requests_for_host).pack(side=tk.LEFT, padx=2)
 
     def create_control_panel(self):
         control_frame = ttk.LabelFrame(self.main_frame, text="Controls", padding="5")
         control_frame.pack(fill=tk.X, pady=5)
         self.intercept_btn = ttk.Button(control_frame, text="Intercept: ON", command=self.toggle_intercept)
         self.intercept_btn.pack(side=tk.LEFT, padx=5)
+        self.stats_label = ttk.Label(control_frame, text="Proxy statistics unavailable")
+        self.stats_label.pack(side=tk.RIGHT, padx=5)
 
     def create_request_panel(self):
         request_frame = ttk.Frame(self.h_paned)
@@ -538,7 +3294,7 @@ class ProxyServerGUI:
         self.notebook = ttk.Notebook(request_frame)
         self.notebook.pack(fill=tk.BOTH, expand=True)
 
-        request_tab = ttk.Frame(self.notebook)
+        request_tab = self.request_tab = ttk.Frame(self.notebook)
         self.notebook.add(request_tab, text='Request')
         headers_frame = ttk.LabelFrame(request_tab, text="Headers", padding="5")
         headers_frame.pack(fill=tk.BOTH, expand=True)
@@ -558,6 +3314,11 @@ class ProxyServerGUI:
         self.save_and_forward_btn = ttk.Button(self.request_buttons_frame, text="Save & Forward Request", command=self.save_and_forward_request)
         self.save_and_forward_btn.pack(side=tk.LEFT, padx=5)
 
+        # Shown instead while a request queued in the repeater is being edited
+        self.repeater_buttons_frame = ttk.Frame(request_tab)
+        ttk.Button(self.repeater_buttons_frame, text="Save to Repeater",
+                   command=self.save_repeater_request).pack(side=tk.LEFT, padx=5)
+
 
     def create_response_panel(self):
         response_frame = ttk.Frame(self.h_paned)
@@ -585,17 +3346,108 @@ class ProxyServerGUI:
         history_tab = ttk.Frame(self.notebook)
         self.notebook.add(history_tab, text='History')
 
-        self.history_list = ttk.Treeview(history_tab, columns=("Method", "URL", "Time", "Protocol"), show="headings")
-        self.history_list.heading("Method", text="Method")
-        self.history_list.heading("URL", text="URL")
-        self.history_list.heading("Time", text="Time")
-        self.history_list.heading("Protocol", text="Protocol")
+        # Search by field ("method:post host:example.com status:4xx header:etag value:gzip body:token") or any field
+        search_frame = ttk.Frame(history_tab)
+        search_frame.pack(fill=tk.X, pady=5)
+        self.history_search_var = tk.StringVar()
+        search_entry = ttk.Entry(search_frame, textvariable=self.history_search_var)
+        search_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=2)
+        search_entry.bind("<Return>", self.search_history)
+        ttk.Button(search_frame, text="Search", command=self.search_history).pack(side=tk.LEFT, padx=2)
+        ttk.Button(search_frame, text="Clear", command=self.clear_history_search).pack(side=tk.LEFT, padx=2)
+        self.history_search_status = ttk.Label(search_frame, text="")
+        self.history_search_status.pack(side=tk.LEFT, padx=5)
+
+        # Saving the history to a file and loading it back
+        session_frame = ttk.Frame(history_tab)
+        session_frame.pack(fill=tk.X)
+        ttk.Button(session_frame, text="Export HAR...",
+                   command=lambda: self.export_history("har")).pack(side=tk.LEFT, padx=2)
+        ttk.Button(session_frame, text="Export Session...",
+                   command=lambda: self.export_history("session")).pack(side=tk.LEFT, padx=2)
+        ttk.Button(session_frame, text="Import Session...", command=self.import_session).pack(side=tk.LEFT, padx=2)
+        ttk.Button(session_frame, text="Repeat Matches", command=self.repeat_history_matches).pack(side=tk.LEFT, padx=2)
+        self.session_status = ttk.Label(session_frame, text="")
+        self.session_status.pack(side=tk.LEFT, padx=5)
+
+        self.history_list = VirtualListView(history_tab,
+                                            columns=("Method", "URL", "Time", "Protocol", "Status", "Duration", "Cache"),
+                                            follow_tail=True)
         self.history_list.pack(fill=tk.BOTH, expand=True)
-        self.history_list.bind("<<TreeviewSelect>>", self.show_history_details)
+        self.history_list.bind_select(self.show_history_details)
+        self.history_list.bind_tail(self.load_history_page)
+        self.root.after(self.HISTORY_SEARCH_REFRESH_MS, self.refresh_history_search)
+
+        # Running percentiles of the exchange duration per host
+        latency_frame = ttk.LabelFrame(history_tab, text="Latency by host (ms)", padding="5")
+        latency_frame.pack(fill=tk.X)
+        columns = ("Host", "Requests", "p50", "p95", "p99")
+        self.latency_list = ttk.Treeview(latency_frame, columns=columns, show="headings", height=6)
+        for column in columns:
+            self.latency_list.heading(column, text=column)
+            self.latency_list.column(column, width=200 if column == "Host" else 70, stretch=column == "Host")
+        self.latency_list.pack(fill=tk.X)
+        self.root.after(self.LATENCY_REFRESH_MS, self.refresh_latency_view)
+
+    def create_repeater_tab(self):
+        """Create the tab replaying history entries through the proxy"""
+        repeater_tab = self.repeater_tab = ttk.Frame(self.notebook)
+        self.notebook.add(repeater_tab, text='Repeater')
+
+        # Queued requests, from the history and optionally edited in the request panel
+        queue_frame = ttk.LabelFrame(repeater_tab, text="Requests", padding="5")
+        queue_frame.pack(fill=tk.X, padx=5, pady=5)
+        columns = ("#", "Request", "Edited")
+        self.repeater_list = ttk.Treeview(queue_frame, columns=columns, show="headings", height=6)
+        for column in columns:
+            self.repeater_list.heading(column, text=column)
+            self.repeater_list.column(column, width=500 if column == "Request" else 60, stretch=column == "Request")
+        self.repeater_list.pack(fill=tk.X)
+        queue_buttons = ttk.Frame(queue_frame)
+        queue_buttons.pack(fill=tk.X, pady=(5, 0))
+        ttk.Button(queue_buttons, text="Edit in Request Panel",
+                   command=self.edit_repeater_request).pack(side=tk.LEFT, padx=2)
+        ttk.Button(queue_buttons, text="Remove", command=self.remove_repeater_requests).pack(side=tk.LEFT, padx=2)
+        ttk.Button(queue_buttons, text="Clear", command=self.clear_repeater_requests).pack(side=tk.LEFT, padx=2)
+
+        run_frame = ttk.Frame(repeater_tab)
+        run_frame.pack(fill=tk.X, padx=5)
+        self.repeater_repeat_var = tk.StringVar(value="1")
+        self.repeater_concurrency_var = tk.StringVar(value="1")
+        self.repeater_rate_var = tk.StringVar(value="0")
+        for label, variable in (("Repeat:", self.repeater_repeat_var), ("Concurrency:", self.repeater_concurrency_var),
+                                ("Rate (req/s, 0 = no limit):", self.repeater_rate_var)):
+            ttk.Label(run_frame, text=label).pack(side=tk.LEFT, padx=(5, 2))
+            ttk.Entry(run_frame, textvariable=variable, width=8).pack(side=tk.LEFT)
+        self.repeater_start_btn = ttk.Button(run_frame, text="Start", command=self.start_repeater)
+        self.repeater_start_btn.pack(side=tk.LEFT, padx=(10, 2))
+        self.repeater_stop_btn = ttk.Button(run_frame, text="Stop", command=self.stop_repeater, state=tk.DISABLED)
+        self.repeater_stop_btn.pack(side=tk.LEFT, padx=2)
+        ttk.Button(run_frame, text="Clear Results", command=self.clear_repeater_results).pack(side=tk.LEFT, padx=2)
+        self.repeater_status = ttk.Label(repeater_tab, text="0 requests queued")
+        self.repeater_status.pack(fill=tk.X, padx=10, pady=5)
+
+        # Latency percentiles per queued request over its recent replays
+        summary_frame = ttk.LabelFrame(repeater_tab, text="Latency by request (ms)", padding="5")
+        summary_frame.pack(fill=tk.X, padx=5)
+        columns = ("Request", "Replays", "p50", "p95", "p99")
+        self.repeater_summary = ttk.Treeview(summary_frame, columns=columns, show="headings", height=4)
+        for column in columns:
+            self.repeater_summary.heading(column, text=column)
+            self.repeater_summary.column(column, width=300 if column == "Request" else 70, stretch=column == "Request")
+        self.repeater_summary.pack(fill=tk.X)
+
+        self.repeater_results = VirtualListView(repeater_tab,
+                                                columns=("Replay", "Request", "Status", "Latency (ms)", "Bytes", "Error"),
+                                                follow_tail=True)
+        self.repeater_results.pack(fill=tk.BOTH, expand=True, padx=5, pady=5)
 
     def on_closing(self):
-        if self.server_socket:
-            self.server_socket.close()
+        if self.blocked_domains.log_lines:
+            self.blocked_domains.compact()
+        if self.gui_channel:
+            self.gui_channel.stop()
+        self.spool.close()
         self.root.destroy()
 
 
@@ -1,85 +1,3001 @@
+#define _GNU_SOURCE  // memmem
 #include <stdio.h>
 #include <stdlib.h>
+#include <stdint.h>
 #include <string.h>
+#include <ctype.h>
+#include <dirent.h>
+#include <limits.h>
+#include <sched.h>
+#include <stdatomic.h>
 #include <unistd.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <fnmatch.h>
+#include <regex.h>
 #include <arpa/inet.h>
+#include <netinet/tcp.h>
 #include <pthread.h>
 #include <netdb.h>
 #include <http_parser.h>
+#include <sys/epoll.h>
+#include <sys/eventfd.h>
 #include <sys/socket.h>
+#include <sys/uio.h>
+#include <sys/stat.h>
 #include <sys/time.h>
 #include <time.h>
-#include <jansson.h>  // JSON parsing library
-#include <openssl/bio.h>
+#include <openssl/crypto.h>
 #include <openssl/evp.h>
+#include <openssl/rand.h>
 
-#define MAX_CREDENTIALS 100
-#define MAX_USERNAME_LENGTH 50
-#define MAX_PASSWORD_LENGTH 50
 #define CREDENTIALS_FILE "credentials.txt"
+#define CREDENTIALS_POLL_SECONDS 2  // How often the credentials file is checked for changes
+#define CREDENTIAL_MAX_SALT 64
+#define CREDENTIAL_HASH_SIZE 32
+#define CREDENTIAL_PLAIN_ITERATIONS 1  // For plaintext file entries, the file holds the password anyway
+#define CREDENTIAL_MAX_ITERATIONS 10000000
+#define AUTH_CACHE_SLOTS 1024
+#define AUTH_CACHE_TTL_SECONDS 300  // How long a verified Authorization token skips verification
+#define MAX_AUTH_TOKEN 512
 
 #define BUFFER_SIZE 100000
 #define PROXY_PORT 8080
 #define GUI_PORT 9090  // Port for GUI communication
 #define INTERCEPT_PORT 9091  // Port for intercept toggle control
 #define BLOCKED_DOMAINS_PORT 9092  // Port for blocked domains update
-#define MAX_HISTORY 1000
-#define MAX_BLOCKED_DOMAINS 100
+#define METRICS_PORT 9093  // Prometheus text metrics over HTTP, on the loopback interface
+#define REWRITE_PORT 9094  // Rewrite rule updates, only accepted on the loopback interface
+#define MAX_HEAD_SIZE 65536  // Largest accepted response start line and headers
+#define RELAY_CHUNK_SIZE 65536  // Bytes moved per recv while relaying a response
+#define STREAM_PREVIEW_SIZE 65536  // Body bytes the GUI gets before switching to a streamed copy
+#define INTERCEPT_MAX_RESPONSE (32 * 1024 * 1024)  // Larger responses are streamed instead of held
+#define UPSTREAM_TIMEOUT_SECONDS 30
+#define GUI_RECONNECT_INTERVAL 1  // Seconds between connection attempts for notifications
+#define CLIENT_IDLE_TIMEOUT_SECONDS 15  // Keep-alive client connections are closed after this
+#define CLIENT_SEND_TIMEOUT_SECONDS 10  // A client that reads nothing for this long is dropped instead of holding a worker
+#define CLIENT_BUFFER_SIZE 4096  // First request buffer of a connection, grown up to BUFFER_SIZE
+#define WORKER_THREADS 32  // Threads running exchanges, connections waiting on the client or the GUI take none
+#define EVENT_BATCH 256  // Readiness events handled per epoll_wait
+#define POOL_MAX_IDLE_PER_HOST 8  // Idle upstream connections kept per host
+#define POOL_IDLE_TIMEOUT_SECONDS 30
+#define POOL_BUCKETS 256
+#define DNS_CACHE_BUCKETS 512
+#define DNS_POSITIVE_TTL_SECONDS 60
+#define DNS_NEGATIVE_TTL_SECONDS 10  // Failed lookups are remembered for this long
+#define CACHE_BUCKETS 1024
+#define CACHE_KEY_SIZE 1536
+#define CACHE_MAX_BYTES (64 * 1024 * 1024)  // Response bytes kept in memory
+#define CACHE_MAX_OBJECT_SIZE (4 * 1024 * 1024)  // Larger responses are not stored
+#define CACHE_DISK_MAX_BYTES (1024LL * 1024 * 1024)  // Response bytes kept in the cache directory
+#define CACHE_HEURISTIC_MAX_SECONDS 86400  // Cap of the lifetime derived from Last-Modified
+#define CACHE_FETCH_WAIT_SECONDS 5  // Longest wait for another request's fetch, the waiter holds a worker
+#define CACHE_VALIDATORS_SIZE 1024  // Room for the validator headers added to a revalidation
+#define REWRITE_MAX_MATCH 4096  // Body bytes a regex rewrite rule looks ahead across pieces of a stream
 
 
 
 typedef struct {
-    char username[MAX_USERNAME_LENGTH];
-    char password[MAX_PASSWORD_LENGTH];
-} Credential;
+    char url[1024];
+} http_request;
+
+int intercept_enabled = 1;
+pthread_mutex_t intercept_lock;
+
+/*
+ * Requests replayed by the GUI's repeater carry REPLAY_HEADER with the token
+ * the GUI registered for the run on INTERCEPT_PORT. The header is removed from
+ * every request before it goes anywhere; a request with the current token is
+ * neither held nor is its response, so a run leaves intercept on for the rest.
+ */
+#define REPLAY_HEADER "X-Proxy-Replay"
+#define REPLAY_TOKEN_SIZE 64
+char replay_token[REPLAY_TOKEN_SIZE + 1] = "";  // Guarded by intercept_lock, empty outside a run
 
-Credential valid_credentials[MAX_CREDENTIALS];
-int credentials_count = 0;
+/*
+ * Live metrics, updated with atomic operations from every worker so the hot
+ * path never takes a lock for them. Served on METRICS_PORT.
+ */
+#define DURATION_BUCKETS 12
+const double duration_bucket_bounds[DURATION_BUCKETS] = {
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+};
 
 typedef struct {
-    char method[8];
-    char url[1024];
-    char headers[BUFFER_SIZE];
-    char body[BUFFER_SIZE];
-    size_t body_length;
-} http_request;
+    atomic_ulong requests;
+    atomic_long connections_in_flight;
+    atomic_long requests_in_flight;
+    atomic_long intercept_queue_depth;  // Messages waiting for a GUI verdict
+    atomic_ullong client_bytes_received;
+    atomic_ullong client_bytes_sent;
+    atomic_ulong blocked_requests;
+    atomic_ulong upstream_errors;
+    atomic_ulong duration_buckets[DURATION_BUCKETS];  // Not cumulative, summed when formatted
+    atomic_ulong duration_count;
+    atomic_ullong duration_sum_us;
+} proxy_metrics_t;
+
+proxy_metrics_t metrics;
+
+void observe_request_duration(long long duration_us) {
+    int bucket = 0;
+    while (bucket < DURATION_BUCKETS && duration_us > duration_bucket_bounds[bucket] * 1000000) bucket++;
+    if (bucket < DURATION_BUCKETS) atomic_fetch_add(&metrics.duration_buckets[bucket], 1);
+    atomic_fetch_add(&metrics.duration_count, 1);
+    atomic_fetch_add(&metrics.duration_sum_us, duration_us);
+}
+
+
+/*
+ * Blocklist matcher. Domains are kept in immutable hash sets that are looked
+ * up once per label suffix of the host, so "ads.example.com" probes
+ * "ads.example.com", "example.com" and "com". A snapshot is a large base set
+ * plus a small overlay holding the domains changed since the base was built;
+ * deltas only rebuild the overlay and fold it into a new base once it grows.
+ * Snapshots are published with one atomic pointer swap, so lookups never take
+ * a lock, and a retired snapshot is freed once no lookup can still see it.
+ */
+#define BLOCK_DOMAIN 0x1      // Listed as "example.com": the domain and every name below it
+#define BLOCK_SUBDOMAINS 0x2  // Listed as "*.example.com": only the names below the domain
+#define BLOCKLIST_MIN_COMPACT 4096  // Overlay entries always allowed before folding into the base
 
 typedef struct {
-    char method[8];
-    char url[1024];
-    char protocol[16];
-    char host[256];
-    time_t timestamp;
-    char request_data[BUFFER_SIZE];
-    char response_data[BUFFER_SIZE];
-} history_entry;
+    const char* name;
+    unsigned int hash;
+    int flags;  // 0 in an overlay marks a domain removed from the base
+} domain_slot;
 
-http_request current_request;
-history_entry history[MAX_HISTORY];
-int history_count = 0;
+typedef struct {
+    domain_slot* slots;
+    size_t mask;
+    char* names;  // Every domain name, back to back
+    size_t names_used;
+    int count;
+    int refs;  // Snapshots sharing this set, only touched by the updating thread
+} domain_set;
 
-int intercept_enabled = 1;
-pthread_mutex_t intercept_lock;
+typedef struct {
+    domain_set* base;
+    domain_set* overlay;  // NULL right after a rebuild
+    uint32_t version;
+    int count;  // Blocklist entries in this snapshot, a domain listed in both forms counts twice
+} blocklist_t;
+
+_Atomic(blocklist_t*) active_blocklist = NULL;
+atomic_uint blocklist_epoch = 0;
+atomic_uint blocklist_readers[2];
+pthread_mutex_t blocked_domains_lock;  // Serializes updates only
+
+unsigned int domain_hash(const char* name, size_t length) {
+    unsigned int hash = 2166136261u;
+    for (size_t i = 0; i < length; i++) hash = (hash ^ (unsigned char)name[i]) * 16777619u;
+    return hash;
+}
+
+domain_slot* domain_set_find(const domain_set* set, const char* name, size_t length, unsigned int hash) {
+    for (size_t i = hash & set->mask;; i = (i + 1) & set->mask) {
+        domain_slot* slot = &set->slots[i];
+        if (slot->name == NULL) return slot;
+        if (slot->hash == hash && strncmp(slot->name, name, length) == 0 && slot->name[length] == '\0') return slot;
+    }
+}
+
+// Flags of a domain in a set, or -1 when the set does not mention it
+int domain_set_flags(const domain_set* set, const char* name, size_t length, unsigned int hash) {
+    if (set == NULL) return -1;
+    domain_slot* slot = domain_set_find(set, name, length, hash);
+    return slot->name != NULL ? slot->flags : -1;
+}
+
+// Allocates a set sized for at most entries domains taking names_size bytes
+domain_set* domain_set_create(size_t entries, size_t names_size) {
+    size_t capacity = 16;
+    while (capacity < entries * 2) capacity <<= 1;
+
+    domain_set* set = calloc(1, sizeof(domain_set));
+    if (set == NULL) return NULL;
+    set->slots = calloc(capacity, sizeof(domain_slot));
+    set->names = malloc(names_size + 1);
+    if (set->slots == NULL || set->names == NULL) {
+        free(set->slots);
+        free(set->names);
+        free(set);
+        return NULL;
+    }
+    set->mask = capacity - 1;
+    set->refs = 1;
+    return set;
+}
+
+void domain_set_release(domain_set* set) {
+    if (set == NULL || --set->refs > 0) return;
+    free(set->slots);
+    free(set->names);
+    free(set);
+}
+
+// Returns the slot for name, adding it with initial_flags if it is missing
+domain_slot* domain_set_add(domain_set* set, const char* name, size_t length, unsigned int hash, int initial_flags) {
+    domain_slot* slot = domain_set_find(set, name, length, hash);
+    if (slot->name == NULL) {
+        char* copy = set->names + set->names_used;
+        memcpy(copy, name, length);
+        copy[length] = '\0';
+        set->names_used += length + 1;
+        slot->name = copy;
+        slot->hash = hash;
+        slot->flags = initial_flags;
+        set->count++;
+    }
+    return slot;
+}
+
+/*
+ * Normalizes a blocklist entry in place and returns its match flag, or 0 for
+ * an empty entry. Both forms of a domain share one slot but keep their own
+ * flag, so each is added and removed independently like in the GUI list.
+ */
+int normalize_blocked_domain(char* domain) {
+    int flags = BLOCK_DOMAIN;
+    char* start = domain;
+    while (isspace((unsigned char)*start)) start++;
+    if (start[0] == '*' && start[1] == '.') {
+        flags = BLOCK_SUBDOMAINS;
+        start += 2;
+    }
+    while (*start == '.') start++;
 
+    size_t length = strlen(start);
+    while (length > 0 && (isspace((unsigned char)start[length - 1]) || start[length - 1] == '.')) length--;
+    for (size_t i = 0; i < length; i++) domain[i] = tolower((unsigned char)start[i]);
+    domain[length] = '\0';
+    return length > 0 ? flags : 0;
+}
+
+// Blocklist entries a slot stands for, one per listed form of the domain
+int blocked_entries(int flags) {
+    return ((flags & BLOCK_DOMAIN) != 0) + ((flags & BLOCK_SUBDOMAINS) != 0);
+}
+
+void blocklist_free(blocklist_t* list) {
+    if (list == NULL) return;
+    domain_set_release(list->base);
+    domain_set_release(list->overlay);
+    free(list);
+}
+
+// Publishes a new blocklist and frees the old one once no lookup can still use it
+void blocklist_publish(blocklist_t* list) {
+    blocklist_t* retired = atomic_exchange(&active_blocklist, list);
 
-char blocked_domains[MAX_BLOCKED_DOMAINS][256];
-int blocked_domains_count = 0;
-pthread_mutex_t blocked_domains_lock;
+    // Two epoch flips, so a lookup that read a stale epoch is waited for as well
+    for (int round = 0; round < 2; round++) {
+        unsigned int previous = atomic_fetch_add(&blocklist_epoch, 1) & 1;
+        while (atomic_load(&blocklist_readers[previous]) != 0) sched_yield();
+    }
+    blocklist_free(retired);
+}
 
 int is_domain_blocked(const char* host) {
-    pthread_mutex_lock(&blocked_domains_lock);
-    
-    for (int i = 0; i < blocked_domains_count; i++) {
-        if (strstr(host, blocked_domains[i]) != NULL) {
-            pthread_mutex_unlock(&blocked_domains_lock);
-            return 1;
+    char name[256];
+    size_t length = strlen(host);
+    if (length == 0 || length >= sizeof(name)) return 0;
+    for (size_t i = 0; i < length; i++) name[i] = tolower((unsigned char)host[i]);
+    while (length > 0 && name[length - 1] == '.') length--;
+    name[length] = '\0';
+
+    unsigned int epoch = atomic_load(&blocklist_epoch) & 1;
+    atomic_fetch_add(&blocklist_readers[epoch], 1);
+    blocklist_t* list = atomic_load(&active_blocklist);
+
+    int blocked = 0;
+    if (list != NULL && list->count > 0) {
+        int required = BLOCK_DOMAIN;
+        for (const char* suffix = name; suffix != NULL && *suffix; required = BLOCK_DOMAIN | BLOCK_SUBDOMAINS) {
+            size_t suffix_length = length - (suffix - name);
+            unsigned int hash = domain_hash(suffix, suffix_length);
+            int flags = domain_set_flags(list->overlay, suffix, suffix_length, hash);
+            if (flags < 0) flags = domain_set_flags(list->base, suffix, suffix_length, hash);
+            if (flags > 0 && (flags & required)) {
+                blocked = 1;
+                break;
+            }
+            suffix = strchr(suffix, '.');
+            if (suffix != NULL) suffix++;
         }
     }
-    
-    pthread_mutex_unlock(&blocked_domains_lock);
+
+    atomic_fetch_sub(&blocklist_readers[epoch], 1);
+    return blocked;
+}
+
+int on_url(http_parser* parser, const char* at, size_t length) {
+    http_request* request = parser->data;
+    size_t used = strlen(request->url);
+    if (length > sizeof(request->url) - 1 - used) length = sizeof(request->url) - 1 - used;
+    memcpy(request->url + used, at, length);
+    request->url[used + length] = '\0';
+    return 0;
+}
+
+int on_message_complete(http_parser* parser) {
     return 0;
 }
 
+// Parses a request into the caller's http_request, every exchange has its own
+void parse_http_request(const char* request, size_t length, http_request* parsed) {
+    http_parser parser;
+    http_parser_init(&parser, HTTP_REQUEST);
+    parser.data = parsed;
+
+    http_parser_settings settings;
+    memset(&settings, 0, sizeof(settings));
+    settings.on_url = on_url;
+    settings.on_message_complete = on_message_complete;
+
+    memset(parsed, 0, sizeof(*parsed));
+    http_parser_execute(&parser, &settings, request, length);
+}
+
+
+/*
+ * Proxy <-> GUI channel framing. Every message in both directions is one frame:
+ *
+ *   magic "PX" | version u8 | type u8 | flags u16 | message id u32 | head length u32 | body length u32
+ *
+ * followed by the head section (start line and headers) and the body section.
+ * All integers are in network byte order. The REQUEST and RESPONSE frames of one
+ * proxied exchange share a message id, and verdicts (FORWARD, DROP, EDIT) answer
+ * with the id of the frame they decide on.
+ */
+#define FRAME_MAGIC "PX"
+#define FRAME_VERSION 1
+#define FRAME_HEADER_SIZE 18
+#define FRAME_MAX_SECTION (64 * 1024 * 1024)
+
+#define FRAME_REQUEST 1
+#define FRAME_RESPONSE 2
+#define FRAME_FORWARD 3
+#define FRAME_DROP 4
+#define FRAME_EDIT 5
+#define FRAME_DATA 6  // More body bytes of a streamed message
+#define FRAME_TIMING 7  // Phase timings of a finished exchange, "name value" lines
+
+#define FRAME_FLAG_HOLD 0x0001  // Sender waits for a verdict on this frame
+#define FRAME_FLAG_PREVIEW 0x0002  // Body is truncated, the full copy follows in DATA frames
+#define FRAME_FLAG_END 0x0004  // Last DATA frame of a message
+#define FRAME_FLAG_CACHED 0x0008  // Response was served from the response cache
+#define FRAME_FLAG_REVALIDATED 0x0010  // Cached response was confirmed by the origin with a 304
+
+typedef struct {
+    uint8_t type;
+    uint16_t flags;
+    uint32_t id;
+    char* head;
+    uint32_t head_length;
+    char* body;
+    uint32_t body_length;
+} frame;
+
+// A message held in the GUI; resume runs on the channel reader thread once the verdict is in
+typedef struct pending_verdict {
+    uint32_t id;
+    frame verdict;  // Type 0 when the GUI went away before answering
+    void (*resume)(struct pending_verdict* pending);
+    void* owner;
+    struct pending_verdict* next;
+} pending_verdict;
+
+int gui_socket = -1;
+time_t gui_last_attempt = 0;
+uint32_t next_message_id = 0;
+pending_verdict* pending_verdicts = NULL;
+pthread_mutex_t gui_lock = PTHREAD_MUTEX_INITIALIZER;
+
+int send_all(int socket, const char* data, size_t length) {
+    while (length > 0) {
+        ssize_t sent = send(socket, data, length, MSG_NOSIGNAL);
+        if (sent <= 0) return 0;
+        data += sent;
+        length -= sent;
+    }
+    return 1;
+}
+
+int recv_all(int socket, char* data, size_t length) {
+    while (length > 0) {
+        ssize_t received = recv(socket, data, length, 0);
+        if (received <= 0) return 0;
+        data += received;
+        length -= received;
+    }
+    return 1;
+}
+
+int send_frame(int socket, uint8_t type, uint16_t flags, uint32_t id,
+               const char* head, size_t head_length, const char* body, size_t body_length) {
+    char header[FRAME_HEADER_SIZE];
+    uint16_t net_flags = htons(flags);
+    uint32_t net_id = htonl(id);
+    uint32_t net_head_length = htonl(head_length);
+    uint32_t net_body_length = htonl(body_length);
+
+    memcpy(header, FRAME_MAGIC, 2);
+    header[2] = FRAME_VERSION;
+    header[3] = type;
+    memcpy(header + 4, &net_flags, 2);
+    memcpy(header + 6, &net_id, 4);
+    memcpy(header + 10, &net_head_length, 4);
+    memcpy(header + 14, &net_body_length, 4);
+
+    // One sendmsg for the whole frame, separate small writes stall on delayed ACKs
+    struct iovec parts[3] = {
+        {header, sizeof(header)}, {(void*)head, head_length}, {(void*)body, body_length}
+    };
+    struct msghdr message;
+    memset(&message, 0, sizeof(message));
+    message.msg_iov = parts;
+    message.msg_iovlen = 3;
+    while (message.msg_iovlen > 0) {
+        ssize_t sent = sendmsg(socket, &message, MSG_NOSIGNAL);
+        if (sent < 0 && errno == EINTR) continue;
+        if (sent <= 0) return 0;
+        while (message.msg_iovlen > 0 && (size_t)sent >= message.msg_iov->iov_len) {
+            sent -= message.msg_iov->iov_len;
+            message.msg_iov++;
+            message.msg_iovlen--;
+        }
+        if (message.msg_iovlen > 0) {
+            message.msg_iov->iov_base = (char*)message.msg_iov->iov_base + sent;
+            message.msg_iov->iov_len -= sent;
+        }
+    }
+    return 1;
+}
+
+void free_frame(frame* f) {
+    free(f->head);
+    free(f->body);
+    f->head = NULL;
+    f->body = NULL;
+}
+
+int recv_frame(int socket, frame* f) {
+    char header[FRAME_HEADER_SIZE];
+    memset(f, 0, sizeof(*f));
+    if (!recv_all(socket, header, sizeof(header))) return 0;
+
+    if (memcmp(header, FRAME_MAGIC, 2) != 0 || header[2] != FRAME_VERSION) {
+        fprintf(stderr, "Invalid frame from GUI\n");
+        return 0;
+    }
+
+    uint16_t net_flags;
+    uint32_t net_id, net_head_length, net_body_length;
+    memcpy(&net_flags, header + 4, 2);
+    memcpy(&net_id, header + 6, 4);
+    memcpy(&net_head_length, header + 10, 4);
+    memcpy(&net_body_length, header + 14, 4);
+
+    f->type = header[3];
+    f->flags = ntohs(net_flags);
+    f->id = ntohl(net_id);
+    f->head_length = ntohl(net_head_length);
+    f->body_length = ntohl(net_body_length);
+    if (f->head_length > FRAME_MAX_SECTION || f->body_length > FRAME_MAX_SECTION) {
+        fprintf(stderr, "Frame from GUI is too large\n");
+        return 0;
+    }
+
+    // Sections are NUL terminated for convenience
+    f->head = malloc(f->head_length + 1);
+    f->body = malloc(f->body_length + 1);
+    if (f->head == NULL || f->body == NULL ||
+        !recv_all(socket, f->head, f->head_length) ||
+        !recv_all(socket, f->body, f->body_length)) {
+        free_frame(f);
+        return 0;
+    }
+    f->head[f->head_length] = '\0';
+    f->body[f->body_length] = '\0';
+    return 1;
+}
+
+/*
+ * Blocklist updates arrive as frames on BLOCKED_DOMAINS_PORT. The body of an
+ * ADD, REMOVE or REPLACE frame lists one domain per line and its id is the
+ * version the list has once the frame is applied. Deltas must follow the
+ * current version; otherwise the proxy answers RESYNC and the GUI sends the
+ * whole list in a REPLACE frame. Applied frames are answered with ACK.
+ */
+#define BLOCKLIST_ADD 16
+#define BLOCKLIST_REMOVE 17
+#define BLOCKLIST_REPLACE 18
+#define BLOCKLIST_ACK 19
+#define BLOCKLIST_RESYNC 20
+
+// Splits a frame body into normalized domains in place, returns how many were found
+size_t split_domain_lines(char* body, char** domains, int* flags, size_t* names_size) {
+    size_t count = 0;
+    char* save = NULL;
+    *names_size = 0;
+    for (char* line = strtok_r(body, "\r\n", &save); line != NULL; line = strtok_r(NULL, "\r\n", &save)) {
+        int line_flags = normalize_blocked_domain(line);
+        if (line_flags == 0) continue;
+        domains[count] = line;
+        flags[count] = line_flags;
+        *names_size += strlen(line) + 1;
+        count++;
+    }
+    return count;
+}
+
+// Builds the snapshot that results from applying a frame to current
+blocklist_t* blocklist_apply(const blocklist_t* current, uint8_t type, char* body, size_t body_length) {
+    size_t max_lines = body_length / 2 + 1;
+    char** domains = malloc(max_lines * sizeof(char*));
+    int* flags = malloc(max_lines * sizeof(int));
+    blocklist_t* list = calloc(1, sizeof(blocklist_t));
+    if (domains == NULL || flags == NULL || list == NULL) goto fail;
+
+    size_t names_size;
+    size_t count = split_domain_lines(body, domains, flags, &names_size);
+
+    domain_set* base = type == BLOCKLIST_REPLACE || current == NULL ? NULL : current->base;
+    domain_set* overlay = type == BLOCKLIST_REPLACE || current == NULL ? NULL : current->overlay;
+    size_t overlay_count = overlay ? overlay->count : 0;
+    size_t base_count = base ? base->count : 0;
+
+    if (base != NULL && overlay_count + count <= BLOCKLIST_MIN_COMPACT + base_count / 4) {
+        // Small delta: share the base and rebuild only the overlay
+        list->base = base;
+        base->refs++;
+        list->count = current->count;
+        list->overlay = domain_set_create(overlay_count + count, (overlay ? overlay->names_used : 0) + names_size);
+        if (list->overlay == NULL) goto fail;
+        if (overlay != NULL) {
+            for (size_t i = 0; i <= overlay->mask; i++) {
+                domain_slot* slot = &overlay->slots[i];
+                if (slot->name != NULL) domain_set_add(list->overlay, slot->name, strlen(slot->name), slot->hash, slot->flags);
+            }
+        }
+    } else {
+        // Rebuild the base from the live domains of the current snapshot
+        size_t capacity = base_count + overlay_count + count;
+        size_t base_names = (base ? base->names_used : 0) + (overlay ? overlay->names_used : 0) + names_size;
+        list->base = domain_set_create(capacity, base_names);
+        if (list->base == NULL) goto fail;
+        domain_set* sources[2] = {overlay, base};
+        for (int source = 0; source < 2; source++) {
+            domain_set* set = sources[source];
+            if (set == NULL) continue;
+            for (size_t i = 0; i <= set->mask; i++) {
+                domain_slot* slot = &set->slots[i];
+                if (slot->name == NULL || slot->flags == 0) continue;
+                size_t length = strlen(slot->name);
+                // Overlay entries take precedence over the base entries they shadow
+                if (source == 1 && domain_set_flags(overlay, slot->name, length, slot->hash) >= 0) continue;
+                domain_set_add(list->base, slot->name, length, slot->hash, slot->flags);
+                list->count += blocked_entries(slot->flags);
+            }
+        }
+    }
+
+    // The target set for the changes: the overlay when there is one, otherwise the new base
+    domain_set* target = list->overlay ? list->overlay : list->base;
+    for (size_t i = 0; i < count; i++) {
+        size_t length = strlen(domains[i]);
+        unsigned int hash = domain_hash(domains[i], length);
+        int before = domain_set_flags(target, domains[i], length, hash);
+        if (before < 0 && list->overlay != NULL) before = domain_set_flags(list->base, domains[i], length, hash);
+        if (before < 0) before = 0;
+
+        int after = type == BLOCKLIST_REMOVE ? before & ~flags[i] : before | flags[i];
+        if (after == before && domain_set_flags(target, domains[i], length, hash) < 0) continue;
+        domain_set_add(target, domains[i], length, hash, before)->flags = after;
+        list->count += blocked_entries(after) - blocked_entries(before);
+    }
+
+    free(domains);
+    free(flags);
+    return list;
+
+fail:
+    free(domains);
+    free(flags);
+    blocklist_free(list);
+    return NULL;
+}
+
+// Applies one update frame, returns the frame type to answer with
+uint8_t update_blocked_domains(frame* update) {
+    pthread_mutex_lock(&blocked_domains_lock);
+    blocklist_t* current = atomic_load(&active_blocklist);
+    uint32_t version = current ? current->version : 0;
+
+    if (update->type != BLOCKLIST_REPLACE && update->id != version + 1) {
+        pthread_mutex_unlock(&blocked_domains_lock);
+        return BLOCKLIST_RESYNC;
+    }
+
+    // Lookups keep using the current snapshot while the next one is built
+    blocklist_t* list = blocklist_apply(current, update->type, update->body, update->body_length);
+    if (list == NULL) {
+        pthread_mutex_unlock(&blocked_domains_lock);
+        fprintf(stderr, "Failed to allocate the blocked domains list\n");
+        return BLOCKLIST_RESYNC;
+    }
+    list->version = update->id;
+    int count = list->count;
+    blocklist_publish(list);
+    pthread_mutex_unlock(&blocked_domains_lock);
+
+    printf("Updated blocked domains to version %u. Total: %d\n", update->id, count);
+    return BLOCKLIST_ACK;
+}
+
+void* blocked_domains_listener(void* arg) {
+    int blocked_domains_socket = socket(AF_INET, SOCK_STREAM, 0);
+    if (blocked_domains_socket < 0) {
+        perror("Failed to create blocked domains socket");
+        return NULL;
+    }
+
+    struct sockaddr_in blocked_domains_addr;
+    blocked_domains_addr.sin_family = AF_INET;
+    blocked_domains_addr.sin_addr.s_addr = INADDR_ANY;
+    blocked_domains_addr.sin_port = htons(BLOCKED_DOMAINS_PORT);
+
+    if (bind(blocked_domains_socket, (struct sockaddr*)&blocked_domains_addr, sizeof(blocked_domains_addr)) < 0) {
+        perror("Failed to bind blocked domains socket");
+        close(blocked_domains_socket);
+        return NULL;
+    }
+
+    listen(blocked_domains_socket, 1);
+    printf("Blocked domains listener running on port %d\n", BLOCKED_DOMAINS_PORT);
+
+    while (1) {
+        int control_socket = accept(blocked_domains_socket, NULL, NULL);
+        if (control_socket < 0) {
+            perror("Failed to accept blocked domains connection");
+            continue;
+        }
+
+        // Any number of updates per connection, each one acknowledged in turn
+        frame update;
+        while (recv_frame(control_socket, &update)) {
+            uint8_t reply = BLOCKLIST_RESYNC;
+            if (update.type == BLOCKLIST_ADD || update.type == BLOCKLIST_REMOVE || update.type == BLOCKLIST_REPLACE) {
+                reply = update_blocked_domains(&update);
+            }
+            free_frame(&update);
+
+            blocklist_t* list = atomic_load(&active_blocklist);
+            if (!send_frame(control_socket, reply, 0, list ? list->version : 0, NULL, 0, NULL, 0)) break;
+        }
+        close(control_socket);
+    }
+
+    close(blocked_domains_socket);
+    return NULL;
+}
+
+// Reads verdicts from the GUI and resumes the messages waiting for them
+void* gui_channel_reader(void* arg) {
+    int socket = *(int*)arg;
+    free(arg);
+
+    frame f;
+    while (recv_frame(socket, &f)) {
+        pthread_mutex_lock(&gui_lock);
+        pending_verdict** link = &pending_verdicts;
+        while (*link != NULL && (*link)->id != f.id) link = &(*link)->next;
+        pending_verdict* pending = *link;
+        if (pending != NULL) *link = pending->next;
+        pthread_mutex_unlock(&gui_lock);
+
+        if (pending != NULL) {
+            atomic_fetch_sub(&metrics.intercept_queue_depth, 1);
+            pending->verdict = f;
+            pending->resume(pending);
+        } else {
+            fprintf(stderr, "Verdict for unknown message %u\n", f.id);
+            free_frame(&f);
+        }
+    }
+
+    // Connection lost: everything still waiting is dropped
+    pthread_mutex_lock(&gui_lock);
+    if (gui_socket == socket) gui_socket = -1;
+    pending_verdict* pending = pending_verdicts;
+    pending_verdicts = NULL;
+    pthread_mutex_unlock(&gui_lock);
+    while (pending != NULL) {
+        pending_verdict* next = pending->next;  // A resumed message may be held again right away
+        atomic_fetch_sub(&metrics.intercept_queue_depth, 1);
+        pending->resume(pending);
+        pending = next;
+    }
+    close(socket);
+    printf("GUI channel closed\n");
+    return NULL;
+}
+
+// Must be called with gui_lock held. Notifications only retry every GUI_RECONNECT_INTERVAL.
+int gui_channel_connect(int notification) {
+    if (gui_socket >= 0) return 1;
+
+    time_t now = time(NULL);
+    if (notification && now - gui_last_attempt < GUI_RECONNECT_INTERVAL) return 0;
+    gui_last_attempt = now;
+
+    int new_socket = socket(AF_INET, SOCK_STREAM, 0);
+    if (new_socket < 0) {
+        perror("Failed to create socket");
+        return 0;
+    }
+
+    struct sockaddr_in gui_addr;
+    gui_addr.sin_family = AF_INET;
+    gui_addr.sin_port = htons(GUI_PORT);
+    inet_pton(AF_INET, "127.0.0.1", &gui_addr.sin_addr);
+
+    if (connect(new_socket, (struct sockaddr*)&gui_addr, sizeof(gui_addr)) < 0) {
+        perror("Failed to connect to GUI");
+        close(new_socket);
+        return 0;
+    }
+    // Frames are small and latency bound, do not let Nagle hold them back
+    int nodelay = 1;
+    setsockopt(new_socket, IPPROTO_TCP, TCP_NODELAY, &nodelay, sizeof(nodelay));
+
+    int* reader_socket = malloc(sizeof(int));
+    *reader_socket = new_socket;
+    pthread_t reader_thread;
+    if (pthread_create(&reader_thread, NULL, gui_channel_reader, reader_socket) != 0) {
+        perror("Failed to start GUI channel reader");
+        free(reader_socket);
+        close(new_socket);
+        return 0;
+    }
+    pthread_detach(reader_thread);
+
+    gui_socket = new_socket;
+    printf("GUI channel connected\n");
+    return 1;
+}
+
+uint32_t next_gui_message_id() {
+    pthread_mutex_lock(&gui_lock);
+    uint32_t id = ++next_message_id;
+    pthread_mutex_unlock(&gui_lock);
+    return id;
+}
+
+// Splits a message into its head (without the blank line) and body sections
+void split_message(const char* message, size_t length, size_t* head_length,
+                   const char** body, size_t* body_length) {
+    const char* separator = memmem(message, length, "\r\n\r\n", 4);
+    *head_length = separator ? (size_t)(separator - message) : length;
+    *body = separator ? separator + 4 : message + length;
+    *body_length = message + length - *body;
+}
+
+// Sends a frame the GUI does not answer; dropped if the GUI is not connected
+void gui_notify(uint8_t type, uint16_t flags, uint32_t message_id,
+                const char* head, size_t head_length, const char* body, size_t body_length) {
+    pthread_mutex_lock(&gui_lock);
+    if (gui_channel_connect(1) &&
+        !send_frame(gui_socket, type, flags, message_id, head, head_length, body, body_length)) {
+        perror("Failed to send notification to GUI");
+        shutdown(gui_socket, SHUT_RDWR);  // The reader thread cleans up
+    }
+    pthread_mutex_unlock(&gui_lock);
+}
+
+/*
+ * Sends a message to the GUI to be held until its verdict, with flags sent
+ * along with FRAME_FLAG_HOLD. The caller sets pending->resume and owner; the
+ * verdict is stored in pending before resume is called. Returns 0 without
+ * holding anything when the GUI cannot be reached.
+ */
+int gui_hold(pending_verdict* pending, uint8_t type, uint32_t message_id, uint16_t flags,
+             const char* message, size_t message_length) {
+    // Split the message into its head and body sections
+    size_t head_length, body_length;
+    const char* body;
+    split_message(message, message_length, &head_length, &body, &body_length);
+
+    pending->id = message_id;
+    memset(&pending->verdict, 0, sizeof(pending->verdict));
+
+    pthread_mutex_lock(&gui_lock);
+    if (!gui_channel_connect(0)) {
+        pthread_mutex_unlock(&gui_lock);
+        return 0;
+    }
+
+    // Registered before sending, the verdict can arrive as soon as the frame is out
+    pending->next = pending_verdicts;
+    pending_verdicts = pending;
+    atomic_fetch_add(&metrics.intercept_queue_depth, 1);
+
+    if (!send_frame(gui_socket, type, FRAME_FLAG_HOLD | flags, message_id, message, head_length, body, body_length)) {
+        perror("Failed to send message to GUI");
+        shutdown(gui_socket, SHUT_RDWR);  // The reader thread cleans up
+        pending_verdicts = pending->next;
+        atomic_fetch_sub(&metrics.intercept_queue_depth, 1);
+        pthread_mutex_unlock(&gui_lock);
+        return 0;
+    }
+    pthread_mutex_unlock(&gui_lock);
+    return 1;
+}
+
+/*
+ * Applies the verdict of a held message. Returns 1 if the message should be
+ * forwarded, in which case *message and *message_length may have been
+ * replaced by an edited version of at most limit bytes. *message is
+ * reallocated as needed, *capacity excludes the terminating NUL.
+ */
+int apply_verdict(frame* verdict, uint8_t type, char** message, size_t* message_length, size_t* capacity,
+                  size_t limit) {
+    const char* type_name = type == FRAME_REQUEST ? "Request" : "Response";
+    int forward = 0;
+
+    if (verdict->type == FRAME_EDIT) {
+        size_t new_message_size = (size_t)verdict->head_length + 4 + verdict->body_length;
+        char* edited = *message;
+        if (new_message_size > *capacity && new_message_size <= limit) {
+            edited = realloc(*message, new_message_size + 1);
+            if (edited != NULL) {
+                *message = edited;
+                *capacity = new_message_size;
+            }
+        }
+        if (new_message_size > limit || edited == NULL) {
+            fprintf(stderr, "Edited message too large\n");
+        } else {
+            memcpy(edited, verdict->head, verdict->head_length);
+            memcpy(edited + verdict->head_length, "\r\n\r\n", 4);
+            memcpy(edited + verdict->head_length + 4, verdict->body, verdict->body_length);
+            edited[new_message_size] = '\0';
+            *message_length = new_message_size;
+            forward = 1;
+        }
+    } else if (verdict->type == FRAME_FORWARD) {
+        forward = 1;
+    }
+
+    if (!forward) printf("%s was dropped by the GUI\n", type_name);
+    free_frame(verdict);
+    return forward;
+}
+
+/*
+ * Response body framing. The body ends after Content-Length bytes, after the
+ * last chunk of a chunked body, or when the server closes the connection.
+ */
+enum {
+    CHUNK_SIZE, CHUNK_EXTENSION, CHUNK_SIZE_LF, CHUNK_DATA, CHUNK_DATA_CR, CHUNK_DATA_LF,
+    CHUNK_TRAILER_START, CHUNK_TRAILER_LINE, CHUNK_TRAILER_LF
+};
+
+typedef struct {
+    int status;
+    int chunked;
+    int close_delimited;
+    long long remaining;  // Body bytes still expected (Content-Length or current chunk)
+    int chunk_state;
+    int done;
+} body_framing;
+
+// Finds a header in a message head; returns its value and sets value_length, or NULL
+const char* find_header(const char* head, size_t head_length, const char* name, size_t* value_length) {
+    size_t name_length = strlen(name);
+    const char* end = head + head_length;
+    const char* line = memchr(head, '\n', head_length);  // Skip the start line
+
+    while (line != NULL && ++line < end) {
+        const char* line_end = memchr(line, '\n', end - line);
+        if (line_end == NULL) line_end = end;
+        if ((size_t)(line_end - line) > name_length && line[name_length] == ':' &&
+            strncasecmp(line, name, name_length) == 0) {
+            const char* value = line + name_length + 1;
+            while (value < line_end && (*value == ' ' || *value == '\t')) value++;
+            const char* value_end = line_end;
+            while (value_end > value && (value_end[-1] == '\r' || value_end[-1] == ' ')) value_end--;
+            *value_length = value_end - value;
+            return value;
+        }
+        line = line_end < end ? line_end : NULL;
+    }
+    return NULL;
+}
+
+// Copies the host name of the Host header into host and sets *port when it names one; returns 0 without one
+int read_host_header(const char* head, size_t head_length, char* host, size_t size, int* port) {
+    size_t host_length;
+    const char* host_value = find_header(head, head_length, "Host", &host_length);
+    if (host_value == NULL || host_length == 0 || host_length >= size) return 0;
+    memcpy(host, host_value, host_length);
+    host[host_length] = '\0';
+    char* port_separator = strchr(host, ':');
+    if (port_separator != NULL) {
+        *port_separator = '\0';
+        *port = atoi(port_separator + 1);
+    }
+    return 1;
+}
+
+void init_response_framing(body_framing* framing, const char* head, size_t head_length, const char* method) {
+    memset(framing, 0, sizeof(*framing));
+    sscanf(head, "%*s %d", &framing->status);
+
+    // Responses to HEAD, 1xx, 204 and 304 never have a body
+    if (strcasecmp(method, "HEAD") == 0 || (framing->status >= 100 && framing->status < 200) ||
+        framing->status == 204 || framing->status == 304) {
+        framing->done = 1;
+        return;
+    }
+
+    size_t value_length;
+    const char* value = find_header(head, head_length, "Transfer-Encoding", &value_length);
+    if (value != NULL && memmem(value, value_length, "chunked", 7) != NULL) {
+        framing->chunked = 1;
+        framing->chunk_state = CHUNK_SIZE;
+        return;
+    }
+
+    value = find_header(head, head_length, "Content-Length", &value_length);
+    if (value != NULL) {
+        framing->remaining = strtoll(value, NULL, 10);
+        framing->done = framing->remaining <= 0;
+        return;
+    }
+
+    framing->close_delimited = 1;
+}
+
+void init_request_framing(body_framing* framing, const char* head, size_t head_length) {
+    memset(framing, 0, sizeof(*framing));
+    size_t value_length;
+    const char* value = find_header(head, head_length, "Transfer-Encoding", &value_length);
+    if (value != NULL && memmem(value, value_length, "chunked", 7) != NULL) {
+        framing->chunked = 1;
+    } else if ((value = find_header(head, head_length, "Content-Length", &value_length)) != NULL) {
+        framing->remaining = strtoll(value, NULL, 10);
+        framing->done = framing->remaining <= 0;
+    } else {
+        framing->done = 1;  // Requests without either header have no body
+    }
+}
+
+/*
+ * Returns how many bytes of data belong to the body, setting done at its end.
+ * When payload is given, the body bytes without the chunked framing are
+ * copied to it (at most length of them) and counted in *payload_length.
+ */
+size_t body_decode(body_framing* framing, const char* data, size_t length, char* payload, size_t* payload_length) {
+    if (framing->done) return 0;
+
+    if (framing->close_delimited) {
+        if (payload != NULL) {
+            memcpy(payload + *payload_length, data, length);
+            *payload_length += length;
+        }
+        return length;
+    }
+
+    if (!framing->chunked) {
+        size_t used = (long long)length < framing->remaining ? length : (size_t)framing->remaining;
+        framing->remaining -= used;
+        framing->done = framing->remaining == 0;
+        if (payload != NULL) {
+            memcpy(payload + *payload_length, data, used);
+            *payload_length += used;
+        }
+        return used;
+    }
+
+    size_t i = 0;
+    while (i < length && !framing->done) {
+        char c = data[i];
+        switch (framing->chunk_state) {
+            case CHUNK_SIZE:
+                if (c == ';') framing->chunk_state = CHUNK_EXTENSION;
+                else if (c == '\r') framing->chunk_state = CHUNK_SIZE_LF;
+                else if (c == '\n') goto chunk_size_done;
+                else if (c >= '0' && c <= '9') framing->remaining = framing->remaining * 16 + (c - '0');
+                else if ((c | 0x20) >= 'a' && (c | 0x20) <= 'f') framing->remaining = framing->remaining * 16 + ((c | 0x20) - 'a' + 10);
+                i++;
+                continue;
+            case CHUNK_EXTENSION:
+            case CHUNK_SIZE_LF:
+                if (c == '\n') goto chunk_size_done;
+                i++;
+                continue;
+            case CHUNK_DATA: {
+                size_t available = length - i;
+                size_t used = (long long)available < framing->remaining ? available : (size_t)framing->remaining;
+                framing->remaining -= used;
+                if (payload != NULL) {
+                    memcpy(payload + *payload_length, data + i, used);
+                    *payload_length += used;
+                }
+                i += used;
+                if (framing->remaining == 0) framing->chunk_state = CHUNK_DATA_CR;
+                continue;
+            }
+            case CHUNK_DATA_CR:
+                framing->chunk_state = c == '\r' ? CHUNK_DATA_LF : CHUNK_SIZE;
+                if (c == '\n') framing->chunk_state = CHUNK_SIZE;
+                i++;
+                continue;
+            case CHUNK_DATA_LF:
+                framing->chunk_state = CHUNK_SIZE;
+                i++;
+                continue;
+            case CHUNK_TRAILER_START:
+                if (c == '\r') framing->chunk_state = CHUNK_TRAILER_LF;
+                else if (c == '\n') framing->done = 1;
+                else framing->chunk_state = CHUNK_TRAILER_LINE;
+                i++;
+                continue;
+            case CHUNK_TRAILER_LINE:
+                if (c == '\n') framing->chunk_state = CHUNK_TRAILER_START;
+                i++;
+                continue;
+            case CHUNK_TRAILER_LF:
+                if (c == '\n') framing->done = 1;
+                else framing->chunk_state = CHUNK_TRAILER_LINE;
+                i++;
+                continue;
+        }
+
+    chunk_size_done:
+        // End of a chunk size line: the last chunk has size 0 and is followed by trailers
+        framing->chunk_state = framing->remaining > 0 ? CHUNK_DATA : CHUNK_TRAILER_START;
+        i++;
+    }
+    return i;
+}
+
+size_t body_consume(body_framing* framing, const char* data, size_t length) {
+    return body_decode(framing, data, length, NULL, NULL);
+}
+
+// Reads until the end of the message head; the buffer may also hold the first body bytes
+int read_message_head(int socket, char** buffer, size_t* capacity, size_t* length, size_t* head_length) {
+    while (1) {
+        if (*length >= 4) {
+            const char* separator = memmem(*buffer, *length, "\r\n\r\n", 4);
+            if (separator != NULL) {
+                *head_length = separator + 4 - *buffer;
+                return 1;
+            }
+        }
+        if (*length >= MAX_HEAD_SIZE) {
+            fprintf(stderr, "Message head too large\n");
+            return 0;
+        }
+        if (*capacity - *length < RELAY_CHUNK_SIZE) {
+            size_t new_capacity = *capacity + RELAY_CHUNK_SIZE;
+            char* grown = realloc(*buffer, new_capacity + 1);
+            if (grown == NULL) return 0;
+            *buffer = grown;
+            *capacity = new_capacity;
+        }
+        ssize_t received = recv(socket, *buffer + *length, *capacity - *length, 0);
+        if (received <= 0) return 0;
+        *length += received;
+    }
+}
+
+/*
+ * Reads the rest of the body into the buffer. Returns 1 when the whole message
+ * is buffered, 0 when it grows past limit (the caller should stream it) and
+ * -1 on a connection error.
+ */
+int buffer_response_body(int server_socket, char** buffer, size_t* capacity, size_t* length,
+                         body_framing* framing, size_t limit) {
+    while (!framing->done) {
+        if (*length >= limit) return 0;
+        if (*capacity - *length < RELAY_CHUNK_SIZE) {
+            size_t new_capacity = *capacity * 2;
+            char* grown = realloc(*buffer, new_capacity + 1);
+            if (grown == NULL) return -1;
+            *buffer = grown;
+            *capacity = new_capacity;
+        }
+
+        ssize_t received = recv(server_socket, *buffer + *length, *capacity - *length, 0);
+        if (received <= 0) {
+            if (received == 0 && framing->close_delimited) {
+                framing->done = 1;
+                break;
+            }
+            return -1;
+        }
+        *length += body_consume(framing, *buffer + *length, received);
+    }
+    (*buffer)[*length] = '\0';
+    return 1;
+}
+
+/*
+ * Content rewriting. The GUI sends the whole rule list in a REWRITE_RULES frame
+ * on REWRITE_PORT, one rule per line:
+ *   action TAB direction TAB host TAB content type TAB find TAB replace
+ * action is header-add, header-set, header-remove, body-replace (literal) or
+ * body-regex (POSIX extended, \0 to \9 in the replacement stand for its
+ * groups); direction is request, response or both; host is a glob on the host
+ * name and content type a substring of the Content-Type, both empty for any.
+ * Header rules take the header name in find and its value in replace. Tabs,
+ * line breaks and backslashes in the fields are escaped as \t, \n, \r and \\.
+ * A valid list replaces the active one and is answered with REWRITE_ACK, an
+ * invalid one with REWRITE_ERROR and the reason, keeping the active list.
+ *
+ * Every exchange uses the list that was active when it started. Bodies are
+ * rewritten as a stream: each body rule is a stage that only holds back the
+ * bytes a match could still need, so a body is never buffered for rewriting.
+ * A buffered message gets the new Content-Length; a streamed response goes to
+ * HTTP/1.1 clients chunked and to older ones delimited by closing the
+ * connection. Compressed bodies are left as they are.
+ */
+#define REWRITE_RULES 21
+#define REWRITE_ACK 22
+#define REWRITE_ERROR 23
+
+#define REWRITE_REQUESTS 0x1
+#define REWRITE_RESPONSES 0x2
+
+enum { REWRITE_HEADER_ADD, REWRITE_HEADER_SET, REWRITE_HEADER_REMOVE, REWRITE_BODY_LITERAL, REWRITE_BODY_REGEX };
+
+typedef struct {
+    int action;
+    int directions;  // REWRITE_REQUESTS and/or REWRITE_RESPONSES
+    const char* host;  // Glob, NULL for any
+    const char* content_type;  // NULL for any
+    const char* find;  // Header name, literal or pattern
+    size_t find_length;
+    const char* replace;  // Header value or replacement
+    size_t replace_length;
+    regex_t pattern;  // Compiled find of a body-regex rule
+} rewrite_rule;
+
+typedef struct {
+    rewrite_rule* rules;
+    size_t count;
+    char* text;  // Frame body the rule fields point into
+    int refs;  // Exchanges using the list, plus one while it is the active list
+} rewrite_rules_t;
+
+typedef struct {
+    char* data;  // NUL terminated for convenience
+    size_t length;
+    size_t capacity;  // Excludes the terminating NUL
+} byte_buffer;
+
+typedef struct {
+    const rewrite_rule* rule;
+    byte_buffer held;  // Input a match could still need
+    size_t offset;  // Of the first held byte in the stage's input
+} rewrite_stage;
+
+typedef struct {
+    rewrite_stage* stages;  // One per body rule, in list order
+    size_t count;
+    body_framing decoder;  // Undoes the chunked framing of the input
+    byte_buffer scratch[2];  // Carries the body from stage to stage
+    int chunked;  // The output is chunk encoded
+} body_rewriter;
+
+rewrite_rules_t* active_rewrite_rules = NULL;
+pthread_mutex_t rewrite_rules_lock = PTHREAD_MUTEX_INITIALIZER;
+
+// Makes room for extra more bytes; returns 0 on allocation failure
+int buffer_reserve(byte_buffer* buffer, size_t extra) {
+    if (buffer->data != NULL && buffer->capacity - buffer->length >= extra) return 1;
+    size_t capacity = buffer->capacity ? buffer->capacity : 4096;
+    while (capacity - buffer->length < extra) capacity *= 2;
+    char* grown = realloc(buffer->data, capacity + 1);
+    if (grown == NULL) return 0;
+    buffer->data = grown;
+    buffer->capacity = capacity;
+    buffer->data[buffer->length] = '\0';
+    return 1;
+}
+
+int buffer_append(byte_buffer* buffer, const char* data, size_t length) {
+    if (length == 0) return 1;
+    if (!buffer_reserve(buffer, length)) return 0;
+    memcpy(buffer->data + buffer->length, data, length);
+    buffer->length += length;
+    buffer->data[buffer->length] = '\0';
+    return 1;
+}
+
+// Undoes the escapes of a rule field in place, returns its length
+size_t rewrite_unescape(char* field) {
+    char* out = field;
+    for (const char* in = field; *in != '\0'; in++) {
+        if (*in == '\\' && in[1] != '\0') {
+            in++;
+            *out++ = *in == 't' ? '\t' : *in == 'n' ? '\n' : *in == 'r' ? '\r' : *in;
+        } else {
+            *out++ = *in;
+        }
+    }
+    *out = '\0';
+    return out - field;
+}
+
+// Fills rule from one line of a rule list; returns 0 and the reason in error for an invalid line
+int parse_rewrite_rule(rewrite_rule* rule, char* line, char* error, size_t error_size) {
+    static const char* actions[] = {"header-add", "header-set", "header-remove", "body-replace", "body-regex"};
+    char* fields[6] = {line, "", "", "", "", ""};
+    size_t count = 1;
+    for (char* c = line; *c != '\0' && count < 6; c++) {
+        if (*c == '\t') {
+            *c = '\0';
+            fields[count++] = c + 1;
+        }
+    }
+
+    rule->action = -1;
+    for (int i = 0; i < (int)(sizeof(actions) / sizeof(actions[0])); i++) {
+        if (strcmp(fields[0], actions[i]) == 0) rule->action = i;
+    }
+    if (rule->action < 0) {
+        snprintf(error, error_size, "unknown action \"%.64s\"", fields[0]);
+        return 0;
+    }
+    rule->directions = strcmp(fields[1], "request") == 0 ? REWRITE_REQUESTS
+                     : strcmp(fields[1], "response") == 0 ? REWRITE_RESPONSES
+                     : strcmp(fields[1], "both") == 0 ? REWRITE_REQUESTS | REWRITE_RESPONSES : 0;
+    if (rule->directions == 0) {
+        snprintf(error, error_size, "unknown direction \"%.64s\"", fields[1]);
+        return 0;
+    }
+
+    rule->host = rewrite_unescape(fields[2]) > 0 ? fields[2] : NULL;
+    rule->content_type = rewrite_unescape(fields[3]) > 0 ? fields[3] : NULL;
+    rule->find = fields[4];
+    rule->find_length = rewrite_unescape(fields[4]);
+    rule->replace = fields[5];
+    rule->replace_length = rewrite_unescape(fields[5]);
+
+    if (rule->action <= REWRITE_HEADER_REMOVE) {
+        if (rule->find_length == 0 || strpbrk(rule->find, ": \t\r\n") != NULL) {
+            snprintf(error, error_size, "invalid header name \"%.64s\"", rule->find);
+            return 0;
+        }
+        // The proxy sets these itself when a body changes
+        if (strcasecmp(rule->find, "Content-Length") == 0 || strcasecmp(rule->find, "Transfer-Encoding") == 0) {
+            snprintf(error, error_size, "%s cannot be rewritten", rule->find);
+            return 0;
+        }
+        if (strpbrk(rule->replace, "\r\n") != NULL) {
+            snprintf(error, error_size, "the value of %.64s spans several lines", rule->find);
+            return 0;
+        }
+    } else if (rule->find_length == 0) {
+        snprintf(error, error_size, "missing pattern");
+        return 0;
+    } else if (rule->action == REWRITE_BODY_REGEX) {
+        int result = regcomp(&rule->pattern, rule->find, REG_EXTENDED);
+        if (result != 0) {
+            regerror(result, &rule->pattern, error, error_size);
+            return 0;
+        }
+    }
+    return 1;
+}
+
+void rewrite_rules_free(rewrite_rules_t* list) {
+    if (list == NULL) return;
+    for (size_t i = 0; i < list->count; i++) {
+        if (list->rules[i].action == REWRITE_BODY_REGEX) regfree(&list->rules[i].pattern);
+    }
+    free(list->rules);
+    free(list->text);
+    free(list);
+}
+
+// Builds a rule list from the NUL terminated text, which it takes over; returns NULL and the reason in error
+rewrite_rules_t* rewrite_rules_parse(char* text, char* error, size_t error_size) {
+    size_t lines = 1;
+    for (const char* c = text; *c != '\0'; c++) lines += *c == '\n';
+
+    rewrite_rules_t* list = calloc(1, sizeof(rewrite_rules_t));
+    rewrite_rule* rules = list != NULL ? calloc(lines, sizeof(rewrite_rule)) : NULL;
+    if (rules == NULL) {
+        snprintf(error, error_size, "out of memory");
+        free(list);
+        free(text);
+        return NULL;
+    }
+    list->rules = rules;
+    list->text = text;
+
+    int line_number = 0;
+    for (char* line = text; line != NULL;) {
+        char* next = strchr(line, '\n');
+        if (next != NULL) *next++ = '\0';
+        line_number++;
+        size_t length = strlen(line);
+        if (length > 0 && line[length - 1] == '\r') line[--length] = '\0';
+
+        if (length > 0 && line[0] != '#') {
+            char reason[256];
+            if (!parse_rewrite_rule(&list->rules[list->count], line, reason, sizeof(reason))) {
+                snprintf(error, error_size, "line %d: %s", line_number, reason);
+                rewrite_rules_free(list);
+                return NULL;
+            }
+            list->count++;
+        }
+        line = next;
+    }
+    return list;
+}
+
+rewrite_rules_t* rewrite_rules_acquire() {
+    pthread_mutex_lock(&rewrite_rules_lock);
+    rewrite_rules_t* list = active_rewrite_rules;
+    if (list != NULL) list->refs++;
+    pthread_mutex_unlock(&rewrite_rules_lock);
+    return list;
+}
+
+void rewrite_rules_release(rewrite_rules_t* list) {
+    if (list == NULL) return;
+    pthread_mutex_lock(&rewrite_rules_lock);
+    int unused = --list->refs == 0;
+    pthread_mutex_unlock(&rewrite_rules_lock);
+    if (unused) rewrite_rules_free(list);
+}
+
+// Makes list the active one; an empty list leaves no rules, so exchanges skip rewriting altogether
+void rewrite_rules_publish(rewrite_rules_t* list) {
+    if (list->count == 0) {
+        rewrite_rules_free(list);
+        list = NULL;
+    } else {
+        list->refs = 1;
+    }
+    pthread_mutex_lock(&rewrite_rules_lock);
+    rewrite_rules_t* previous = active_rewrite_rules;
+    active_rewrite_rules = list;
+    pthread_mutex_unlock(&rewrite_rules_lock);
+    rewrite_rules_release(previous);
+}
+
+int rewrite_rule_applies(const rewrite_rule* rule, int direction, const char* host) {
+    return (rule->directions & direction) && (rule->host == NULL || fnmatch(rule->host, host, FNM_CASEFOLD) == 0);
+}
+
+int rewrite_head_applies(const rewrite_rules_t* rules, int direction, const char* host) {
+    for (size_t i = 0; rules != NULL && i < rules->count; i++) {
+        if (rules->rules[i].action <= REWRITE_HEADER_REMOVE && rewrite_rule_applies(&rules->rules[i], direction, host)) {
+            return 1;
+        }
+    }
+    return 0;
+}
+
+// Whether a header line of the original head is left out of the rewritten one
+int rewrite_header_dropped(const rewrite_rules_t* rules, int direction, const char* host,
+                           const char* name, size_t name_length, const char* framing) {
+    if (framing != NULL) {
+        if ((name_length == 14 && strncasecmp(name, "Content-Length", 14) == 0) ||
+            (name_length == 17 && strncasecmp(name, "Transfer-Encoding", 17) == 0)) {
+            return 1;
+        }
+        // A body delimited by the end of the connection must not be announced as kept alive
+        if (strncasecmp(framing, "Connection:", 11) == 0 &&
+            ((name_length == 10 && strncasecmp(name, "Connection", 10) == 0) ||
+             (name_length == 10 && strncasecmp(name, "Keep-Alive", 10) == 0))) {
+            return 1;
+        }
+    }
+    for (size_t i = 0; i < rules->count; i++) {
+        const rewrite_rule* rule = &rules->rules[i];
+        if ((rule->action == REWRITE_HEADER_SET || rule->action == REWRITE_HEADER_REMOVE) &&
+            rule->find_length == name_length && strncasecmp(rule->find, name, name_length) == 0 &&
+            rewrite_rule_applies(rule, direction, host)) {
+            return 1;
+        }
+    }
+    return 0;
+}
+
+/*
+ * Appends the head of a message, blank line included, to out with the header
+ * rules applied. head_length includes the blank line. A framing header line
+ * replaces Content-Length and Transfer-Encoding when given. Returns 0 on
+ * allocation failure.
+ */
+int rewrite_head(const rewrite_rules_t* rules, int direction, const char* host,
+                 const char* head, size_t head_length, const char* framing, byte_buffer* out) {
+    const char* end = head + head_length - 2;  // Each line keeps its line break, the blank line is added last
+    const char* line = memchr(head, '\n', end - head);
+    line = line != NULL ? line + 1 : end;
+    if (!buffer_append(out, head, line - head)) return 0;
+
+    while (line < end) {
+        const char* line_end = memchr(line, '\n', end - line);
+        const char* next = line_end != NULL ? line_end + 1 : end;
+        const char* colon = memchr(line, ':', next - line);
+        if (colon == NULL || !rewrite_header_dropped(rules, direction, host, line, colon - line, framing)) {
+            if (!buffer_append(out, line, next - line)) return 0;
+        }
+        line = next;
+    }
+
+    for (size_t i = 0; i < rules->count; i++) {
+        const rewrite_rule* rule = &rules->rules[i];
+        if ((rule->action == REWRITE_HEADER_ADD || rule->action == REWRITE_HEADER_SET) &&
+            rewrite_rule_applies(rule, direction, host)) {
+            if (!buffer_append(out, rule->find, rule->find_length) || !buffer_append(out, ": ", 2) ||
+                !buffer_append(out, rule->replace, rule->replace_length) || !buffer_append(out, "\r\n", 2)) {
+                return 0;
+            }
+        }
+    }
+    if (framing != NULL && (!buffer_append(out, framing, strlen(framing)) || !buffer_append(out, "\r\n", 2))) return 0;
+    return buffer_append(out, "\r\n", 2);
+}
+
+/*
+ * Sets up the body rules that apply to a message whose body is framed as
+ * framing says; returns how many do. The rewriter needs body_rewriter_free()
+ * either way.
+ */
+size_t body_rewriter_init(body_rewriter* rewriter, const rewrite_rules_t* rules, int direction, const char* host,
+                          const char* head, size_t head_length, const body_framing* framing) {
+    memset(rewriter, 0, sizeof(*rewriter));
+    rewriter->decoder = *framing;
+    if (rules == NULL || framing->done) return 0;
+
+    size_t value_length;
+    const char* value = find_header(head, head_length, "Content-Encoding", &value_length);
+    if (value != NULL && !(value_length == 8 && strncasecmp(value, "identity", 8) == 0)) return 0;
+    char content_type[256] = "";
+    value = find_header(head, head_length, "Content-Type", &value_length);
+    if (value != NULL && value_length < sizeof(content_type)) {
+        memcpy(content_type, value, value_length);
+        content_type[value_length] = '\0';
+    }
+
+    for (size_t i = 0; i < rules->count; i++) {
+        const rewrite_rule* rule = &rules->rules[i];
+        if (rule->action < REWRITE_BODY_LITERAL || !rewrite_rule_applies(rule, direction, host) ||
+            (rule->content_type != NULL && strcasestr(content_type, rule->content_type) == NULL)) {
+            continue;
+        }
+        if (rewriter->stages == NULL) {
+            rewriter->stages = calloc(rules->count - i, sizeof(rewrite_stage));
+            if (rewriter->stages == NULL) {
+                fprintf(stderr, "Failed to allocate the body rewriter\n");
+                return 0;
+            }
+        }
+        rewriter->stages[rewriter->count++].rule = rule;
+    }
+    return rewriter->count;
+}
+
+void body_rewriter_free(body_rewriter* rewriter) {
+    for (size_t i = 0; i < rewriter->count; i++) free(rewriter->stages[i].held.data);
+    free(rewriter->stages);
+    free(rewriter->scratch[0].data);
+    free(rewriter->scratch[1].data);
+    memset(rewriter, 0, sizeof(*rewriter));
+}
+
+// Appends the replacement of a regex match, \0 to \9 standing for its groups and \\ for a backslash
+int rewrite_expand(const rewrite_rule* rule, const char* text, const regmatch_t* groups, byte_buffer* out) {
+    const char* replace = rule->replace;
+    size_t literal_start = 0;
+    for (size_t i = 0; i + 1 < rule->replace_length; i++) {
+        char next = replace[i + 1];
+        if (replace[i] != '\\' || !((next >= '0' && next <= '9') || next == '\\')) continue;
+        if (!buffer_append(out, replace + literal_start, i - literal_start)) return 0;
+        if (next == '\\') {
+            if (!buffer_append(out, "\\", 1)) return 0;
+        } else {
+            const regmatch_t* group = &groups[next - '0'];
+            if (group->rm_so >= 0 && !buffer_append(out, text + group->rm_so, group->rm_eo - group->rm_so)) return 0;
+        }
+        i++;
+        literal_start = i + 1;
+    }
+    return buffer_append(out, replace + literal_start, rule->replace_length - literal_start);
+}
+
+/*
+ * Rewrites the next input bytes of a stage into out, holding back the bytes a
+ * match could still need until more input or the final call comes. A regex
+ * match is settled once REWRITE_MAX_MATCH bytes follow its start.
+ */
+int rewrite_stage_feed(rewrite_stage* stage, const char* data, size_t length, int final, byte_buffer* out) {
+    if (!buffer_append(&stage->held, data, length)) return 0;
+    const rewrite_rule* rule = stage->rule;
+    const char* text = stage->held.data;
+    size_t held = stage->held.length;
+    size_t position = 0;
+    size_t keep;
+    int ok = 1;
+
+    if (rule->action == REWRITE_BODY_LITERAL) {
+        const char* match;
+        while (ok && position < held &&
+               (match = memmem(text + position, held - position, rule->find, rule->find_length)) != NULL) {
+            ok = buffer_append(out, text + position, match - text - position) &&
+                 buffer_append(out, rule->replace, rule->replace_length);
+            position = match - text + rule->find_length;
+        }
+        keep = rule->find_length - 1;  // A match can still start in these bytes
+    } else {
+        regmatch_t groups[10];
+        while (ok && position < held) {
+            groups[0].rm_so = position;
+            groups[0].rm_eo = held;
+            int flags = REG_STARTEND | (stage->offset > 0 ? REG_NOTBOL : 0) | (final ? 0 : REG_NOTEOL);
+            if (regexec(&rule->pattern, text, 10, groups, flags) != 0) break;
+            size_t start = groups[0].rm_so;
+            size_t end = groups[0].rm_eo;
+            if (!final && start + REWRITE_MAX_MATCH > held) break;  // More input could still change it
+            if (end == start) {
+                // Empty matches replace nothing
+                if (start >= held) break;
+                ok = buffer_append(out, text + position, start + 1 - position);
+                position = start + 1;
+                continue;
+            }
+            ok = buffer_append(out, text + position, start - position) && rewrite_expand(rule, text, groups, out);
+            position = end;
+        }
+        keep = REWRITE_MAX_MATCH;
+    }
+
+    if (final) keep = 0;
+    size_t emit_end = held - position > keep ? held - keep : position;
+    ok = ok && buffer_append(out, text + position, emit_end - position);
+    if (held > emit_end) memmove(stage->held.data, text + emit_end, held - emit_end);
+    stage->held.length = held - emit_end;
+    stage->offset += emit_end;
+    return ok;
+}
+
+/*
+ * Rewrites the next raw body bytes of a message into out; final marks the end
+ * of the body. Chunked input is decoded before the rules see it, chunked
+ * output is encoded again and ends with the last chunk. Returns 0 on
+ * allocation failure.
+ */
+int body_rewriter_feed(body_rewriter* rewriter, const char* data, size_t length, int final, byte_buffer* out) {
+    byte_buffer* input = &rewriter->scratch[0];
+    input->length = 0;
+    if (length > 0 && !buffer_reserve(input, length)) return 0;
+    body_decode(&rewriter->decoder, data, length, input->data, &input->length);
+
+    for (size_t i = 0; i < rewriter->count; i++) {
+        byte_buffer* output = &rewriter->scratch[(i + 1) % 2];
+        output->length = 0;
+        if (!rewrite_stage_feed(&rewriter->stages[i], input->data, input->length, final, output)) return 0;
+        input = output;
+    }
+
+    if (!rewriter->chunked) return buffer_append(out, input->data, input->length);
+    if (input->length > 0) {
+        char size_line[32];
+        int size_length = snprintf(size_line, sizeof(size_line), "%zx\r\n", input->length);
+        if (!buffer_append(out, size_line, size_length) || !buffer_append(out, input->data, input->length) ||
+            !buffer_append(out, "\r\n", 2)) {
+            return 0;
+        }
+    }
+    return !final || buffer_append(out, "0\r\n\r\n", 5);
+}
+
+/*
+ * Applies the rules to a buffered message whose body is framed as framing
+ * says. When anything changes, *message is replaced by the rewritten message
+ * with room for reserve more bytes, and a rewritten body gets a new
+ * Content-Length. *head_length includes the blank line. Returns 0 when the
+ * message could not be rewritten.
+ */
+int rewrite_message(const rewrite_rules_t* rules, int direction, const char* host, const body_framing* framing,
+                    char** message, size_t* length, size_t* capacity, size_t* head_length, size_t reserve) {
+    body_rewriter rewriter;
+    size_t body_rules = body_rewriter_init(&rewriter, rules, direction, host, *message, *head_length, framing);
+    if (body_rules == 0 && !rewrite_head_applies(rules, direction, host)) {
+        body_rewriter_free(&rewriter);
+        return 1;
+    }
+
+    byte_buffer body = {0};
+    byte_buffer out = {0};
+    const char* body_data = *message + *head_length;
+    size_t body_length = *length - *head_length;
+    char framing_header[64];
+    int ok = 1;
+    if (body_rules > 0) {
+        ok = body_rewriter_feed(&rewriter, body_data, body_length, 1, &body);
+        body_data = body.data;
+        body_length = body.length;
+        snprintf(framing_header, sizeof(framing_header), "Content-Length: %zu", body_length);
+    }
+    ok = ok && rewrite_head(rules, direction, host, *message, *head_length, body_rules > 0 ? framing_header : NULL, &out);
+    size_t new_head_length = out.length;
+    ok = ok && buffer_append(&out, body_data, body_length) && buffer_reserve(&out, reserve);
+    body_rewriter_free(&rewriter);
+    free(body.data);
+    if (!ok) {
+        free(out.data);
+        return 0;
+    }
+
+    free(*message);
+    *message = out.data;
+    *length = out.length;
+    *capacity = out.capacity;
+    *head_length = new_head_length;
+    return 1;
+}
+
+/*
+ * Prepares a response that is streamed to the client. Returns 1 with the
+ * rewritten head in head when rules apply to it, and sets up rewriter when
+ * body rules do. The new body length is not known up front: HTTP/1.1 clients
+ * get it chunked, others until the connection closes, clearing *keep_alive.
+ */
+int rewrite_stream_start(const rewrite_rules_t* rules, const char* host, const char* response, size_t head_length,
+                         const char* method, const char* protocol, body_rewriter* rewriter, byte_buffer* head,
+                         int* keep_alive) {
+    body_framing framing;
+    init_response_framing(&framing, response, head_length, method);
+    size_t body_rules = body_rewriter_init(rewriter, rules, REWRITE_RESPONSES, host, response, head_length, &framing);
+    if (body_rules == 0 && !rewrite_head_applies(rules, REWRITE_RESPONSES, host)) return 0;
+
+    const char* framing_header = NULL;
+    if (body_rules > 0) {
+        rewriter->chunked = strcmp(protocol, "HTTP/1.1") == 0;
+        framing_header = rewriter->chunked ? "Transfer-Encoding: chunked" : "Connection: close";
+    }
+    if (!rewrite_head(rules, REWRITE_RESPONSES, host, response, head_length, framing_header, head)) {
+        fprintf(stderr, "Failed to rewrite a response\n");
+        body_rewriter_free(rewriter);
+        free(head->data);
+        memset(head, 0, sizeof(*head));
+        return 0;
+    }
+    if (body_rules > 0 && !rewriter->chunked) *keep_alive = 0;
+    return 1;
+}
+
+// What the GUI has been shown of a streamed response so far
+typedef struct {
+    uint32_t message_id;
+    const char* head;
+    size_t head_length;
+    char preview[STREAM_PREVIEW_SIZE];
+    size_t preview_length;
+    int streaming;  // The preview went out, the body follows in DATA frames
+} gui_stream;
+
+// Shows the GUI the next body bytes sent to the client
+void gui_stream_body(gui_stream* stream, const char* data, size_t length) {
+    // Hand the GUI a preview as soon as the body outgrows it
+    if (!stream->streaming && stream->preview_length + length > STREAM_PREVIEW_SIZE) {
+        memcpy(stream->preview + stream->preview_length, data, STREAM_PREVIEW_SIZE - stream->preview_length);
+        gui_notify(FRAME_RESPONSE, FRAME_FLAG_PREVIEW, stream->message_id, stream->head, stream->head_length - 4,
+                   stream->preview, STREAM_PREVIEW_SIZE);
+        if (stream->preview_length > 0) {
+            gui_notify(FRAME_DATA, 0, stream->message_id, NULL, 0, stream->preview, stream->preview_length);
+        }
+        stream->streaming = 1;
+    }
+    if (stream->streaming) {
+        gui_notify(FRAME_DATA, 0, stream->message_id, NULL, 0, data, length);
+    } else {
+        memcpy(stream->preview + stream->preview_length, data, length);
+        stream->preview_length += length;
+    }
+}
+
+/*
+ * Streaming pass-through: sends the head and the body bytes already buffered,
+ * then relays the rest of the body to the client as it arrives, through
+ * rewriter when one is given. The GUI gets the whole response in one frame if
+ * it is small, otherwise a truncated preview followed by the full body in DATA frames.
+ */
+int stream_response(int client_socket, int server_socket, const char* head, size_t head_length,
+                    const char* body, size_t body_length, body_framing* framing, uint32_t message_id,
+                    body_rewriter* rewriter) {
+    gui_stream stream;
+    stream.message_id = message_id;
+    stream.head = head;
+    stream.head_length = head_length;
+    stream.preview_length = 0;
+    stream.streaming = 0;
+
+    byte_buffer rewritten = {0};
+    int sent = 1;
+    if (rewriter != NULL) {
+        sent = body_rewriter_feed(rewriter, body, body_length, framing->done, &rewritten);
+        body = rewritten.data;
+        body_length = rewritten.length;
+    }
+    // Unless rewritten, the head and the buffered body bytes go out in one send
+    if (body == head + head_length) {
+        sent = send_all(client_socket, head, head_length + body_length);
+    } else {
+        sent = sent && send_all(client_socket, head, head_length) && send_all(client_socket, body, body_length);
+    }
+    if (!sent) {
+        free(rewritten.data);
+        return 0;
+    }
+    atomic_fetch_add(&metrics.client_bytes_sent, head_length + body_length);
+    if (body_length > 0) gui_stream_body(&stream, body, body_length);
+
+    char chunk[RELAY_CHUNK_SIZE];
+    while (sent && !framing->done) {
+        ssize_t received = recv(server_socket, chunk, sizeof(chunk), 0);
+        size_t used = 0;
+        if (received > 0) {
+            used = body_consume(framing, chunk, received);
+        } else if (received == 0 && framing->close_delimited) {
+            framing->done = 1;  // The server closing the connection ends the body
+        } else {
+            break;
+        }
+
+        const char* piece = chunk;
+        if (rewriter != NULL) {
+            rewritten.length = 0;
+            if (!body_rewriter_feed(rewriter, chunk, used, framing->done, &rewritten)) {
+                sent = 0;
+                break;
+            }
+            piece = rewritten.data;
+            used = rewritten.length;
+        }
+        if (used == 0) continue;
+        sent = send_all(client_socket, piece, used);
+        if (!sent) break;
+        atomic_fetch_add(&metrics.client_bytes_sent, used);
+        gui_stream_body(&stream, piece, used);
+    }
+    free(rewritten.data);
+
+    if (stream.streaming) {
+        gui_notify(FRAME_DATA, FRAME_FLAG_END, message_id, NULL, 0, NULL, 0);
+    } else {
+        gui_notify(FRAME_RESPONSE, 0, message_id, head, head_length - 4, stream.preview, stream.preview_length);
+    }
+    return sent && framing->done;
+}
+
+/*
+ * Upstream connection pool. Idle keep-alive connections are kept per host:port
+ * in a small hash table and handed out again to later requests for that host.
+ */
+typedef struct pooled_connection {
+    char host[256];
+    int port;
+    int socket;
+    time_t idle_since;
+    struct pooled_connection* next;
+} pooled_connection;
+
+typedef struct {
+    unsigned long hits;  // Requests sent on a reused upstream connection
+    unsigned long misses;  // Requests that needed a new upstream connection
+    unsigned long stale;  // Idle connections found closed by the server
+    unsigned long expired;  // Idle connections closed by the proxy
+    unsigned long idle;  // Connections currently idle in the pool
+    unsigned long client_connections;
+    unsigned long client_requests;
+} pool_stats_t;
+
+pooled_connection* connection_pool[POOL_BUCKETS];
+pool_stats_t pool_stats;
+pthread_mutex_t pool_lock = PTHREAD_MUTEX_INITIALIZER;
+
+unsigned int pool_bucket(const char* host, int port) {
+    unsigned int hash = 5381;
+    for (const char* c = host; *c; c++) hash = hash * 33 + (unsigned char)*c;
+    return (hash + port) % POOL_BUCKETS;
+}
+
+// An idle connection is usable if the server has neither closed it nor sent anything
+int connection_alive(int socket) {
+    char probe;
+    ssize_t n = recv(socket, &probe, 1, MSG_PEEK | MSG_DONTWAIT);
+    return n < 0 && (errno == EAGAIN || errno == EWOULDBLOCK);
+}
+
+/*
+ * Phase timings of one exchange, in microseconds of the monotonic clock. The
+ * phases follow each other, so they add up to the total minus proxy overhead.
+ */
+typedef struct {
+    long long start;
+    long long request_hold;  // Waiting for the GUI's verdict on the request
+    long long dns;
+    long long connect;
+    long long wait;  // Sending the request until the response head arrived
+    long long download;  // Buffering a held or cacheable response body
+    long long response_hold;
+    long long send;  // Writing or streaming the response to the client
+} request_timing;
+
+long long monotonic_us() {
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (long long)now.tv_sec * 1000000 + now.tv_nsec / 1000;
+}
+
+// Formats the timings as "name value" lines for a FRAME_TIMING body
+int format_request_timing(const request_timing* timing, char* out, size_t size) {
+    return snprintf(out, size,
+        "total_us %lld\n"
+        "request_hold_us %lld\n"
+        "dns_us %lld\n"
+        "connect_us %lld\n"
+        "wait_us %lld\n"
+        "download_us %lld\n"
+        "response_hold_us %lld\n"
+        "send_us %lld\n",
+        monotonic_us() - timing->start, timing->request_hold, timing->dns, timing->connect,
+        timing->wait, timing->download, timing->response_hold, timing->send);
+}
+
+// Records the duration of a finished exchange and sends its phase timings to the GUI
+void report_request_timing(const request_timing* timing, uint32_t message_id) {
+    observe_request_duration(monotonic_us() - timing->start);
+    char timing_text[512];
+    int timing_length = format_request_timing(timing, timing_text, sizeof(timing_text));
+    gui_notify(FRAME_TIMING, 0, message_id, NULL, 0, timing_text, timing_length);
+}
+
+/*
+ * DNS cache shared by all worker threads. Answers are kept for a fixed TTL,
+ * failures for a shorter one. Only the first thread asking for a host runs
+ * the lookup; threads asking for it meanwhile wait for that answer.
+ */
+typedef struct dns_entry {
+    char host[256];
+    struct in_addr address;
+    int resolved;  // 0 for a cached failure
+    int pending;  // A lookup for this host is in progress
+    time_t expires;
+    struct dns_entry* next;
+} dns_entry;
+
+typedef struct {
+    unsigned long hits;
+    unsigned long misses;
+    unsigned long coalesced;  // Requests that waited for another thread's lookup
+    unsigned long negative_hits;
+    unsigned long entries;
+} dns_stats_t;
+
+dns_entry* dns_cache[DNS_CACHE_BUCKETS];
+dns_stats_t dns_stats;
+pthread_mutex_t dns_lock = PTHREAD_MUTEX_INITIALIZER;
+pthread_cond_t dns_ready = PTHREAD_COND_INITIALIZER;
+
+unsigned int dns_bucket(const char* host) {
+    unsigned int hash = 5381;
+    for (const char* c = host; *c; c++) hash = hash * 33 + (unsigned char)tolower(*c);
+    return hash % DNS_CACHE_BUCKETS;
+}
+
+// Resolves host to an IPv4 address through the cache; returns 1 on success
+int resolve_host(const char* host, struct in_addr* address) {
+    unsigned int bucket = dns_bucket(host);
+
+    pthread_mutex_lock(&dns_lock);
+    dns_entry* entry = dns_cache[bucket];
+    while (entry != NULL && strcasecmp(entry->host, host) != 0) entry = entry->next;
+
+    if (entry != NULL && entry->pending) {
+        dns_stats.coalesced++;
+        while (entry->pending) pthread_cond_wait(&dns_ready, &dns_lock);
+        int resolved = entry->resolved;
+        *address = entry->address;
+        pthread_mutex_unlock(&dns_lock);
+        return resolved;
+    }
+
+    if (entry != NULL && entry->expires > time(NULL)) {
+        if (entry->resolved) dns_stats.hits++;
+        else dns_stats.negative_hits++;
+        int resolved = entry->resolved;
+        *address = entry->address;
+        pthread_mutex_unlock(&dns_lock);
+        return resolved;
+    }
+
+    if (entry == NULL) {
+        entry = calloc(1, sizeof(dns_entry));
+        if (entry == NULL) {
+            pthread_mutex_unlock(&dns_lock);
+            return 0;
+        }
+        strncpy(entry->host, host, sizeof(entry->host) - 1);
+        entry->next = dns_cache[bucket];
+        dns_cache[bucket] = entry;
+        dns_stats.entries++;
+    }
+    entry->pending = 1;
+    dns_stats.misses++;
+    pthread_mutex_unlock(&dns_lock);
+
+    // The lookup itself runs without the lock, other hosts resolve concurrently
+    struct addrinfo hints, *result = NULL;
+    memset(&hints, 0, sizeof(hints));
+    hints.ai_family = AF_INET;
+    hints.ai_socktype = SOCK_STREAM;
+    int error = getaddrinfo(host, NULL, &hints, &result);
+    if (error != 0) fprintf(stderr, "Host resolution failed for %s: %s\n", host, gai_strerror(error));
+
+    pthread_mutex_lock(&dns_lock);
+    entry->resolved = error == 0 && result != NULL;
+    if (entry->resolved) entry->address = ((struct sockaddr_in*)result->ai_addr)->sin_addr;
+    entry->expires = time(NULL) + (entry->resolved ? DNS_POSITIVE_TTL_SECONDS : DNS_NEGATIVE_TTL_SECONDS);
+    entry->pending = 0;
+    int resolved = entry->resolved;
+    *address = entry->address;
+    pthread_cond_broadcast(&dns_ready);
+    pthread_mutex_unlock(&dns_lock);
+
+    if (result != NULL) freeaddrinfo(result);
+    return resolved;
+}
+
+// Drops expired answers so hosts that are not asked for again do not pile up
+void dns_cache_sweep() {
+    time_t now = time(NULL);
+    pthread_mutex_lock(&dns_lock);
+    for (int bucket = 0; bucket < DNS_CACHE_BUCKETS; bucket++) {
+        dns_entry** link = &dns_cache[bucket];
+        while (*link != NULL) {
+            dns_entry* entry = *link;
+            if (!entry->pending && entry->expires <= now) {
+                *link = entry->next;
+                free(entry);
+                dns_stats.entries--;
+            } else {
+                link = &entry->next;
+            }
+        }
+    }
+    pthread_mutex_unlock(&dns_lock);
+}
+
+// Connects to host:port; timing, if not NULL, collects the DNS and connect durations
+int connect_upstream(const char* host, int port, request_timing* timing) {
+    long long started = monotonic_us();
+    struct in_addr address;
+    int resolved = resolve_host(host, &address);
+    long long resolved_at = monotonic_us();
+    if (timing != NULL) timing->dns += resolved_at - started;
+    if (!resolved) return -1;
+
+    int server_socket = socket(AF_INET, SOCK_STREAM, 0);
+    if (server_socket < 0) return -1;
+
+    struct sockaddr_in server_addr;
+    memset(&server_addr, 0, sizeof(server_addr));
+    server_addr.sin_family = AF_INET;
+    server_addr.sin_addr = address;
+    server_addr.sin_port = htons(port);
+
+    int connected = connect(server_socket, (struct sockaddr*)&server_addr, sizeof(server_addr)) == 0;
+    if (timing != NULL) timing->connect += monotonic_us() - resolved_at;
+    if (!connected) {
+        perror("Failed to connect to server");
+        close(server_socket);
+        return -1;
+    }
+
+    // Guard against servers that stall, the body itself ends on its framing
+    struct timeval timeout;
+    timeout.tv_sec = UPSTREAM_TIMEOUT_SECONDS;
+    timeout.tv_usec = 0;
+    if (setsockopt(server_socket, SOL_SOCKET, SO_RCVTIMEO, &timeout, sizeof(timeout)) < 0) {
+        perror("setsockopt failed");
+    }
+    return server_socket;
+}
+
+// Returns an upstream connection for host:port, reused from the pool when possible
+int pool_acquire(const char* host, int port, int* reused, request_timing* timing) {
+    unsigned int bucket = pool_bucket(host, port);
+    time_t now = time(NULL);
+
+    pthread_mutex_lock(&pool_lock);
+    pooled_connection** link = &connection_pool[bucket];
+    while (*link != NULL) {
+        pooled_connection* entry = *link;
+        if (entry->port != port || strcmp(entry->host, host) != 0) {
+            link = &entry->next;
+            continue;
+        }
+        *link = entry->next;
+        pool_stats.idle--;
+
+        int expired = now - entry->idle_since >= POOL_IDLE_TIMEOUT_SECONDS;
+        if (!expired && connection_alive(entry->socket)) {
+            int server_socket = entry->socket;
+            pool_stats.hits++;
+            pthread_mutex_unlock(&pool_lock);
+            free(entry);
+            *reused = 1;
+            return server_socket;
+        }
+        if (expired) pool_stats.expired++;
+        else pool_stats.stale++;
+        close(entry->socket);
+        free(entry);
+    }
+    pool_stats.misses++;
+    pthread_mutex_unlock(&pool_lock);
+
+    *reused = 0;
+    return connect_upstream(host, port, timing);
+}
+
+// Puts a connection back in the pool, or closes it if it cannot carry another request
+void pool_release(const char* host, int port, int server_socket, int reusable) {
+    if (!reusable) {
+        close(server_socket);
+        return;
+    }
+
+    pooled_connection* entry = malloc(sizeof(pooled_connection));
+    if (entry == NULL) {
+        close(server_socket);
+        return;
+    }
+    strncpy(entry->host, host, sizeof(entry->host) - 1);
+    entry->host[sizeof(entry->host) - 1] = '\0';
+    entry->port = port;
+    entry->socket = server_socket;
+    entry->idle_since = time(NULL);
+
+    unsigned int bucket = pool_bucket(host, port);
+    pthread_mutex_lock(&pool_lock);
+
+    // Enforce the per-host limit by dropping the oldest idle connection (kept at the tail)
+    int count = 0;
+    pooled_connection** oldest = NULL;
+    for (pooled_connection** link = &connection_pool[bucket]; *link != NULL; link = &(*link)->next) {
+        if ((*link)->port == port && strcmp((*link)->host, host) == 0) {
+            count++;
+            oldest = link;
+        }
+    }
+    if (count >= POOL_MAX_IDLE_PER_HOST) {
+        pooled_connection* victim = *oldest;
+        *oldest = victim->next;
+        close(victim->socket);
+        free(victim);
+        pool_stats.expired++;
+        pool_stats.idle--;
+    }
+
+    entry->next = connection_pool[bucket];
+    connection_pool[bucket] = entry;
+    pool_stats.idle++;
+    pthread_mutex_unlock(&pool_lock);
+}
+
+// Closes idle connections that outlived POOL_IDLE_TIMEOUT_SECONDS and expires DNS answers
+void* pool_reaper(void* arg) {
+    while (1) {
+        sleep(5);
+        dns_cache_sweep();
+        time_t now = time(NULL);
+        pthread_mutex_lock(&pool_lock);
+        for (int bucket = 0; bucket < POOL_BUCKETS; bucket++) {
+            pooled_connection** link = &connection_pool[bucket];
+            while (*link != NULL) {
+                pooled_connection* entry = *link;
+                if (now - entry->idle_since >= POOL_IDLE_TIMEOUT_SECONDS) {
+                    *link = entry->next;
+                    close(entry->socket);
+                    free(entry);
+                    pool_stats.expired++;
+                    pool_stats.idle--;
+                } else {
+                    link = &entry->next;
+                }
+            }
+        }
+        pthread_mutex_unlock(&pool_lock);
+    }
+    return NULL;
+}
+
+// Returns 1 if the header's comma separated value contains token
+int header_has_token(const char* head, size_t head_length, const char* name, const char* token) {
+    size_t value_length;
+    const char* value = find_header(head, head_length, name, &value_length);
+    size_t token_length = strlen(token);
+    if (value == NULL) return 0;
+    for (size_t i = 0; i + token_length <= value_length; i++) {
+        if (strncasecmp(value + i, token, token_length) == 0) return 1;
+    }
+    return 0;
+}
+
+// HTTP/1.1 messages are persistent unless they say "close", HTTP/1.0 ones only with "keep-alive"
+int message_keeps_alive(const char* head, size_t head_length, const char* version) {
+    if (header_has_token(head, head_length, "Connection", "close") ||
+        header_has_token(head, head_length, "Proxy-Connection", "close")) {
+        return 0;
+    }
+    if (strstr(version, "HTTP/1.0") != NULL) {
+        return header_has_token(head, head_length, "Connection", "keep-alive") ||
+               header_has_token(head, head_length, "Proxy-Connection", "keep-alive");
+    }
+    return 1;
+}
+
+/*
+ * Response cache for GET requests, shared by all worker threads. Responses are
+ * stored as received from the origin, keyed by host, port and URL plus the
+ * request's Accept-Encoding, the only Vary header that is supported. An entry
+ * is fresh for the lifetime given by Cache-Control or Expires, or a tenth of
+ * its Last-Modified age; a stale entry with an ETag or Last-Modified is
+ * revalidated with a conditional request. The memory tier evicts the least
+ * recently used responses beyond CACHE_MAX_BYTES. With a cache directory the
+ * responses are also written to disk and read back once they left memory.
+ * Only one request fetches a given key at a time, the others wait for it.
+ */
+enum { CACHE_BYPASS, CACHE_MISS, CACHE_HIT, CACHE_STALE };
+
+typedef struct cache_entry {
+    char* key;  // "host:port url", "\n" and the request's Accept-Encoding
+    size_t url_key_length;  // Length of the part before "\n", shared by every variant of a URL
+    unsigned int hash;  // Of the URL part, so the variants of a URL share a bucket
+    char* response;  // Head and body as received, NULL while the entry is only on disk
+    size_t length;
+    size_t head_length;  // Including the blank line
+    time_t stored_at;  // When the response was received or last revalidated
+    time_t expires;
+    long initial_age;  // Age of the response when it was received
+    int revalidate;  // no-cache: confirmed with the origin before every use
+    int validators;  // The response has an ETag or Last-Modified
+    int on_disk;
+    struct cache_entry* next;  // Hash chain
+    struct cache_entry *newer, *older;  // Memory LRU list, while response is set
+    struct cache_entry *disk_newer, *disk_older;  // Disk list in store order, while on_disk is set
+} cache_entry;
+
+typedef struct cache_lookup {
+    int state;
+    int invalidates;  // Unsafe method, every stored variant of the URL is dropped
+    int revalidate;  // The client asked for an end-to-end check (no-cache, max-age=0)
+    int conditional;  // The client sent validators of its own
+    int validating;  // Validators of the stale entry were added to the request
+    int fetching;  // Listed in cache_fetches until cache_end
+    char key[CACHE_KEY_SIZE];
+    size_t url_key_length;
+    unsigned int hash;
+    char* response;  // Copy of the entry for a hit or a revalidation, with room for GUI edits
+    size_t length;
+    size_t head_length;
+    size_t capacity;
+    struct cache_lookup* next;
+} cache_lookup;
+
+typedef struct {
+    unsigned long lookups;
+    unsigned long hits;
+    unsigned long revalidated;  // Stale entries confirmed by a 304
+    unsigned long misses;
+    unsigned long coalesced;  // Lookups that waited for another request's fetch
+    unsigned long disk_reads;
+    unsigned long stores;
+    unsigned long evictions;
+    unsigned long invalidations;
+    unsigned long entries;
+    unsigned long long memory_bytes;
+    unsigned long long disk_bytes;
+} cache_stats_t;
+
+#define CACHE_FILE_MAGIC "PXC1"
+
+// Start of every file in the cache directory, followed by the key and the response
+typedef struct {
+    char magic[4];
+    uint32_t key_length;
+    uint64_t length;
+    uint64_t head_length;
+    int64_t stored_at;
+    int64_t expires;
+    int64_t initial_age;
+    int32_t revalidate;
+    int32_t validators;
+} cache_file_header;
+
+cache_entry* response_cache[CACHE_BUCKETS];
+cache_entry *cache_lru_newest = NULL, *cache_lru_oldest = NULL;
+cache_entry *cache_disk_newest = NULL, *cache_disk_oldest = NULL;
+cache_lookup* cache_fetches = NULL;  // Misses and revalidations in progress
+cache_stats_t cache_stats;
+const char* cache_directory = NULL;  // Optional disk tier, from PROXY_CACHE_DIR
+pthread_mutex_t cache_lock = PTHREAD_MUTEX_INITIALIZER;
+pthread_cond_t cache_ready = PTHREAD_COND_INITIALIZER;
+
+// Value of a Cache-Control directive: -1 when it is absent, 0 when it has no value
+long cache_control_directive(const char* head, size_t head_length, const char* directive) {
+    size_t value_length;
+    const char* value = find_header(head, head_length, "Cache-Control", &value_length);
+    if (value == NULL) return -1;
+
+    size_t directive_length = strlen(directive);
+    const char* end = value + value_length;
+    for (const char* item = value; item < end;) {
+        while (item < end && (*item == ' ' || *item == ',')) item++;
+        const char* item_end = memchr(item, ',', end - item);
+        if (item_end == NULL) item_end = end;
+        if ((size_t)(item_end - item) >= directive_length && strncasecmp(item, directive, directive_length) == 0) {
+            const char* rest = item + directive_length;
+            while (rest < item_end && *rest == ' ') rest++;
+            if (rest == item_end) return 0;
+            if (*rest == '=') {
+                rest++;
+                if (rest < item_end && *rest == '"') rest++;
+                long seconds = strtol(rest, NULL, 10);
+                return seconds > 0 ? seconds : 0;
+            }
+        }
+        item = item_end;
+    }
+    return -1;
+}
+
+// Parses an IMF-fixdate ("Sun, 06 Nov 1994 08:49:37 GMT"), -1 if it is not one
+time_t parse_http_date(const char* value, size_t length) {
+    char text[64];
+    if (length >= sizeof(text)) return -1;
+    memcpy(text, value, length);
+    text[length] = '\0';
+
+    struct tm date;
+    memset(&date, 0, sizeof(date));
+    if (strptime(text, "%a, %d %b %Y %H:%M:%S", &date) == NULL) return -1;
+    return timegm(&date);
+}
+
+// Freshness lifetime of a response in seconds, or -1 if it must not be stored
+long response_freshness(const char* head, size_t head_length, time_t now, int* revalidate) {
+    if (cache_control_directive(head, head_length, "no-store") >= 0 ||
+        cache_control_directive(head, head_length, "private") >= 0) {
+        return -1;
+    }
+    *revalidate = cache_control_directive(head, head_length, "no-cache") >= 0;
+
+    long lifetime = cache_control_directive(head, head_length, "s-maxage");
+    if (lifetime < 0) lifetime = cache_control_directive(head, head_length, "max-age");
+    if (lifetime >= 0) return lifetime;
+
+    size_t value_length;
+    const char* value = find_header(head, head_length, "Date", &value_length);
+    time_t date = value != NULL ? parse_http_date(value, value_length) : -1;
+    if (date < 0) date = now;
+
+    if ((value = find_header(head, head_length, "Expires", &value_length)) != NULL) {
+        // An invalid date such as "0" means already expired
+        time_t expires = parse_http_date(value, value_length);
+        return expires > date ? (long)(expires - date) : 0;
+    }
+    if ((value = find_header(head, head_length, "Last-Modified", &value_length)) != NULL) {
+        time_t modified = parse_http_date(value, value_length);
+        if (modified >= 0 && modified < date) {
+            long heuristic = (date - modified) / 10;
+            return heuristic < CACHE_HEURISTIC_MAX_SECONDS ? heuristic : CACHE_HEURISTIC_MAX_SECONDS;
+        }
+    }
+    return 0;
+}
+
+int response_has_validators(const char* head, size_t head_length) {
+    size_t value_length;
+    return find_header(head, head_length, "ETag", &value_length) != NULL ||
+           find_header(head, head_length, "Last-Modified", &value_length) != NULL;
+}
+
+// Returns 1 if a response may be stored once its body is buffered
+int cache_response_storable(const char* response, size_t head_length, const body_framing* framing) {
+    switch (framing->status) {
+        case 200: case 203: case 300: case 301: case 308: case 404: case 410:
+            break;
+        default:
+            return 0;
+    }
+    if (framing->close_delimited) return 0;
+
+    size_t value_length;
+    if (find_header(response, head_length, "Set-Cookie", &value_length) != NULL) return 0;
+    const char* vary = find_header(response, head_length, "Vary", &value_length);
+    if (vary != NULL && !(value_length == 15 && strncasecmp(vary, "Accept-Encoding", 15) == 0)) return 0;
+    const char* content_length = find_header(response, head_length, "Content-Length", &value_length);
+    if (content_length != NULL && strtoll(content_length, NULL, 10) > CACHE_MAX_OBJECT_SIZE) return 0;
+
+    int revalidate = 0;
+    long lifetime = response_freshness(response, head_length, time(NULL), &revalidate);
+    if (lifetime < 0) return 0;
+    return (lifetime > 0 && !revalidate) || response_has_validators(response, head_length);
+}
+
+// Prepares the lookup of a request, whose head ends at head_length
+void cache_lookup_init(cache_lookup* lookup, const char* host, int port, const char* request, size_t head_length) {
+    memset(lookup, 0, sizeof(*lookup));
+    char method[16] = "", url[1024] = "";
+    sscanf(request, "%15s %1023s", method, url);
+
+    size_t value_length = 0;
+    const char* encoding = find_header(request, head_length, "Accept-Encoding", &value_length);
+    int used = snprintf(lookup->key, sizeof(lookup->key), "%s:%d %s", host, port, url);
+    lookup->url_key_length = used;
+    snprintf(lookup->key + used, sizeof(lookup->key) - used, "\n%.*s",
+             encoding != NULL ? (int)value_length : 0, encoding != NULL ? encoding : "");
+    lookup->hash = domain_hash(lookup->key, lookup->url_key_length);
+
+    lookup->invalidates = strcmp(method, "GET") != 0 && strcmp(method, "HEAD") != 0 &&
+                          strcmp(method, "OPTIONS") != 0 && strcmp(method, "TRACE") != 0;
+    if (strcmp(method, "GET") != 0 ||
+        find_header(request, head_length, "Authorization", &value_length) != NULL ||
+        find_header(request, head_length, "Range", &value_length) != NULL ||
+        cache_control_directive(request, head_length, "no-store") >= 0) {
+        lookup->state = CACHE_BYPASS;
+        return;
+    }
+    lookup->state = CACHE_MISS;
+    lookup->revalidate = cache_control_directive(request, head_length, "no-cache") >= 0 ||
+                         cache_control_directive(request, head_length, "max-age") == 0 ||
+                         header_has_token(request, head_length, "Pragma", "no-cache");
+    lookup->conditional = find_header(request, head_length, "If-None-Match", &value_length) != NULL ||
+                          find_header(request, head_length, "If-Modified-Since", &value_length) != NULL;
+}
+
+void cache_file_path(const char* key, char* path, size_t size) {
+    unsigned long long hash = 14695981039346656037ULL;
+    for (const char* c = key; *c; c++) hash = (hash ^ (unsigned char)*c) * 1099511628211ULL;
+    snprintf(path, size, "%s/%016llx.cache", cache_directory, hash);
+}
+
+// Writes a stored response to the cache directory, replacing its file atomically
+void cache_disk_write(const char* key, const cache_file_header* header, const char* response) {
+    char path[PATH_MAX], temporary[PATH_MAX + 32];
+    cache_file_path(key, path, sizeof(path));
+    snprintf(temporary, sizeof(temporary), "%s.%lx.tmp", path, (unsigned long)pthread_self());
+
+    FILE* file = fopen(temporary, "wb");
+    if (file == NULL) {
+        perror("Failed to write cache file");
+        return;
+    }
+    int written = fwrite(header, sizeof(*header), 1, file) == 1 &&
+                  fwrite(key, header->key_length, 1, file) == 1 &&
+                  fwrite(response, header->length, 1, file) == 1;
+    if (fclose(file) != 0) written = 0;
+    if (!written || rename(temporary, path) != 0) {
+        perror("Failed to write cache file");
+        unlink(temporary);
+    }
+}
+
+// Reads a stored response back; NULL if the file is gone or holds another key
+char* cache_disk_read(const char* key, size_t length) {
+    char path[PATH_MAX];
+    cache_file_path(key, path, sizeof(path));
+    FILE* file = fopen(path, "rb");
+    if (file == NULL) return NULL;
+
+    cache_file_header header;
+    char stored_key[CACHE_KEY_SIZE];
+    char* response = NULL;
+    if (fread(&header, sizeof(header), 1, file) == 1 && memcmp(header.magic, CACHE_FILE_MAGIC, 4) == 0 &&
+        header.key_length < sizeof(stored_key) && header.length == length &&
+        fread(stored_key, header.key_length, 1, file) == 1) {
+        stored_key[header.key_length] = '\0';
+        if (strcmp(stored_key, key) == 0 && (response = malloc(length)) != NULL &&
+            fread(response, length, 1, file) != 1) {
+            free(response);
+            response = NULL;
+        }
+    }
+    fclose(file);
+    return response;
+}
+
+// The list functions and everything below until cache_begin expect cache_lock to be held
+void cache_lru_unlink(cache_entry* entry) {
+    if (entry->newer != NULL) entry->newer->older = entry->older;
+    else cache_lru_newest = entry->older;
+    if (entry->older != NULL) entry->older->newer = entry->newer;
+    else cache_lru_oldest = entry->newer;
+    entry->newer = entry->older = NULL;
+}
+
+void cache_lru_push(cache_entry* entry) {
+    entry->older = cache_lru_newest;
+    entry->newer = NULL;
+    if (cache_lru_newest != NULL) cache_lru_newest->newer = entry;
+    else cache_lru_oldest = entry;
+    cache_lru_newest = entry;
+}
+
+void cache_disk_unlink(cache_entry* entry) {
+    if (entry->disk_newer != NULL) entry->disk_newer->disk_older = entry->disk_older;
+    else cache_disk_newest = entry->disk_older;
+    if (entry->disk_older != NULL) entry->disk_older->disk_newer = entry->disk_newer;
+    else cache_disk_oldest = entry->disk_newer;
+    entry->disk_newer = entry->disk_older = NULL;
+}
+
+void cache_disk_push(cache_entry* entry) {
+    entry->disk_older = cache_disk_newest;
+    entry->disk_newer = NULL;
+    if (cache_disk_newest != NULL) cache_disk_newest->disk_newer = entry;
+    else cache_disk_oldest = entry;
+    cache_disk_newest = entry;
+}
+
+cache_entry* cache_find(const char* key, unsigned int hash) {
+    cache_entry* entry = response_cache[hash % CACHE_BUCKETS];
+    while (entry != NULL && (entry->hash != hash || strcmp(entry->key, key) != 0)) entry = entry->next;
+    return entry;
+}
+
+void cache_drop_memory(cache_entry* entry) {
+    if (entry->response == NULL) return;
+    cache_lru_unlink(entry);
+    cache_stats.memory_bytes -= entry->length;
+    free(entry->response);
+    entry->response = NULL;
+}
+
+void cache_drop_disk(cache_entry* entry) {
+    if (!entry->on_disk) return;
+    cache_disk_unlink(entry);
+    cache_stats.disk_bytes -= entry->length;
+    entry->on_disk = 0;
+    char path[PATH_MAX];
+    cache_file_path(entry->key, path, sizeof(path));
+    unlink(path);
+}
+
+void cache_remove(cache_entry* entry) {
+    cache_entry** link = &response_cache[entry->hash % CACHE_BUCKETS];
+    while (*link != entry) link = &(*link)->next;
+    *link = entry->next;
+    cache_drop_memory(entry);
+    cache_drop_disk(entry);
+    cache_stats.entries--;
+    free(entry->key);
+    free(entry);
+}
+
+// Evicts from both tiers until they fit their budgets; an entry leaves the cache with its last copy
+void cache_enforce_limits() {
+    while (cache_stats.memory_bytes > CACHE_MAX_BYTES && cache_lru_oldest != NULL) {
+        cache_entry* victim = cache_lru_oldest;
+        cache_stats.evictions++;
+        if (victim->on_disk) cache_drop_memory(victim);
+        else cache_remove(victim);
+    }
+    while (cache_stats.disk_bytes > CACHE_DISK_MAX_BYTES && cache_disk_oldest != NULL) {
+        cache_entry* victim = cache_disk_oldest;
+        cache_stats.evictions++;
+        if (victim->response != NULL) cache_drop_disk(victim);
+        else cache_remove(victim);
+    }
+}
+
+void cache_insert(cache_entry* entry) {
+    cache_entry* old = cache_find(entry->key, entry->hash);
+    if (old != NULL) cache_remove(old);
+    unsigned int bucket = entry->hash % CACHE_BUCKETS;
+    entry->next = response_cache[bucket];
+    response_cache[bucket] = entry;
+    cache_stats.entries++;
+    if (entry->response != NULL) {
+        cache_lru_push(entry);
+        cache_stats.memory_bytes += entry->length;
+    }
+    if (entry->on_disk) {
+        cache_disk_push(entry);
+        cache_stats.disk_bytes += entry->length;
+    }
+    cache_enforce_limits();
+}
+
+/*
+ * Copies an entry into the lookup for the client, with an Age header for the
+ * time it spent in the cache. Edits in the GUI reallocate the copy. Returns 0
+ * when out of memory, leaving the previous copy in place.
+ */
+int cache_copy(const cache_entry* entry, cache_lookup* lookup, time_t now) {
+    size_t capacity = entry->length + 64;
+    char* copy = malloc(capacity + 1);
+    if (copy == NULL) return 0;
+    free(lookup->response);
+    lookup->response = copy;
+    lookup->capacity = capacity;
+
+    // Every head line but Age, ending before the blank line
+    const char* head_end = entry->response + entry->head_length - 2;
+    size_t used = 0;
+    for (const char* line = entry->response; line < head_end;) {
+        const char* line_end = memchr(line, '\n', head_end - line);
+        line_end = line_end != NULL ? line_end + 1 : head_end;
+        if (line_end - line < 4 || strncasecmp(line, "Age:", 4) != 0) {
+            memcpy(lookup->response + used, line, line_end - line);
+            used += line_end - line;
+        }
+        line = line_end;
+    }
+    long age = entry->initial_age + (long)(now - entry->stored_at);
+    used += snprintf(lookup->response + used, 64, "Age: %ld\r\n\r\n", age > 0 ? age : 0);
+    lookup->head_length = used;
+
+    size_t body_length = entry->length - entry->head_length;
+    memcpy(lookup->response + used, entry->response + entry->head_length, body_length);
+    lookup->length = used + body_length;
+    lookup->response[lookup->length] = '\0';
+    return 1;
+}
+
+void cache_fetch_register(cache_lookup* lookup) {
+    lookup->next = cache_fetches;
+    cache_fetches = lookup;
+    lookup->fetching = 1;
+}
+
+void cache_fetch_unregister(cache_lookup* lookup) {
+    if (!lookup->fetching) return;
+    cache_lookup** link = &cache_fetches;
+    while (*link != lookup) link = &(*link)->next;
+    *link = lookup->next;
+    lookup->fetching = 0;
+    pthread_cond_broadcast(&cache_ready);
+}
+
+/*
+ * Looks the request up and sets lookup->state: CACHE_HIT with a copy to send,
+ * CACHE_STALE with a copy to revalidate, or CACHE_MISS. Stale and missing keys
+ * are claimed until cache_end, so concurrent requests for them wait here.
+ */
+void cache_begin(cache_lookup* lookup) {
+    if (lookup->state == CACHE_BYPASS) return;
+
+    struct timespec deadline;
+    clock_gettime(CLOCK_REALTIME, &deadline);
+    deadline.tv_sec += CACHE_FETCH_WAIT_SECONDS;
+    int waited = 0;
+
+    pthread_mutex_lock(&cache_lock);
+    cache_stats.lookups++;
+    while (1) {
+        cache_lookup* fetch = cache_fetches;
+        while (fetch != NULL && strcmp(fetch->key, lookup->key) != 0) fetch = fetch->next;
+        if (fetch != NULL) {
+            if (!waited) cache_stats.coalesced++;
+            waited = 1;
+            if (pthread_cond_timedwait(&cache_ready, &cache_lock, &deadline) == ETIMEDOUT) {
+                // The other fetch is slow: fetch without claiming the key rather than keep holding this worker
+                lookup->state = CACHE_MISS;
+                cache_stats.misses++;
+                break;
+            }
+            continue;
+        }
+
+        cache_entry* entry = cache_find(lookup->key, lookup->hash);
+        if (entry != NULL && entry->response == NULL) {
+            // Only on disk: read it back while other requests for the key wait
+            size_t length = entry->length;
+            cache_fetch_register(lookup);
+            pthread_mutex_unlock(&cache_lock);
+            char* response = cache_disk_read(lookup->key, length);
+            pthread_mutex_lock(&cache_lock);
+            cache_fetch_unregister(lookup);
+
+            entry = cache_find(lookup->key, lookup->hash);
+            if (entry != NULL && entry->response == NULL && entry->length == length) {
+                if (response != NULL) {
+                    entry->response = response;
+                    response = NULL;
+                    cache_lru_push(entry);
+                    cache_stats.memory_bytes += length;
+                    cache_stats.disk_reads++;
+                    cache_enforce_limits();
+                } else {
+                    cache_remove(entry);
+                }
+            }
+            free(response);
+            continue;
+        }
+
+        time_t now = time(NULL);
+        if (entry != NULL && !lookup->revalidate && !entry->revalidate && now < entry->expires &&
+            cache_copy(entry, lookup, now)) {
+            cache_lru_unlink(entry);
+            cache_lru_push(entry);
+            lookup->state = CACHE_HIT;
+            cache_stats.hits++;
+        } else if (entry != NULL && entry->validators && cache_copy(entry, lookup, now)) {
+            lookup->state = CACHE_STALE;
+            cache_fetch_register(lookup);
+        } else {
+            if (entry != NULL) cache_remove(entry);
+            lookup->state = CACHE_MISS;
+            cache_stats.misses++;
+            cache_fetch_register(lookup);
+        }
+        break;
+    }
+    pthread_mutex_unlock(&cache_lock);
+}
+
+// Releases the key claimed by cache_begin, waiting requests look it up again
+void cache_end(cache_lookup* lookup) {
+    if (lookup->fetching) {
+        pthread_mutex_lock(&cache_lock);
+        cache_fetch_unregister(lookup);
+        pthread_mutex_unlock(&cache_lock);
+    }
+    free(lookup->response);
+    lookup->response = NULL;
+}
+
+// Stores a complete response from the origin, the caller checked cache_response_storable
+void cache_store(cache_lookup* lookup, const char* response, size_t length, size_t head_length) {
+    if (lookup->state == CACHE_BYPASS || length > CACHE_MAX_OBJECT_SIZE) return;
+
+    time_t now = time(NULL);
+    int revalidate = 0;
+    long lifetime = response_freshness(response, head_length, now, &revalidate);
+    size_t value_length;
+    const char* age = find_header(response, head_length, "Age", &value_length);
+    long initial_age = age != NULL ? strtol(age, NULL, 10) : 0;
+    if (initial_age < 0) initial_age = 0;
+
+    cache_entry* entry = calloc(1, sizeof(cache_entry));
+    if (entry == NULL) return;
+    entry->key = strdup(lookup->key);
+    entry->response = malloc(length);
+    if (entry->key == NULL || entry->response == NULL) {
+        free(entry->key);
+        free(entry->response);
+        free(entry);
+        return;
+    }
+    memcpy(entry->response, response, length);
+    entry->url_key_length = lookup->url_key_length;
+    entry->hash = lookup->hash;
+    entry->length = length;
+    entry->head_length = head_length;
+    entry->stored_at = now;
+    entry->expires = now + lifetime - initial_age;
+    entry->initial_age = initial_age;
+    entry->revalidate = revalidate;
+    entry->validators = response_has_validators(response, head_length);
+    entry->on_disk = cache_directory != NULL;
+
+    cache_file_header header;
+    memcpy(header.magic, CACHE_FILE_MAGIC, 4);
+    header.key_length = strlen(entry->key);
+    header.length = length;
+    header.head_length = head_length;
+    header.stored_at = entry->stored_at;
+    header.expires = entry->expires;
+    header.initial_age = entry->initial_age;
+    header.revalidate = entry->revalidate;
+    header.validators = entry->validators;
+
+    pthread_mutex_lock(&cache_lock);
+    cache_insert(entry);
+    cache_stats.stores++;
+    pthread_mutex_unlock(&cache_lock);
+
+    // A read racing this write finds no file or a complete one, never a partial one
+    if (cache_directory != NULL) cache_disk_write(lookup->key, &header, response);
+}
+
+// Applies a 304 from the origin to the stale entry and to the copy about to be sent
+void cache_refresh(cache_lookup* lookup, const char* head, size_t head_length) {
+    time_t now = time(NULL);
+    int revalidate = 0;
+    size_t value_length;
+    // Without freshness information in the 304 the stored headers still apply
+    int updated = find_header(head, head_length, "Cache-Control", &value_length) != NULL ||
+                  find_header(head, head_length, "Expires", &value_length) != NULL;
+    long lifetime = updated ? response_freshness(head, head_length, now, &revalidate)
+                            : response_freshness(lookup->response, lookup->head_length, now, &revalidate);
+
+    pthread_mutex_lock(&cache_lock);
+    cache_stats.revalidated++;
+    cache_entry* entry = cache_find(lookup->key, lookup->hash);
+    if (entry != NULL && lifetime < 0) {
+        cache_remove(entry);
+    } else if (entry != NULL) {
+        // The file keeps the old expiry, after a restart the entry is revalidated once more
+        entry->stored_at = now;
+        entry->initial_age = 0;
+        entry->expires = now + lifetime;
+        entry->revalidate = revalidate;
+        if (entry->response != NULL) {
+            cache_lru_unlink(entry);
+            cache_lru_push(entry);
+            cache_copy(entry, lookup, now);
+        }
+    }
+    pthread_mutex_unlock(&cache_lock);
+}
+
+// Drops every stored variant of the URL, called before an unsafe method reaches the origin
+void cache_invalidate(const cache_lookup* lookup) {
+    pthread_mutex_lock(&cache_lock);
+    cache_entry* entry = response_cache[lookup->hash % CACHE_BUCKETS];
+    while (entry != NULL) {
+        cache_entry* next = entry->next;
+        if (entry->url_key_length == lookup->url_key_length &&
+            memcmp(entry->key, lookup->key, lookup->url_key_length) == 0) {
+            cache_remove(entry);
+            cache_stats.invalidations++;
+        }
+        entry = next;
+    }
+    pthread_mutex_unlock(&cache_lock);
+}
+
+// Indexes the responses an earlier run left in the cache directory
+void cache_disk_load() {
+    if (mkdir(cache_directory, 0700) < 0 && errno != EEXIST) {
+        perror("Failed to create the cache directory, disk cache disabled");
+        cache_directory = NULL;
+        return;
+    }
+    DIR* directory = opendir(cache_directory);
+    if (directory == NULL) {
+        perror("Failed to open the cache directory, disk cache disabled");
+        cache_directory = NULL;
+        return;
+    }
+
+    time_t now = time(NULL);
+    struct dirent* item;
+    pthread_mutex_lock(&cache_lock);
+    while ((item = readdir(directory)) != NULL) {
+        size_t name_length = strlen(item->d_name);
+        if (name_length < 6 || strcmp(item->d_name + name_length - 6, ".cache") != 0) continue;
+
+        char path[PATH_MAX];
+        snprintf(path, sizeof(path), "%s/%s", cache_directory, item->d_name);
+        FILE* file = fopen(path, "rb");
+        if (file == NULL) continue;
+        cache_file_header header;
+        char key[CACHE_KEY_SIZE];
+        int valid = fread(&header, sizeof(header), 1, file) == 1 && memcmp(header.magic, CACHE_FILE_MAGIC, 4) == 0 &&
+                    header.key_length < sizeof(key) && header.length <= CACHE_MAX_OBJECT_SIZE &&
+                    fread(key, header.key_length, 1, file) == 1;
+        fclose(file);
+        if (!valid || (header.expires <= now && !header.validators)) {
+            unlink(path);
+            continue;
+        }
+        key[header.key_length] = '\0';
+
+        cache_entry* entry = calloc(1, sizeof(cache_entry));
+        if (entry == NULL || (entry->key = strdup(key)) == NULL) {
+            free(entry);
+            break;
+        }
+        const char* separator = strchr(key, '\n');
+        entry->url_key_length = separator != NULL ? (size_t)(separator - key) : header.key_length;
+        entry->hash = domain_hash(key, entry->url_key_length);
+        entry->length = header.length;
+        entry->head_length = header.head_length;
+        entry->stored_at = header.stored_at;
+        entry->expires = header.expires;
+        entry->initial_age = header.initial_age;
+        entry->revalidate = header.revalidate;
+        entry->validators = header.validators;
+        entry->on_disk = 1;
+        cache_insert(entry);
+    }
+    printf("Loaded %lu cached responses from %s\n", cache_stats.entries, cache_directory);
+    pthread_mutex_unlock(&cache_lock);
+    closedir(directory);
+}
+
+// Adds the validators of a stale entry to the request; returns 1 if any was added
+int add_cache_validators(char* request, size_t* request_length, size_t capacity, size_t head_length,
+                         const cache_lookup* lookup) {
+    char lines[CACHE_VALIDATORS_SIZE];
+    size_t used = 0;
+    size_t value_length;
+    const char* value = find_header(lookup->response, lookup->head_length, "ETag", &value_length);
+    if (value != NULL && value_length < 400) {
+        used += snprintf(lines + used, sizeof(lines) - used, "\r\nIf-None-Match: %.*s", (int)value_length, value);
+    }
+    value = find_header(lookup->response, lookup->head_length, "Last-Modified", &value_length);
+    if (value != NULL && value_length < 400) {
+        used += snprintf(lines + used, sizeof(lines) - used, "\r\nIf-Modified-Since: %.*s", (int)value_length, value);
+    }
+    if (used == 0 || *request_length + used > capacity) return 0;
+
+    // New header lines go right before the blank line that ends the head
+    memmove(request + head_length + used, request + head_length, *request_length - head_length);
+    memcpy(request + head_length, lines, used);
+    *request_length += used;
+    request[*request_length] = '\0';
+    return 1;
+}
+
+/*
+ * Proxy credentials. credentials.txt holds one "user:password" or
+ * "user:pbkdf2-sha256$iterations$salt$hash" line per user, salt and hash in
+ * hex. Passwords are only kept as salted PBKDF2-HMAC-SHA256 hashes, indexed by
+ * user name in a hash table. The file is watched, and a changed file is loaded
+ * into a new store that replaces the active one under credentials_lock, so a
+ * request sees either the old or the new credentials. Tokens that passed
+ * verification are remembered by their SHA-256 until the store changes or
+ * AUTH_CACHE_TTL_SECONDS pass, so repeat requests skip decoding and hashing.
+ */
+typedef struct {
+    char* username;
+    unsigned char salt[CREDENTIAL_MAX_SALT];
+    size_t salt_length;
+    unsigned char hash[CREDENTIAL_HASH_SIZE];
+    int iterations;
+} credential;
+
+typedef struct {
+    credential* entries;
+    size_t count;
+    size_t users;  // Distinct user names, a later line for a user replaces earlier ones
+    size_t* slots;  // Open addressing on the user name hash, entry index + 1 or 0 when empty
+    size_t mask;
+    unsigned long generation;
+    int refs;  // Requests using the store, plus one while it is the active store
+} credential_store;
+
+typedef struct {
+    unsigned char digest[32];  // SHA-256 of the base64 token
+    unsigned long generation;  // Of the store that verified it
+    time_t expires;
+} auth_cache_slot;
+
+typedef struct {
+    unsigned long cache_hits;
+    unsigned long cache_misses;
+    unsigned long failures;
+} auth_stats_t;
+
+credential_store* active_credentials = NULL;
+unsigned long credentials_generation = 0;  // Of the active store, tokens cached for older ones are ignored
+pthread_mutex_t credentials_lock = PTHREAD_MUTEX_INITIALIZER;
+auth_cache_slot auth_cache[AUTH_CACHE_SLOTS];
+auth_stats_t auth_stats;
+pthread_mutex_t auth_cache_lock = PTHREAD_MUTEX_INITIALIZER;
+
+int derive_password_hash(const char* password, size_t length, const credential* entry,
+                         unsigned char hash[CREDENTIAL_HASH_SIZE]) {
+    return PKCS5_PBKDF2_HMAC(password, length, entry->salt, entry->salt_length, entry->iterations,
+                             EVP_sha256(), CREDENTIAL_HASH_SIZE, hash) == 1;
+}
+
+// Decodes exactly size bytes of hex, or as many as there are when size_out is given
+int parse_hex(const char* text, size_t length, unsigned char* out, size_t size, size_t* size_out) {
+    if (length % 2 != 0 || length / 2 > size || (size_out == NULL && length / 2 != size) || length == 0) return 0;
+    for (size_t i = 0; i < length / 2; i++) {
+        unsigned int byte;
+        if (!isxdigit((unsigned char)text[2 * i]) || !isxdigit((unsigned char)text[2 * i + 1]) ||
+            sscanf(text + 2 * i, "%2x", &byte) != 1) {
+            return 0;
+        }
+        out[i] = byte;
+    }
+    if (size_out != NULL) *size_out = length / 2;
+    return 1;
+}
+
+// Fills entry from one line of the credentials file; returns 0 for a malformed line
+int parse_credential(credential* entry, const char* username, const char* secret) {
+    memset(entry, 0, sizeof(*entry));
+    if (strncmp(secret, "pbkdf2-sha256$", 14) == 0) {
+        char* end;
+        long iterations = strtol(secret + 14, &end, 10);
+        const char* salt = end + 1;
+        const char* hash = *end == '$' ? strchr(salt, '$') : NULL;
+        if (hash == NULL || iterations < 1 || iterations > CREDENTIAL_MAX_ITERATIONS ||
+            !parse_hex(salt, hash - salt, entry->salt, sizeof(entry->salt), &entry->salt_length) ||
+            !parse_hex(hash + 1, strlen(hash + 1), entry->hash, sizeof(entry->hash), NULL)) {
+            return 0;
+        }
+        entry->iterations = iterations;
+    } else {
+        entry->salt_length = 16;
+        entry->iterations = CREDENTIAL_PLAIN_ITERATIONS;
+        if (RAND_bytes(entry->salt, entry->salt_length) != 1 ||
+            !derive_password_hash(secret, strlen(secret), entry, entry->hash)) {
+            return 0;
+        }
+    }
+    entry->username = strdup(username);
+    return entry->username != NULL;
+}
+
+credential* credential_store_find(const credential_store* store, const char* username, size_t length) {
+    for (size_t i = domain_hash(username, length) & store->mask;; i = (i + 1) & store->mask) {
+        if (store->slots[i] == 0) return NULL;
+        credential* entry = &store->entries[store->slots[i] - 1];
+        if (strncmp(entry->username, username, length) == 0 && entry->username[length] == '\0') return entry;
+    }
+}
+
+// Builds the user name index; a user listed twice keeps the later line
+int credential_store_index(credential_store* store) {
+    size_t capacity = 16;
+    while (capacity < store->count * 2) capacity <<= 1;
+    store->slots = calloc(capacity, sizeof(size_t));
+    if (store->slots == NULL) return 0;
+    store->mask = capacity - 1;
+
+    for (size_t index = 0; index < store->count; index++) {
+        const char* username = store->entries[index].username;
+        size_t i = domain_hash(username, strlen(username)) & store->mask;
+        while (store->slots[i] != 0 && strcmp(store->entries[store->slots[i] - 1].username, username) != 0) {
+            i = (i + 1) & store->mask;
+        }
+        if (store->slots[i] == 0) store->users++;
+        store->slots[i] = index + 1;
+    }
+    return 1;
+}
+
+void credential_store_free(credential_store* store) {
+    if (store == NULL) return;
+    for (size_t i = 0; i < store->count; i++) free(store->entries[i].username);
+    OPENSSL_cleanse(store->entries, store->count * sizeof(credential));
+    free(store->entries);
+    free(store->slots);
+    free(store);
+}
+
+credential_store* credential_store_acquire() {
+    pthread_mutex_lock(&credentials_lock);
+    credential_store* store = active_credentials;
+    if (store != NULL) store->refs++;
+    pthread_mutex_unlock(&credentials_lock);
+    return store;
+}
+
+void credential_store_release(credential_store* store) {
+    pthread_mutex_lock(&credentials_lock);
+    int unused = --store->refs == 0;
+    pthread_mutex_unlock(&credentials_lock);
+    if (unused) credential_store_free(store);
+}
+
+// Reads CREDENTIALS_FILE into a new store and makes it the active one; returns 1 on success
 int load_credentials() {
     FILE* file = fopen(CREDENTIALS_FILE, "r");
     if (file == NULL) {
@@ -87,469 +3003,889 @@ int load_credentials() {
         return 0;
     }
 
-    credentials_count = 0;
-    while (
-        fscanf(file, "%49[^:]:%49s", 
-            valid_credentials[credentials_count].username, 
-            valid_credentials[credentials_count].password
-        ) == 2 && 
-        credentials_count < MAX_CREDENTIALS
-    ) {
-        credentials_count++;
-    }
+    credential_store* store = calloc(1, sizeof(credential_store));
+    size_t capacity = 0;
+    char* line = NULL;
+    size_t line_size = 0;
+    ssize_t line_length;
+    int line_number = 0;
+    int failed = store == NULL;
+    while (!failed && (line_length = getline(&line, &line_size, file)) >= 0) {
+        line_number++;
+        while (line_length > 0 && (line[line_length - 1] == '\n' || line[line_length - 1] == '\r')) {
+            line[--line_length] = '\0';
+        }
+        if (line_length == 0 || line[0] == '#') continue;
+        char* separator = strchr(line, ':');
+        if (separator == NULL || separator == line) {
+            fprintf(stderr, "Ignoring malformed credentials line %d\n", line_number);
+            continue;
+        }
+        *separator = '\0';
 
+        if (store->count == capacity) {
+            capacity = capacity ? capacity * 2 : 64;
+            credential* grown = realloc(store->entries, capacity * sizeof(credential));
+            if (grown == NULL) {
+                failed = 1;
+                break;
+            }
+            store->entries = grown;
+        }
+        if (parse_credential(&store->entries[store->count], line, separator + 1)) {
+            store->count++;
+        } else {
+            fprintf(stderr, "Ignoring malformed credentials line %d\n", line_number);
+        }
+        OPENSSL_cleanse(line, line_length);
+    }
+    free(line);
     fclose(file);
-    printf("Loaded %d credentials\n", credentials_count);
-    return credentials_count > 0;
-}
 
-int verify_authentication(const char* request) {
-    
-    const char* auth_line = strstr(request, "Proxy-Authorization: Basic ");
-    if (auth_line == NULL) {
-        return 0;  
+    if (failed || store->count == 0 || !credential_store_index(store)) {
+        fprintf(stderr, failed ? "Failed to allocate the credentials\n" : "No usable credentials\n");
+        credential_store_free(store);
+        return 0;
     }
 
-   
-    const char* end_line = strchr(auth_line, '\r');
-    if (end_line == NULL) end_line = strchr(auth_line, '\n');
-    if (end_line == NULL) end_line = auth_line + strlen(auth_line);
+    pthread_mutex_lock(&credentials_lock);
+    credential_store* previous = active_credentials;
+    store->refs = 1;
+    store->generation = ++credentials_generation;
+    active_credentials = store;
+    pthread_mutex_unlock(&credentials_lock);
+    if (previous != NULL) credential_store_release(previous);
 
-    
-    char auth_header[512];
-    size_t line_length = end_line - auth_line;
-    strncpy(auth_header, auth_line, line_length);
-    auth_header[line_length] = '\0';
-
-    
-    const char* base64_token = auth_header + strlen("Proxy-Authorization: Basic ");
-
-    
-    BIO *bio, *b64;
-    char* decoded_token = NULL;
-    int decoded_length;
+    printf("Loaded %zu credentials\n", store->users);
+    return 1;
+}
 
-    
-    b64 = BIO_new(BIO_f_base64());
-    bio = BIO_new_mem_buf(base64_token, strlen(base64_token));
-    bio = BIO_push(b64, bio);
+// Reloads the credentials whenever the file changes, requests keep using the old store meanwhile
+void* credentials_watcher(void* arg) {
+    struct stat last;
+    int known = stat(CREDENTIALS_FILE, &last) == 0;
+    while (1) {
+        sleep(CREDENTIALS_POLL_SECONDS);
+        struct stat current;
+        if (stat(CREDENTIALS_FILE, &current) != 0) continue;
+        if (known && current.st_ino == last.st_ino && current.st_size == last.st_size &&
+            current.st_mtim.tv_sec == last.st_mtim.tv_sec && current.st_mtim.tv_nsec == last.st_mtim.tv_nsec) {
+            continue;
+        }
+        last = current;
+        known = 1;
+        if (!load_credentials()) fprintf(stderr, "Keeping the previous credentials\n");
+    }
+    return NULL;
+}
 
-    
-    BIO_set_flags(bio, BIO_FLAGS_BASE64_NO_NL);
+// Checks the Proxy-Authorization header of a request head against the active credentials
+int verify_authentication(const char* head, size_t head_length) {
+    size_t value_length;
+    const char* value = find_header(head, head_length, "Proxy-Authorization", &value_length);
+    if (value == NULL || value_length <= 6 || strncasecmp(value, "Basic ", 6) != 0) return 0;
+    const char* token = value + 6;
+    size_t token_length = value_length - 6;
+    while (token_length > 0 && *token == ' ') {
+        token++;
+        token_length--;
+    }
+    if (token_length == 0 || token_length > MAX_AUTH_TOKEN) return 0;
 
-    
-    decoded_token = malloc(strlen(base64_token));
-    decoded_length = BIO_read(bio, decoded_token, strlen(base64_token));
-    
-    
-    decoded_token[decoded_length] = '\0';
+    // Fast path: the same token was verified recently against the active credentials
+    unsigned char digest[32];
+    if (!EVP_Digest(token, token_length, digest, NULL, EVP_sha256(), NULL)) return 0;
+    auth_cache_slot* slot = &auth_cache[(digest[0] | digest[1] << 8) % AUTH_CACHE_SLOTS];
+    time_t now = time(NULL);
 
-    
-    BIO_free_all(bio);
+    pthread_mutex_lock(&credentials_lock);
+    unsigned long generation = credentials_generation;
+    pthread_mutex_unlock(&credentials_lock);
+    pthread_mutex_lock(&auth_cache_lock);
+    int cached = slot->generation == generation && slot->expires > now &&
+                 CRYPTO_memcmp(slot->digest, digest, sizeof(digest)) == 0;
+    if (cached) auth_stats.cache_hits++;
+    else auth_stats.cache_misses++;
+    pthread_mutex_unlock(&auth_cache_lock);
+    if (cached) return 1;
 
-    if (decoded_length <= 0) {
-        free(decoded_token);
-        return 0;
-    }
+    unsigned char decoded[MAX_AUTH_TOKEN];
+    int decoded_length = EVP_DecodeBlock(decoded, (const unsigned char*)token, token_length);
+    // EVP_DecodeBlock counts the padding as decoded zero bytes
+    for (size_t i = token_length; decoded_length > 0 && i > 0 && token[i - 1] == '='; i--) decoded_length--;
+    const unsigned char* separator = decoded_length > 0 ? memchr(decoded, ':', decoded_length) : NULL;
 
-    
-    char* username = decoded_token;
-    char* password = strchr(decoded_token, ':');
-    
-    if (password == NULL) {
-        free(decoded_token);
-        return 0;
-    }
-    
-    *password = '\0';  
-    password++;  
-
-   
-    for (int i = 0; i < credentials_count; i++) {
-        if (strcmp(valid_credentials[i].username, username) == 0 && 
-            strcmp(valid_credentials[i].password, password) == 0) {
-            free(decoded_token);
-            return 1;
-        }
+    credential_store* store = credential_store_acquire();
+    int valid = 0;
+    if (separator != NULL && store != NULL) {
+        size_t username_length = separator - decoded;
+        credential* entry = credential_store_find(store, (const char*)decoded, username_length);
+        // Unknown users cost a derivation as well, so response times do not tell which names exist
+        const credential* target = entry != NULL ? entry : &store->entries[0];
+        unsigned char hash[CREDENTIAL_HASH_SIZE];
+        valid = derive_password_hash((const char*)separator + 1, decoded_length - username_length - 1, target, hash) &&
+                CRYPTO_memcmp(hash, target->hash, sizeof(hash)) == 0 && entry != NULL;
     }
+    OPENSSL_cleanse(decoded, sizeof(decoded));
 
-    free(decoded_token);
-    return 0;
-}
-
-void update_blocked_domains(const char* json_str) {
-    pthread_mutex_lock(&blocked_domains_lock);
-    
-    
-    blocked_domains_count = 0;
-    
-    
-    json_error_t error;
-    json_t* root = json_loads(json_str, 0, &error);
-    
-    if (root && json_is_array(root)) {
-        size_t index;
-        json_t* value;
-        
-        json_array_foreach(root, index, value) {
-            if (json_is_string(value) && blocked_domains_count < MAX_BLOCKED_DOMAINS) {
-                const char* domain = json_string_value(value);
-                strncpy(blocked_domains[blocked_domains_count], domain, sizeof(blocked_domains[0]) - 1);
-                blocked_domains_count++;
-            }
-        }
+    pthread_mutex_lock(&auth_cache_lock);
+    if (valid) {
+        memcpy(slot->digest, digest, sizeof(digest));
+        slot->generation = store->generation;
+        slot->expires = now + AUTH_CACHE_TTL_SECONDS;
+    } else {
+        auth_stats.failures++;
     }
-    
-    if (root) json_decref(root);
-    
-    pthread_mutex_unlock(&blocked_domains_lock);
-    
-    printf("Updated blocked domains. Total: %d\n", blocked_domains_count);
+    pthread_mutex_unlock(&auth_cache_lock);
+    if (store != NULL) credential_store_release(store);
+    return valid;
 }
 
-void* blocked_domains_listener(void* arg) {
-    int blocked_domains_socket = socket(AF_INET, SOCK_STREAM, 0);
-    if (blocked_domains_socket < 0) {
-        perror("Failed to create blocked domains socket");
-        return NULL;
-    }
-
-    struct sockaddr_in blocked_domains_addr;
-    blocked_domains_addr.sin_family = AF_INET;
-    blocked_domains_addr.sin_addr.s_addr = INADDR_ANY;
-    blocked_domains_addr.sin_port = htons(BLOCKED_DOMAINS_PORT);
+/*
+ * Client connections. One event loop thread owns every connection that is
+ * idle or still receiving a request; these sit in epoll with a client_conn
+ * each and a receive buffer only while request bytes are pending. A complete
+ * request becomes an exchange that one of WORKER_THREADS workers runs against
+ * the cache and the origin. A message held in the GUI parks its connection
+ * until the channel reader hands the verdict to a worker, so held messages do
+ * not keep a thread either. After the response the connection goes back to the
+ * event loop, which also closes connections idle for CLIENT_IDLE_TIMEOUT_SECONDS.
+ */
+enum { EXCHANGE_CLOSE, EXCHANGE_KEEP_ALIVE, EXCHANGE_HELD };
+enum { STAGE_REQUEST, STAGE_REQUEST_HOLD, STAGE_RESPONSE_HOLD };
 
-    if (bind(blocked_domains_socket, (struct sockaddr*)&blocked_domains_addr, sizeof(blocked_domains_addr)) < 0) {
-        perror("Failed to bind blocked domains socket");
-        close(blocked_domains_socket);
-        return NULL;
-    }
+typedef struct {
+    char* request;
+    size_t request_length;
+    size_t request_capacity;  // Leaves room for the cache validators
+    http_request parsed;
+    char method[16];
+    char protocol[16];
+    int intercept;
+    uint32_t message_id;
+    int client_keep_alive;
+    char host[256];
+    int port;
+    int server_socket;  // Upstream connection to release after the response, -1 for none
+    int server_keep_alive;
+    int request_misframed;  // An edited request whose body does not match its framing headers
+    char* response;  // Buffered response, from the origin or the cache
+    size_t response_length;
+    size_t response_capacity;
+    size_t head_length;
+    body_framing framing;
+    rewrite_rules_t* rewrites;  // Rewrite rules active when the exchange started, NULL for none
+    request_timing timing;
+    long long phase_start;  // Of the hold in progress
+} exchange;
 
-    listen(blocked_domains_socket, 1);
-    printf("Blocked domains listener running on port %d\n", BLOCKED_DOMAINS_PORT);
+typedef struct client_conn {
+    int socket;
+    char* buffer;  // Received bytes of the next requests, NULL when there are none
+    size_t capacity;
+    size_t buffered;
+    int stage;
+    exchange* exchange;  // Request in progress, NULL while the event loop owns the connection
+    pending_verdict hold;
+    time_t active_at;  // Last request bytes or the end of the last exchange
+    struct client_conn* newer;  // Event loop list of waiting connections, oldest first
+    struct client_conn* older;
+    struct client_conn* next;  // Worker queue or returned list
+} client_conn;
 
-    while (1) {
-        int control_socket = accept(blocked_domains_socket, NULL, NULL);
-        if (control_socket < 0) {
-            perror("Failed to accept blocked domains connection");
-            continue;
-        }
+client_conn* work_head = NULL;
+client_conn* work_tail = NULL;
+pthread_mutex_t work_lock = PTHREAD_MUTEX_INITIALIZER;
+pthread_cond_t work_ready = PTHREAD_COND_INITIALIZER;
+client_conn* returned_connections = NULL;  // Handed back by workers, picked up by the event loop
+pthread_mutex_t returned_lock = PTHREAD_MUTEX_INITIALIZER;
+int loop_epoll = -1;
+int loop_wakeup = -1;  // eventfd the workers signal when returning connections
+client_conn* waiting_oldest = NULL;  // Only the event loop thread uses the waiting list
+client_conn* waiting_newest = NULL;
 
-        char json_buffer[BUFFER_SIZE];
-        int n = recv(control_socket, json_buffer, sizeof(json_buffer) - 1, 0);
-        json_buffer[n] = '\0';
+/*
+ * Measures the request at the start of buffer. Returns its length, 0 while
+ * more bytes are needed, -1 when the request does not fit in limit bytes.
+ */
+long measure_request(const char* buffer, size_t buffered, size_t limit) {
+    const char* separator = memmem(buffer, buffered, "\r\n\r\n", 4);
+    if (separator == NULL) return buffered >= limit - 1 ? -1 : 0;
 
-        update_blocked_domains(json_buffer);
-        close(control_socket);
-    }
+    size_t head_length = separator + 4 - buffer;
+    body_framing framing;
+    init_request_framing(&framing, buffer, head_length);
 
-    close(blocked_domains_socket);
-    return NULL;
+    size_t request_length = head_length + body_consume(&framing, buffer + head_length, buffered - head_length);
+    if (!framing.done) return buffered >= limit - 1 ? -1 : 0;
+    return request_length;
 }
 
-int on_url(http_parser* parser, const char* at, size_t length) {
-    strncat(current_request.url, at, length);
-    return 0;
+void work_submit(client_conn* conn) {
+    pthread_mutex_lock(&work_lock);
+    conn->next = NULL;
+    if (work_tail != NULL) work_tail->next = conn;
+    else work_head = conn;
+    work_tail = conn;
+    pthread_cond_signal(&work_ready);
+    pthread_mutex_unlock(&work_lock);
 }
 
-int on_header_field(http_parser* parser, const char* at, size_t length) {
-    strncat(current_request.headers, at, length);
-    return 0;
+// Verdicts arrive on the GUI channel reader, the exchange continues on a worker
+void connection_resume(pending_verdict* pending) {
+    work_submit(pending->owner);
 }
 
-int on_header_value(http_parser* parser, const char* at, size_t length) {
-    strncat(current_request.headers, ": ", sizeof(current_request.headers) - strlen(current_request.headers) - 1);
-    strncat(current_request.headers, at, length);
-    strncat(current_request.headers, "\r\n", sizeof(current_request.headers) - strlen(current_request.headers) - 1);
-    return 0;
+void connection_close(client_conn* conn) {
+    close(conn->socket);
+    free(conn->buffer);
+    free(conn);
+    atomic_fetch_sub(&metrics.connections_in_flight, 1);
 }
 
-int on_body(http_parser* parser, const char* at, size_t length) {
-    strncat(current_request.body, at, length);
-    current_request.body_length += length;
-    return 0;
+// Hands a connection back to the event loop for its next request
+void connection_return(client_conn* conn) {
+    pthread_mutex_lock(&returned_lock);
+    conn->next = returned_connections;
+    returned_connections = conn;
+    pthread_mutex_unlock(&returned_lock);
+    uint64_t one = 1;
+    if (write(loop_wakeup, &one, sizeof(one)) < 0) perror("Failed to wake the event loop");
 }
 
-int on_message_complete(http_parser* parser) {
-    return 0;
+// Moves the cached copy out of the lookup into the exchange and releases the key
+void take_cached_response(exchange* ex, cache_lookup* lookup) {
+    free(ex->response);
+    ex->response = lookup->response;
+    ex->response_length = lookup->length;
+    ex->response_capacity = lookup->capacity;
+    ex->head_length = lookup->head_length;
+    lookup->response = NULL;
+    cache_end(lookup);
 }
 
-void parse_http_request(const char* request, size_t length) {
-    http_parser parser;
-    http_parser_init(&parser, HTTP_REQUEST);
-
-    http_parser_settings settings;
-    memset(&settings, 0, sizeof(settings));
-    settings.on_url = on_url;
-    settings.on_header_field = on_header_field;
-    settings.on_header_value = on_header_value;
-    settings.on_body = on_body;
-    settings.on_message_complete = on_message_complete;
+// Sends the buffered response; returns the connection's fate
+int send_response(client_conn* conn) {
+    exchange* ex = conn->exchange;
+    ex->timing.response_hold = monotonic_us() - ex->phase_start;
 
-    memset(&current_request, 0, sizeof(current_request));
-    http_parser_execute(&parser, &settings, request, length);
+    long long phase_start = monotonic_us();
+    int complete = send_all(conn->socket, ex->response, ex->response_length);
+    if (complete) atomic_fetch_add(&metrics.client_bytes_sent, ex->response_length);
+    ex->timing.send = monotonic_us() - phase_start;
+    if (ex->server_socket >= 0) {
+        pool_release(ex->host, ex->port, ex->server_socket, ex->server_keep_alive && ex->framing.done);
+        ex->server_socket = -1;
+    }
+    report_request_timing(&ex->timing, ex->message_id);
+    return complete && ex->client_keep_alive && !ex->framing.close_delimited ? EXCHANGE_KEEP_ALIVE : EXCHANGE_CLOSE;
 }
 
+// Sends a buffered response, after the GUI's verdict when intercept is on
+int deliver_response(client_conn* conn, uint16_t flags) {
+    exchange* ex = conn->exchange;
+    ex->phase_start = monotonic_us();
+    if (ex->rewrites != NULL) {
+        body_framing framing;
+        init_response_framing(&framing, ex->response, ex->head_length, ex->method);
+        if (!rewrite_message(ex->rewrites, REWRITE_RESPONSES, ex->host, &framing, &ex->response, &ex->response_length,
+                             &ex->response_capacity, &ex->head_length, 0)) {
+            fprintf(stderr, "Failed to rewrite a response\n");
+        }
+    }
+    if (!ex->intercept) {
+        gui_notify(FRAME_RESPONSE, flags, ex->message_id, ex->response, ex->head_length - 4,
+                   ex->response + ex->head_length, ex->response_length - ex->head_length);
+        return send_response(conn);
+    }
 
-void add_to_history(const char* method, const char* url, const char* protocol, const char* host,
-                    const char* request_data, const char* response_data) {
-    pthread_mutex_lock(&intercept_lock);
-
-    if (history_count < MAX_HISTORY) {
-        history_entry* entry = &history[history_count++];
-        strncpy(entry->method, method, sizeof(entry->method) - 1);
-        strncpy(entry->url, url, sizeof(entry->url) - 1);
-        strncpy(entry->protocol, protocol, sizeof(entry->protocol) - 1);
-        strncpy(entry->host, host, sizeof(entry->host) - 1);
-        entry->timestamp = time(NULL);
-        strncpy(entry->request_data, request_data, sizeof(entry->request_data) - 1);
-        strncpy(entry->response_data, response_data, sizeof(entry->response_data) - 1);
+    // Hold the complete response until the GUI decides on it
+    conn->stage = STAGE_RESPONSE_HOLD;
+    if (gui_hold(&conn->hold, FRAME_RESPONSE, ex->message_id, flags, ex->response, ex->response_length)) {
+        return EXCHANGE_HELD;
     }
+    if (ex->server_socket >= 0) pool_release(ex->host, ex->port, ex->server_socket, ex->server_keep_alive);
+    ex->server_socket = -1;
+    return EXCHANGE_CLOSE;
+}
 
-    pthread_mutex_unlock(&intercept_lock);
+int resume_response(client_conn* conn) {
+    exchange* ex = conn->exchange;
+    if (!apply_verdict(&conn->hold.verdict, FRAME_RESPONSE, &ex->response, &ex->response_length,
+                       &ex->response_capacity, INTERCEPT_MAX_RESPONSE)) {
+        if (ex->server_socket >= 0) pool_release(ex->host, ex->port, ex->server_socket, ex->server_keep_alive);
+        ex->server_socket = -1;
+        return EXCHANGE_CLOSE;
+    }
+    return send_response(conn);
 }
 
+// Runs a request the GUI let through against the cache and the origin
+int forward_request(client_conn* conn) {
+    exchange* ex = conn->exchange;
+    size_t request_head_length, request_body_length;
+    const char* request_body;
+    split_message(ex->request, ex->request_length, &request_head_length, &request_body, &request_body_length);
+    ex->client_keep_alive = message_keeps_alive(ex->request, request_head_length, ex->protocol);
 
-int communicate_with_gui(char* message, const char* type) {
-    int gui_socket = socket(AF_INET, SOCK_STREAM, 0);
-    if (gui_socket < 0) {
-        perror("Failed to create socket");
-        return 0;
+    // After potential modification by GUI, get the host and port
+    if (!read_host_header(ex->request, request_head_length, ex->host, sizeof(ex->host), &ex->port)) {
+        const char* bad_request = "HTTP/1.1 400 Bad Request\r\nContent-Type: text/plain\r\nConnection: close\r\n\r\nMissing Host header";
+        send(conn->socket, bad_request, strlen(bad_request), MSG_NOSIGNAL);
+        return EXCHANGE_CLOSE;
     }
 
-    struct sockaddr_in gui_addr;
-    gui_addr.sin_family = AF_INET;
-    gui_addr.sin_port = htons(GUI_PORT);
-    inet_pton(AF_INET, "127.0.0.1", &gui_addr.sin_addr);
+    // Check if domain is blocked
+    if (is_domain_blocked(ex->host)) {
+        atomic_fetch_add(&metrics.blocked_requests, 1);
+        const char* blocked_response = "HTTP/1.1 403 Forbidden\r\nContent-Type: text/plain\r\nConnection: close\r\n\r\nDomain is blocked by proxy";
+        send(conn->socket, blocked_response, strlen(blocked_response), MSG_NOSIGNAL);
+        return EXCHANGE_CLOSE;
+    }
 
-    if (connect(gui_socket, (struct sockaddr*)&gui_addr, sizeof(gui_addr)) < 0) {
-        perror("Failed to connect to GUI");
-        close(gui_socket);
-        return 0;
+    // Answer from the response cache when possible, concurrent misses for a key wait for one fetch
+    cache_lookup lookup;
+    cache_lookup_init(&lookup, ex->host, ex->port, ex->request, request_head_length);
+    if (lookup.invalidates) cache_invalidate(&lookup);
+    cache_begin(&lookup);
+    if (lookup.state == CACHE_HIT) {
+        take_cached_response(ex, &lookup);
+        return deliver_response(conn, FRAME_FLAG_CACHED);
+    }
+    if (lookup.state == CACHE_STALE && !lookup.conditional) {
+        lookup.validating = add_cache_validators(ex->request, &ex->request_length, ex->request_capacity,
+                                                 request_head_length, &lookup);
     }
 
-    
-    send(gui_socket, type, strlen(type), 0);
-    send(gui_socket, "\n\n", 2, 0);  
-    send(gui_socket, message, strlen(message), 0);
-
-    char decision[BUFFER_SIZE];
-    int n = recv(gui_socket, decision, sizeof(decision), 0);
-    decision[n]='\0';
-    //close(gui_socket);
-
-    if (n > 0 && strncmp(decision, "EDIT", 4) == 0) 
-    {
-        char message_length_str[11];  // 10 digits plus null terminator
-        ssize_t length_received = recv(gui_socket, message_length_str, 10, MSG_WAITALL);
-        if (length_received != 10) {
-            printf("%s\t",message_length_str);
-            perror("Failed to receive message length");
-            close(gui_socket);
-            return 0;
-        }
-        message_length_str[10] = '\0';
-        
-        // Convert length string to integer, trimming any padding
-        char *endptr;
-        long new_message_size = strtol(message_length_str, &endptr, 10);
-        if (new_message_size <= 0 || new_message_size > BUFFER_SIZE) {
-            fprintf(stderr, "Invalid message size received: %ld\n", new_message_size);
-            close(gui_socket);
-            return 0;
-        }
+    // Send the request upstream. A pooled connection may have been closed by the
+    // server in the meantime, in which case the request is retried once on a new one.
+    ex->response_capacity = BUFFER_SIZE;
+    ex->response = malloc(ex->response_capacity + 1);
+    int reused = 0;
+    int have_head = 0;
 
-        // Send acknowledgment
-        const char* ready_message = "READY";
-        if (send(gui_socket, ready_message, strlen(ready_message), 0) == -1) {
-            perror("Failed to send acknowledgment");
-            close(gui_socket);
-            return 0;
+    for (int attempt = 0; ex->response != NULL && attempt < 2 && !have_head; attempt++) {
+        ex->server_socket = attempt == 0 ? pool_acquire(ex->host, ex->port, &reused, &ex->timing)
+                                         : connect_upstream(ex->host, ex->port, &ex->timing);
+        if (ex->server_socket < 0) break;
+        ex->response_length = 0;
+        long long phase_start = monotonic_us();
+        have_head = send_all(ex->server_socket, ex->request, ex->request_length) &&
+                    read_message_head(ex->server_socket, &ex->response, &ex->response_capacity,
+                                      &ex->response_length, &ex->head_length);
+        ex->timing.wait += monotonic_us() - phase_start;
+        if (!have_head) {
+            close(ex->server_socket);
+            ex->server_socket = -1;
+            if (!reused) break;
         }
+    }
 
-        // Allocate buffer for new message
-        char* new_message = (char*)malloc(new_message_size + 1);
-        if (new_message == NULL) {
-            perror("Memory allocation failed");
-            close(gui_socket);
-            return 0;
-        }
+    if (!have_head) {
+        atomic_fetch_add(&metrics.upstream_errors, 1);
+        perror("Failed to read response from server");
+        cache_end(&lookup);
+        return EXCHANGE_CLOSE;
+    }
 
-        // Receive the modified request
-        size_t total_received = 0;
-        while (total_received < new_message_size) {
-            ssize_t received = recv(gui_socket, 
-                                new_message + total_received, 
-                                new_message_size - total_received, 
-                                0);
-            if (received <= 0) {
-                perror("Failed to receive modified request");
-                free(new_message);
-                close(gui_socket);
-                return 0;
-            }
-            total_received += received;
-        }
-        new_message[new_message_size] = '\0';
-        parse_http_request(new_message,new_message_size);
+    char* response = ex->response;
+    init_response_framing(&ex->framing, response, ex->head_length, ex->method);
+    ex->response_length = ex->head_length + body_consume(&ex->framing, response + ex->head_length,
+                                                         ex->response_length - ex->head_length);
 
+    // Held responses and storable ones are buffered, everything else is streamed
+    int storable = lookup.state != CACHE_BYPASS && cache_response_storable(response, ex->head_length, &ex->framing);
+    size_t buffer_limit = ex->intercept ? INTERCEPT_MAX_RESPONSE : storable ? CACHE_MAX_OBJECT_SIZE : 0;
+    long long phase_start = monotonic_us();
+    int buffered = buffer_limit > 0
+        ? buffer_response_body(ex->server_socket, &ex->response, &ex->response_capacity, &ex->response_length,
+                               &ex->framing, buffer_limit)
+        : 0;
+    ex->timing.download = monotonic_us() - phase_start;
+    response = ex->response;
 
-        // Copy the new message to the buffer
-        if (new_message_size < BUFFER_SIZE) {
-            memcpy(message, new_message, new_message_size + 1);
+    // Decide on upstream reuse before the GUI gets a chance to edit the response
+    char response_version[16] = "";
+    sscanf(response, "%15s", response_version);
+    ex->server_keep_alive = !ex->framing.close_delimited && !ex->request_misframed &&
+                            message_keeps_alive(response, ex->head_length, response_version);
 
-            // Send confirmation
-            const char* ok_message = "OK";
-            send(gui_socket, ok_message, strlen(ok_message), 0);
-            
-            free(new_message);
-            close(gui_socket);
-            return 1;
-        } else {
-            fprintf(stderr, "Edited message too large\n");
-            free(new_message);
-            close(gui_socket);
-            return 0;
-        }
+    // A 304 to the validators added above confirms the stale copy
+    if (lookup.validating && ex->framing.status == 304) {
+        cache_refresh(&lookup, response, ex->head_length);
+        pool_release(ex->host, ex->port, ex->server_socket, ex->server_keep_alive);
+        ex->server_socket = -1;
+        take_cached_response(ex, &lookup);
+        return deliver_response(conn, FRAME_FLAG_CACHED | FRAME_FLAG_REVALIDATED);
     }
-   
-    if (n > 0 && strncmp(decision, "FORWARD", 7) == 0) return 1;
-    if (strcmp(type, "REQUEST") == 0) {
-        printf("Request was dropped by the GUI\n");
-    } else if (strcmp(type, "RESPONSE") == 0) {
-        printf("Response was dropped by the GUI\n");
+
+    // Stored before the GUI can edit it, then requests waiting for the key can use it
+    if (buffered == 1 && storable) cache_store(&lookup, response, ex->response_length, ex->head_length);
+    cache_end(&lookup);
+
+    if (buffered == 1) return deliver_response(conn, 0);
+
+    int complete = 0;
+    if (buffered == 0) {
+        if (ex->intercept) printf("Response too large to intercept, streaming it\n");
+        body_rewriter rewriter;
+        byte_buffer head = {0};
+        int rewritten = rewrite_stream_start(ex->rewrites, ex->host, response, ex->head_length, ex->method,
+                                             ex->protocol, &rewriter, &head, &ex->client_keep_alive);
+        phase_start = monotonic_us();
+        complete = stream_response(conn->socket, ex->server_socket, rewritten ? head.data : response,
+                                   rewritten ? head.length : ex->head_length, response + ex->head_length,
+                                   ex->response_length - ex->head_length, &ex->framing, ex->message_id,
+                                   rewriter.count > 0 ? &rewriter : NULL);
+        ex->timing.send = monotonic_us() - phase_start;
+        body_rewriter_free(&rewriter);
+        free(head.data);
+        ex->server_keep_alive = ex->server_keep_alive && complete;
+    } else {
+        atomic_fetch_add(&metrics.upstream_errors, 1);
+        perror("Failed to read response from server");
+        ex->server_keep_alive = 0;
     }
-    return 0;
+    pool_release(ex->host, ex->port, ex->server_socket, ex->server_keep_alive);
+    ex->server_socket = -1;
+    report_request_timing(&ex->timing, ex->message_id);
+    return complete && ex->client_keep_alive && !ex->framing.close_delimited ? EXCHANGE_KEEP_ALIVE : EXCHANGE_CLOSE;
 }
 
-void* handle_client(void* arg) {
-    int client_socket = *(int*)arg;
-    free(arg);
+// Checks that the body of a request ends exactly where its Content-Length or chunked framing says
+int request_framing_matches(const char* request, size_t request_length) {
+    size_t head_length, body_length;
+    const char* body;
+    split_message(request, request_length, &head_length, &body, &body_length);
+    body_framing framing;
+    init_request_framing(&framing, request, head_length + 4);
+    size_t used = framing.done ? 0 : body_consume(&framing, body, body_length);
+    return framing.done && used == body_length;
+}
+
+int resume_request(client_conn* conn) {
+    exchange* ex = conn->exchange;
+    int edited = conn->hold.verdict.type == FRAME_EDIT;
+    if (!apply_verdict(&conn->hold.verdict, FRAME_REQUEST, &ex->request, &ex->request_length,
+                       &ex->request_capacity, BUFFER_SIZE)) {
+        return EXCHANGE_CLOSE;
+    }
+    // The origin would read a leftover or missing part of the body as the next pooled request
+    if (edited && !request_framing_matches(ex->request, ex->request_length)) {
+        fprintf(stderr, "Edited request body does not match its framing, not reusing the upstream connection\n");
+        ex->request_misframed = 1;
+    }
+    parse_http_request(ex->request, ex->request_length, &ex->parsed);
+
+    // Keep room for the cache validators after an edit
+    if (ex->request_capacity < ex->request_length + CACHE_VALIDATORS_SIZE) {
+        char* request = realloc(ex->request, ex->request_length + CACHE_VALIDATORS_SIZE + 1);
+        if (request != NULL) {
+            ex->request = request;
+            ex->request_capacity = ex->request_length + CACHE_VALIDATORS_SIZE;
+        }
+    }
+    ex->timing.request_hold = monotonic_us() - ex->phase_start;
+    return forward_request(conn);
+}
+
+// Removes REPLAY_HEADER from a request, returns 1 if it carried the current replay token
+int take_replay_marker(char* request, size_t* request_length) {
+    size_t head_length, body_length;
+    const char* body;
+    split_message(request, *request_length, &head_length, &body, &body_length);
+    size_t value_length;
+    const char* value = find_header(request, head_length, REPLAY_HEADER, &value_length);
+    if (value == NULL) return 0;
+
+    pthread_mutex_lock(&intercept_lock);
+    int replay = replay_token[0] != '\0' && value_length == strlen(replay_token) &&
+                 memcmp(value, replay_token, value_length) == 0;
+    pthread_mutex_unlock(&intercept_lock);
 
-    char buffer[BUFFER_SIZE];
-    int bytes_read = recv(client_socket, buffer, sizeof(buffer) - 1, 0);
-    buffer[bytes_read] = '\0';
+    // The line ends with its CRLF, which for the last header is the first half of the blank line
+    char* line = (char*)value;
+    while (line > request && line[-1] != '\n') line--;
+    char* next = memchr(value, '\n', request + head_length - value);
+    next = next != NULL ? next + 1 : request + head_length + 2;
+    memmove(line, next, request + *request_length - next);
+    *request_length -= next - line;
+    request[*request_length] = '\0';
+    return replay;
+}
 
-    parse_http_request(buffer, bytes_read);
+// Handles a new request of a client connection
+int start_exchange(client_conn* conn) {
+    exchange* ex = conn->exchange;
+    ex->timing.start = monotonic_us();
 
-    char buffer_copy[BUFFER_SIZE];
-    strncpy(buffer_copy, buffer, sizeof(buffer_copy) - 1);
-    buffer_copy[sizeof(buffer_copy) - 1] = '\0';
+    parse_http_request(ex->request, ex->request_length, &ex->parsed);
 
-    // Authentication check
-    if (!verify_authentication(buffer_copy)) {
+    // Authentication check, only the head is searched for the header
+    size_t request_head_length, request_body_length;
+    const char* request_body;
+    split_message(ex->request, ex->request_length, &request_head_length, &request_body, &request_body_length);
+    if (!verify_authentication(ex->request, request_head_length)) {
         const char* unauthorized_response = 
             "HTTP/1.1 401 Unauthorized\r\n"
             "WWW-Authenticate: Basic realm=\"Proxy\"\r\n"
-            "Content-Type: text/plain\r\n\r\n"
+            "Content-Type: text/plain\r\n"
+            "Connection: close\r\n\r\n"
             "Authentication required";
-        send(client_socket, unauthorized_response, strlen(unauthorized_response), 0);
-        close(client_socket);
-        return NULL;
+        send(conn->socket, unauthorized_response, strlen(unauthorized_response), MSG_NOSIGNAL);
+        return EXCHANGE_CLOSE;
     }
 
+    int replay = take_replay_marker(ex->request, &ex->request_length);
+    split_message(ex->request, ex->request_length, &request_head_length, &request_body, &request_body_length);
+
     // Get method and protocol before potential modification
-    char method[16] = "GET";  
-    char protocol[16] = "HTTP"; 
-    sscanf(buffer, "%s %s %s", method, current_request.url, protocol);
+    sscanf(ex->request, "%15s %*s %15s", ex->method, ex->protocol);
 
-    // Check intercept status
+    // Rewrite rules apply before the GUI sees the request
+    ex->rewrites = rewrite_rules_acquire();
+    if (ex->rewrites != NULL) {
+        char host[256] = "";
+        int port;
+        read_host_header(ex->request, request_head_length, host, sizeof(host), &port);
+        body_framing framing;
+        size_t head_length = request_head_length + 4;
+        init_request_framing(&framing, ex->request, head_length);
+        if (!rewrite_message(ex->rewrites, REWRITE_REQUESTS, host, &framing, &ex->request, &ex->request_length,
+                             &ex->request_capacity, &head_length, CACHE_VALIDATORS_SIZE)) {
+            fprintf(stderr, "Failed to rewrite a request\n");
+        }
+        split_message(ex->request, ex->request_length, &request_head_length, &request_body, &request_body_length);
+    }
+
+    // Check intercept status, replays from the repeater are never held
     pthread_mutex_lock(&intercept_lock);
-    int intercept = intercept_enabled;
+    ex->intercept = intercept_enabled && !replay;
     pthread_mutex_unlock(&intercept_lock);
 
-    // Communicate with GUI first if intercept is enabled
-    if (intercept && !communicate_with_gui(buffer, "REQUEST")) {
-        close(client_socket);
-        return NULL; 
+    // Hold the request in the GUI if intercept is enabled, otherwise just let it record the request
+    ex->message_id = next_gui_message_id();
+    ex->phase_start = monotonic_us();
+    if (ex->intercept) {
+        conn->stage = STAGE_REQUEST_HOLD;
+        return gui_hold(&conn->hold, FRAME_REQUEST, ex->message_id, 0, ex->request, ex->request_length)
+            ? EXCHANGE_HELD : EXCHANGE_CLOSE;
     }
+    ex->timing.request_hold = monotonic_us() - ex->phase_start;
+    gui_notify(FRAME_REQUEST, 0, ex->message_id, ex->request, request_head_length, request_body, request_body_length);
+    return forward_request(conn);
+}
 
-    // After potential modification by GUI, get the host
-    char host[256];
-    sscanf(current_request.headers, "Host: %s", host);
+// Runs the next step of a connection's exchange on a worker
+void run_connection(client_conn* conn) {
+    int result;
+    if (conn->stage == STAGE_REQUEST_HOLD) result = resume_request(conn);
+    else if (conn->stage == STAGE_RESPONSE_HOLD) result = resume_response(conn);
+    else result = start_exchange(conn);
+    if (result == EXCHANGE_HELD) return;  // Another worker picks it up with the verdict
 
-    // Check if domain is blocked
-    if (is_domain_blocked(host)) {
-        const char* blocked_response = "HTTP/1.1 403 Forbidden\r\nContent-Type: text/plain\r\n\r\nDomain is blocked by proxy";
-        send(client_socket, blocked_response, strlen(blocked_response), 0);
-        close(client_socket);
-        return NULL;
+    exchange* ex = conn->exchange;
+    rewrite_rules_release(ex->rewrites);
+    free(ex->request);
+    free(ex->response);
+    free(ex);
+    conn->exchange = NULL;
+    conn->stage = STAGE_REQUEST;
+    atomic_fetch_sub(&metrics.requests_in_flight, 1);
+    if (result == EXCHANGE_KEEP_ALIVE) connection_return(conn);
+    else connection_close(conn);
+}
+
+void* connection_worker(void* arg) {
+    while (1) {
+        pthread_mutex_lock(&work_lock);
+        while (work_head == NULL) pthread_cond_wait(&work_ready, &work_lock);
+        client_conn* conn = work_head;
+        work_head = conn->next;
+        if (work_head == NULL) work_tail = NULL;
+        pthread_mutex_unlock(&work_lock);
+        run_connection(conn);
     }
+    return NULL;
+}
 
-    // Connect to server
-    int server_socket;
-    struct sockaddr_in server_addr;
-    struct hostent* server = gethostbyname(host);
-    if (!server) {
-        perror("Host resolution failed");
-        close(client_socket);
-        return NULL;
+void waiting_push(client_conn* conn) {
+    conn->newer = NULL;
+    conn->older = waiting_newest;
+    if (waiting_newest != NULL) waiting_newest->newer = conn;
+    else waiting_oldest = conn;
+    waiting_newest = conn;
+}
+
+void waiting_unlink(client_conn* conn) {
+    if (conn->older != NULL) conn->older->newer = conn->newer;
+    else waiting_oldest = conn->newer;
+    if (conn->newer != NULL) conn->newer->older = conn->older;
+    else waiting_newest = conn->older;
+    conn->newer = conn->older = NULL;
+}
+
+// Waits for the next bytes of a connection; EPOLLONESHOT keeps it with one thread at a time
+void loop_watch(client_conn* conn, int operation) {
+    struct epoll_event event;
+    event.events = EPOLLIN | EPOLLRDHUP | EPOLLONESHOT;
+    event.data.ptr = conn;
+    if (epoll_ctl(loop_epoll, operation, conn->socket, &event) < 0) {
+        perror("Failed to watch client connection");
+        connection_close(conn);
+        return;
     }
+    waiting_push(conn);
+}
 
-    server_socket = socket(AF_INET, SOCK_STREAM, 0);
-    server_addr.sin_family = AF_INET;
-    memcpy(&server_addr.sin_addr.s_addr, server->h_addr_list[0], server->h_length);
-    server_addr.sin_port = htons(80);
+// Passes the complete request at the start of the buffer to the workers
+void loop_dispatch(client_conn* conn, size_t request_length) {
+    exchange* ex = calloc(1, sizeof(exchange));
+    char* request = ex != NULL ? malloc(request_length + CACHE_VALIDATORS_SIZE + 1) : NULL;
+    if (request == NULL) {
+        fprintf(stderr, "Failed to allocate a request\n");
+        free(ex);
+        connection_close(conn);
+        return;
+    }
+    memcpy(request, conn->buffer, request_length);
+    request[request_length] = '\0';
+    ex->request = request;
+    ex->request_length = request_length;
+    ex->request_capacity = request_length + CACHE_VALIDATORS_SIZE;
+    strcpy(ex->method, "GET");
+    strcpy(ex->protocol, "HTTP");
+    ex->port = 80;
+    ex->server_socket = -1;
 
-    connect(server_socket, (struct sockaddr*)&server_addr, sizeof(server_addr));
-    send(server_socket, buffer, bytes_read, 0);
+    // Keep the start of a pipelined request, drop the buffer when nothing is left
+    conn->buffered -= request_length;
+    if (conn->buffered > 0) {
+        memmove(conn->buffer, conn->buffer + request_length, conn->buffered);
+    } else {
+        free(conn->buffer);
+        conn->buffer = NULL;
+        conn->capacity = 0;
+    }
 
-    // Handle response
-    char response_buffer[BUFFER_SIZE];
-    int response_size;
-    int total_size = 0;
-    char* total_buffer = (char*)malloc(BUFFER_SIZE);
-    total_buffer[0] = '\0';
+    pthread_mutex_lock(&pool_lock);
+    pool_stats.client_requests++;
+    pthread_mutex_unlock(&pool_lock);
+    atomic_fetch_add(&metrics.requests, 1);
+    atomic_fetch_add(&metrics.client_bytes_received, request_length);
+    atomic_fetch_add(&metrics.requests_in_flight, 1);
 
-    struct timeval timeout;
-    timeout.tv_sec = 1;  // Timeout in seconds
-    timeout.tv_usec = 0; 
+    conn->exchange = ex;
+    conn->stage = STAGE_REQUEST;
+    work_submit(conn);
+}
 
-    if (setsockopt(server_socket, SOL_SOCKET, SO_RCVTIMEO, &timeout, sizeof(timeout)) < 0) {
-        perror("setsockopt failed");
-        exit(EXIT_FAILURE);
+// Dispatches a buffered request, rejects one that cannot fit, or waits for more bytes
+void loop_continue(client_conn* conn, int closed, int operation) {
+    long request_length = conn->buffered > 0 ? measure_request(conn->buffer, conn->buffered, BUFFER_SIZE) : 0;
+    if (request_length > 0) {
+        loop_dispatch(conn, request_length);
+    } else if (request_length < 0) {
+        const char* too_large = "HTTP/1.1 413 Payload Too Large\r\nConnection: close\r\nContent-Length: 0\r\n\r\n";
+        send(conn->socket, too_large, strlen(too_large), MSG_NOSIGNAL);
+        connection_close(conn);
+    } else if (closed) {
+        connection_close(conn);
+    } else {
+        loop_watch(conn, operation);
     }
+}
 
-    while((response_size = recv(server_socket,response_buffer,sizeof(response_buffer),0)) > 0)
-    {
-        if(response_size == 0)
-            break;
+// Reads what a ready connection has, the buffer grows up to BUFFER_SIZE as needed
+void loop_read(client_conn* conn) {
+    waiting_unlink(conn);
+    int closed = 0;
+    while (conn->buffered < BUFFER_SIZE - 1) {
+        if (conn->buffered == conn->capacity) {
+            size_t capacity = conn->capacity == 0 ? CLIENT_BUFFER_SIZE : conn->capacity * 2;
+            if (capacity > BUFFER_SIZE - 1) capacity = BUFFER_SIZE - 1;
+            char* buffer = realloc(conn->buffer, capacity);
+            if (buffer == NULL) {
+                closed = 1;
+                break;
+            }
+            conn->buffer = buffer;
+            conn->capacity = capacity;
+        }
+        ssize_t received = recv(conn->socket, conn->buffer + conn->buffered, conn->capacity - conn->buffered,
+                                MSG_DONTWAIT);
+        if (received > 0) {
+            conn->buffered += received;
+            continue;
+        }
+        if (received < 0 && errno == EINTR) continue;
+        if (received < 0 && (errno == EAGAIN || errno == EWOULDBLOCK)) break;
+        closed = 1;
+        break;
+    }
+    conn->active_at = time(NULL);
+    loop_continue(conn, closed, EPOLL_CTL_MOD);
+}
+
+void loop_accept(int server_fd) {
+    while (1) {
+        int client_socket = accept4(server_fd, NULL, NULL, SOCK_CLOEXEC);
+        if (client_socket < 0) {
+            if (errno == EINTR || errno == ECONNABORTED) continue;
+            if (errno != EAGAIN && errno != EWOULDBLOCK) perror("Failed to accept client connection");
+            return;
+        }
+        client_conn* conn = calloc(1, sizeof(client_conn));
+        if (conn == NULL) {
+            close(client_socket);
+            continue;
+        }
+        // Workers write responses with blocking sends, bound how long a stalled client can keep one
+        struct timeval send_timeout;
+        send_timeout.tv_sec = CLIENT_SEND_TIMEOUT_SECONDS;
+        send_timeout.tv_usec = 0;
+        if (setsockopt(client_socket, SOL_SOCKET, SO_SNDTIMEO, &send_timeout, sizeof(send_timeout)) < 0) {
+            perror("setsockopt failed");
+        }
+        conn->socket = client_socket;
+        conn->hold.resume = connection_resume;
+        conn->hold.owner = conn;
+        conn->active_at = time(NULL);
+
+        pthread_mutex_lock(&pool_lock);
+        pool_stats.client_connections++;
+        pthread_mutex_unlock(&pool_lock);
+        atomic_fetch_add(&metrics.connections_in_flight, 1);
+        loop_watch(conn, EPOLL_CTL_ADD);
+    }
+}
+
+// Takes back the connections the workers finished an exchange on
+void loop_take_returned() {
+    uint64_t count;
+    if (read(loop_wakeup, &count, sizeof(count)) < 0 && errno != EAGAIN) perror("Failed to read the event loop wakeup");
 
-        printf("%d\n%s\n---------------\n",response_size,response_buffer);
-        total_size += response_size;
+    pthread_mutex_lock(&returned_lock);
+    client_conn* conn = returned_connections;
+    returned_connections = NULL;
+    pthread_mutex_unlock(&returned_lock);
 
-        response_buffer[response_size] = '\0';
-        strncat(total_buffer,response_buffer, response_size);
+    time_t now = time(NULL);
+    while (conn != NULL) {
+        client_conn* next = conn->next;
+        conn->active_at = now;
+        loop_continue(conn, 0, EPOLL_CTL_MOD);
+        conn = next;
+    }
+}
 
-        printf("\n            GOOD            \n");
+void start_workers() {
+    for (int i = 0; i < WORKER_THREADS; i++) {
+        pthread_t worker_thread;
+        if (pthread_create(&worker_thread, NULL, connection_worker, NULL) != 0) {
+            perror("Failed to start worker");
+            continue;
+        }
+        pthread_detach(worker_thread);
     }
-    printf("\n+++++++++++++++\n%s\n",total_buffer);
+}
 
-    if(intercept && !communicate_with_gui(total_buffer, "RESPONSE")){
-        close(server_socket);
-        close(client_socket);
-        return NULL;
+// Accepts client connections and reads their requests until the process ends
+void run_event_loop(int server_fd) {
+    loop_epoll = epoll_create1(EPOLL_CLOEXEC);
+    loop_wakeup = eventfd(0, EFD_NONBLOCK | EFD_CLOEXEC);
+    if (loop_epoll < 0 || loop_wakeup < 0 || fcntl(server_fd, F_SETFL, fcntl(server_fd, F_GETFL) | O_NONBLOCK) < 0) {
+        perror("Failed to set up the event loop");
+        return;
     }
 
-    send(client_socket, total_buffer, total_size,0);
+    // The listener and the wakeup are told apart by a NULL and a non-NULL marker
+    struct epoll_event event;
+    event.events = EPOLLIN;
+    event.data.ptr = NULL;
+    epoll_ctl(loop_epoll, EPOLL_CTL_ADD, server_fd, &event);
+    event.data.ptr = &loop_wakeup;
+    epoll_ctl(loop_epoll, EPOLL_CTL_ADD, loop_wakeup, &event);
+
+    struct epoll_event events[EVENT_BATCH];
+    while (1) {
+        int ready = epoll_wait(loop_epoll, events, EVENT_BATCH, 1000);
+        if (ready < 0 && errno != EINTR) {
+            perror("Failed to wait for client connections");
+            return;
+        }
+        for (int i = 0; i < ready; i++) {
+            if (events[i].data.ptr == NULL) loop_accept(server_fd);
+            else if (events[i].data.ptr == &loop_wakeup) loop_take_returned();
+            else loop_read(events[i].data.ptr);
+        }
+
+        // Idle keep-alive connections are closed after CLIENT_IDLE_TIMEOUT_SECONDS
+        time_t now = time(NULL);
+        while (waiting_oldest != NULL && now - waiting_oldest->active_at >= CLIENT_IDLE_TIMEOUT_SECONDS) {
+            client_conn* conn = waiting_oldest;
+            waiting_unlink(conn);
+            connection_close(conn);
+        }
+    }
+}
 
-    // while ((response_size = recv(server_socket, response_buffer, sizeof(response_buffer), 0)) > 0) {
-    //     response_buffer[response_size] = '\0';
-        
-    //     printf("%s\n\n",response_buffer);
+// Formats the connection and DNS statistics as "name value" lines
+int format_proxy_stats(char* out, size_t size) {
+    pthread_mutex_lock(&pool_lock);
+    pool_stats_t stats = pool_stats;
+    pthread_mutex_unlock(&pool_lock);
 
-    //     add_to_history(method, current_request.url, protocol, host, buffer, response_buffer);
+    pthread_mutex_lock(&dns_lock);
+    dns_stats_t dns = dns_stats;
+    pthread_mutex_unlock(&dns_lock);
 
-    //     if (intercept && !communicate_with_gui(response_buffer, "RESPONSE")) { //communicates to the GUI that its a response
-    //         break;
-    //     }
+    pthread_mutex_lock(&cache_lock);
+    cache_stats_t cache = cache_stats;
+    pthread_mutex_unlock(&cache_lock);
 
-    //     send(client_socket, response_buffer, response_size, 0);
-    // }
+    pthread_mutex_lock(&auth_cache_lock);
+    auth_stats_t auth = auth_stats;
+    pthread_mutex_unlock(&auth_cache_lock);
+    credential_store* credentials = credential_store_acquire();
+    size_t users = credentials != NULL ? credentials->users : 0;
+    if (credentials != NULL) credential_store_release(credentials);
 
-    close(server_socket);
-    close(client_socket);
-    return NULL;
+    return snprintf(out, size,
+        "pool_hits %lu\n"
+        "pool_misses %lu\n"
+        "pool_stale %lu\n"
+        "pool_expired %lu\n"
+        "pool_idle %lu\n"
+        "client_connections %lu\n"
+        "client_requests %lu\n"
+        "dns_hits %lu\n"
+        "dns_misses %lu\n"
+        "dns_coalesced %lu\n"
+        "dns_negative_hits %lu\n"
+        "dns_entries %lu\n"
+        "cache_lookups %lu\n"
+        "cache_hits %lu\n"
+        "cache_revalidated %lu\n"
+        "cache_misses %lu\n"
+        "cache_coalesced %lu\n"
+        "cache_disk_reads %lu\n"
+        "cache_stores %lu\n"
+        "cache_evictions %lu\n"
+        "cache_invalidations %lu\n"
+        "cache_entries %lu\n"
+        "cache_memory_bytes %llu\n"
+        "cache_disk_bytes %llu\n"
+        "auth_cache_hits %lu\n"
+        "auth_cache_misses %lu\n"
+        "auth_failures %lu\n"
+        "auth_users %zu\n",
+        stats.hits, stats.misses, stats.stale, stats.expired, stats.idle,
+        stats.client_connections, stats.client_requests,
+        dns.hits, dns.misses, dns.coalesced, dns.negative_hits, dns.entries,
+        cache.lookups, cache.hits, cache.revalidated, cache.misses, cache.coalesced, cache.disk_reads,
+        cache.stores, cache.evictions, cache.invalidations, cache.entries, cache.memory_bytes, cache.disk_bytes,
+        auth.cache_hits, auth.cache_misses, auth.failures, users);
 }
 
 void* intercept_control_listener(void* arg) {
@@ -581,8 +3917,8 @@ void* intercept_control_listener(void* arg) {
         }
 
         char command[BUFFER_SIZE];
-        int n = recv(control_socket, command, sizeof(command), 0);
-        command[n] = '\0';
+        int n = recv(control_socket, command, sizeof(command) - 1, 0);
+        command[n > 0 ? n : 0] = '\0';
 
         if (strcmp(command, "INTERCEPT_ON") == 0) {
             pthread_mutex_lock(&intercept_lock);
@@ -594,6 +3930,21 @@ void* intercept_control_listener(void* arg) {
             intercept_enabled = 0;
             pthread_mutex_unlock(&intercept_lock);
             printf("Intercept disabled by GUI\n");
+        } else if (strncmp(command, "REPLAY_TOKEN", 12) == 0) {
+            // "REPLAY_TOKEN <token>" starts a repeater run, the bare command ends it
+            char* token = command + 12;
+            while (*token == ' ') token++;
+            size_t length = strcspn(token, " \r\n");
+            if (length <= REPLAY_TOKEN_SIZE) {
+                pthread_mutex_lock(&intercept_lock);
+                memcpy(replay_token, token, length);
+                replay_token[length] = '\0';
+                pthread_mutex_unlock(&intercept_lock);
+            }
+        } else if (strcmp(command, "STATS") == 0) {
+            char stats[4096];
+            int length = format_proxy_stats(stats, sizeof(stats));
+            send_all(control_socket, stats, length);
         }
 
         close(control_socket);
@@ -603,26 +3954,135 @@ void* intercept_control_listener(void* arg) {
     return NULL;
 }
 
-int create_server_socket(int port) {
+// Listens on port at address, INADDR_LOOPBACK for ports only the local GUI may use
+int create_server_socket(in_addr_t address_value, int port) {
     int server_fd = socket(AF_INET, SOCK_STREAM, 0);
-    struct sockaddr_in address = { .sin_family = AF_INET, .sin_addr.s_addr = INADDR_ANY, .sin_port = htons(port) };
+    if (server_fd < 0) return -1;
+    struct sockaddr_in address = { .sin_family = AF_INET, .sin_addr.s_addr = htonl(address_value),
+                                   .sin_port = htons(port) };
 
-    bind(server_fd, (struct sockaddr*)&address, sizeof(address));
-    listen(server_fd, 10);
+    if (bind(server_fd, (struct sockaddr*)&address, sizeof(address)) < 0 || listen(server_fd, SOMAXCONN) < 0) {
+        close(server_fd);
+        return -1;
+    }
     return server_fd;
 }
 
-void accept_connections(int server_fd) {
-    struct sockaddr_in client_addr;
-    socklen_t client_addr_len = sizeof(client_addr);
+// Formats the metrics in the Prometheus text exposition format
+int format_metrics(char* out, size_t size) {
+    size_t used = snprintf(out, size,
+        "# TYPE proxy_requests_total counter\n"
+        "proxy_requests_total %lu\n"
+        "# TYPE proxy_connections_in_flight gauge\n"
+        "proxy_connections_in_flight %ld\n"
+        "# TYPE proxy_requests_in_flight gauge\n"
+        "proxy_requests_in_flight %ld\n"
+        "# TYPE proxy_intercept_queue_depth gauge\n"
+        "proxy_intercept_queue_depth %ld\n"
+        "# TYPE proxy_client_bytes_received_total counter\n"
+        "proxy_client_bytes_received_total %llu\n"
+        "# TYPE proxy_client_bytes_sent_total counter\n"
+        "proxy_client_bytes_sent_total %llu\n"
+        "# TYPE proxy_blocked_requests_total counter\n"
+        "proxy_blocked_requests_total %lu\n"
+        "# TYPE proxy_upstream_errors_total counter\n"
+        "proxy_upstream_errors_total %lu\n"
+        "# TYPE proxy_request_duration_seconds histogram\n",
+        atomic_load(&metrics.requests), atomic_load(&metrics.connections_in_flight),
+        atomic_load(&metrics.requests_in_flight), atomic_load(&metrics.intercept_queue_depth),
+        atomic_load(&metrics.client_bytes_received), atomic_load(&metrics.client_bytes_sent),
+        atomic_load(&metrics.blocked_requests), atomic_load(&metrics.upstream_errors));
+
+    unsigned long cumulative = 0;
+    for (int bucket = 0; bucket < DURATION_BUCKETS && used < size; bucket++) {
+        cumulative += atomic_load(&metrics.duration_buckets[bucket]);
+        used += snprintf(out + used, size - used, "proxy_request_duration_seconds_bucket{le=\"%g\"} %lu\n",
+                         duration_bucket_bounds[bucket], cumulative);
+    }
+    if (used < size) {
+        used += snprintf(out + used, size - used,
+            "proxy_request_duration_seconds_bucket{le=\"+Inf\"} %lu\n"
+            "proxy_request_duration_seconds_sum %.6f\n"
+            "proxy_request_duration_seconds_count %lu\n",
+            atomic_load(&metrics.duration_count), atomic_load(&metrics.duration_sum_us) / 1e6,
+            atomic_load(&metrics.duration_count));
+    }
+    return used < size ? (int)used : (int)size - 1;
+}
+
+// Answers every HTTP request on METRICS_PORT with the current metrics
+void* metrics_listener(void* arg) {
+    int metrics_socket = create_server_socket(INADDR_LOOPBACK, METRICS_PORT);
+    if (metrics_socket < 0) {
+        perror("Failed to start metrics listener");
+        return NULL;
+    }
+    printf("Metrics listener running on port %d\n", METRICS_PORT);
+
+    while (1) {
+        int scrape_socket = accept(metrics_socket, NULL, NULL);
+        if (scrape_socket < 0) {
+            perror("Failed to accept metrics connection");
+            continue;
+        }
+
+        // Scrapers send a short GET, its content does not matter
+        struct timeval timeout = {2, 0};
+        setsockopt(scrape_socket, SOL_SOCKET, SO_RCVTIMEO, &timeout, sizeof(timeout));
+        char request[2048];
+        recv(scrape_socket, request, sizeof(request), 0);
+
+        char body[4096], head[256];
+        int body_length = format_metrics(body, sizeof(body));
+        int head_length = snprintf(head, sizeof(head),
+            "HTTP/1.1 200 OK\r\n"
+            "Content-Type: text/plain; version=0.0.4\r\n"
+            "Content-Length: %d\r\n"
+            "Connection: close\r\n\r\n", body_length);
+        if (send_all(scrape_socket, head, head_length)) send_all(scrape_socket, body, body_length);
+        close(scrape_socket);
+    }
+    return NULL;
+}
+
+// Replaces the rewrite rules with the list of each REWRITE_RULES frame
+void* rewrite_rules_listener(void* arg) {
+    int rules_socket = create_server_socket(INADDR_LOOPBACK, REWRITE_PORT);
+    if (rules_socket < 0) {
+        perror("Failed to start rewrite rules listener");
+        return NULL;
+    }
+    printf("Rewrite rules listener running on port %d\n", REWRITE_PORT);
 
     while (1) {
-        int* client_socket = malloc(sizeof(int));
-        *client_socket = accept(server_fd, (struct sockaddr*)&client_addr, &client_addr_len);
-        pthread_t thread_id;
-        pthread_create(&thread_id, NULL, handle_client, client_socket);
-        pthread_detach(thread_id);
+        int control_socket = accept(rules_socket, NULL, NULL);
+        if (control_socket < 0) {
+            perror("Failed to accept rewrite rules connection");
+            continue;
+        }
+
+        // Any number of lists per connection, each one answered in turn
+        frame update;
+        while (recv_frame(control_socket, &update)) {
+            char error[512] = "";
+            uint8_t reply = REWRITE_ERROR;
+            if (update.type == REWRITE_RULES) {
+                rewrite_rules_t* list = rewrite_rules_parse(update.body, error, sizeof(error));
+                update.body = NULL;  // Taken over by the list
+                if (list != NULL) {
+                    printf("Loaded %zu rewrite rules\n", list->count);
+                    rewrite_rules_publish(list);
+                    reply = REWRITE_ACK;
+                }
+            } else {
+                snprintf(error, sizeof(error), "unexpected frame type %u", update.type);
+            }
+            free_frame(&update);
+            if (!send_frame(control_socket, reply, 0, update.id, NULL, 0, error, strlen(error))) break;
+        }
+        close(control_socket);
     }
+    return NULL;
 }
 
 int main() {
@@ -635,14 +4095,29 @@ int main() {
     pthread_mutex_init(&intercept_lock, NULL);
     pthread_mutex_init(&blocked_domains_lock, NULL);
 
-    int server_fd = create_server_socket(PROXY_PORT);
+    // The response cache keeps a disk tier only when given a directory
+    cache_directory = getenv("PROXY_CACHE_DIR");
+    if (cache_directory != NULL && *cache_directory) cache_disk_load();
+    else cache_directory = NULL;
+
+    int server_fd = create_server_socket(INADDR_ANY, PROXY_PORT);
+    if (server_fd < 0) {
+        perror("Failed to start proxy server");
+        return 1;
+    }
     printf("Proxy Server running on port %d\n", PROXY_PORT);
 
-    pthread_t control_thread, blocked_domains_thread;
+    pthread_t control_thread, blocked_domains_thread, pool_reaper_thread, metrics_thread, credentials_thread,
+              rewrite_rules_thread;
     pthread_create(&control_thread, NULL, intercept_control_listener, NULL);
     pthread_create(&blocked_domains_thread, NULL, blocked_domains_listener, NULL);
+    pthread_create(&pool_reaper_thread, NULL, pool_reaper, NULL);
+    pthread_create(&metrics_thread, NULL, metrics_listener, NULL);
+    pthread_create(&credentials_thread, NULL, credentials_watcher, NULL);
+    pthread_create(&rewrite_rules_thread, NULL, rewrite_rules_listener, NULL);
 
-    accept_connections(server_fd);
+    start_workers();
+    run_event_loop(server_fd);
 
     close(server_fd);
     pthread_mutex_destroy(&intercept_lock);